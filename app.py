@@ -4,9 +4,11 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from flask_login import LoginManager
+from services.metrics import TimedQueuePool
+from services.logging_setup import configure_logging, init_app as init_logging
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (queue-based, structured; see services/logging_setup.py)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 class Base(DeclarativeBase):
@@ -30,10 +32,14 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_recycle": 300,
     "pool_pre_ping": True,
 }
+# Measure connection checkout waits (in-memory SQLite needs its single-connection pool)
+if ":memory:" not in database_url:
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"]["poolclass"] = TimedQueuePool
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
 # Initialize extensions with app
 db.init_app(app)
+init_logging(app)
 login_manager.init_app(app)
 login_manager.login_view = 'auth.login'
 login_manager.login_message_category = 'info'
@@ -48,6 +54,8 @@ models.ChatMessage = type('ChatMessage', (models.ChatMessage, db.Model), {})
 models.BotStyle = type('BotStyle', (models.BotStyle, db.Model), {})
 models.Config = type('Config', (models.Config, db.Model), {})
 models.Document = type('Document', (models.Document, db.Model), {})
+models.DocumentChunk = type('DocumentChunk', (models.DocumentChunk, db.Model), {})
+models.MessageStat = type('MessageStat', (models.MessageStat, db.Model), {})
 models.LogEntry = type('LogEntry', (models.LogEntry, db.Model), {})
 
 # Import for easy access
@@ -57,6 +65,8 @@ ChatMessage = models.ChatMessage
 BotStyle = models.BotStyle
 Config = models.Config
 Document = models.Document
+DocumentChunk = models.DocumentChunk
+MessageStat = models.MessageStat
 LogEntry = models.LogEntry
 
 # Create tables and initialize data
@@ -64,6 +74,10 @@ with app.app_context():
     # Create tables if they don't exist
     db.create_all()
     
+    # Bring existing tables up to date (indexes, constraints, new columns)
+    from migrations import run_migrations
+    run_migrations(db)
+    
     # Create initial admin user if no users exist
     if not User.query.first():
         from werkzeug.security import generate_password_hash
@@ -112,11 +126,13 @@ from routes.admin import admin_bp
 from routes.webhook import webhook_bp
 from routes.auth import auth_bp
 from routes.api import api_bp
+from routes.metrics import metrics_bp
 
 app.register_blueprint(admin_bp)
 app.register_blueprint(webhook_bp)
 app.register_blueprint(auth_bp)
 app.register_blueprint(api_bp)
+app.register_blueprint(metrics_bp)
 
 # Create knowledge_base directory if it doesn't exist
 import os
@@ -0,0 +1,105 @@
+"""ASGI entry point: the LINE webhook and /api/chat on the event loop, the Flask app for everything else
+
+Run with, for example:
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+POST /webhook and POST /api/chat are served natively with the async OpenAI
+client, the async LINE Messaging API client and an async database engine, so
+one process carries many conversations while they wait on the LLM. All other
+routes (admin UI, login, /metrics, streaming chat) run in the Flask app through
+WsgiToAsgi, unchanged. main:app under gunicorn keeps working as before.
+
+Per-user message ordering and coalescing (services.user_queue) are tracked per
+process; run a single worker where they must hold for every delivery. With
+uvicorn --workers, metrics are merged through a per-server directory (see below).
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+# uvicorn --workers N spawns its workers without gunicorn.conf.py, so give them a metrics
+# directory of their own, shared by the workers of one server (they have the same parent)
+# so /metrics merges them. It must be set before prometheus_client is imported.
+if multiprocessing.parent_process() is not None and "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(
+        tempfile.gettempdir(), f"prometheus_multiproc_{multiprocessing.parent_process().pid}"
+    )
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app, db
+from routes.async_api import chat
+from routes.async_webhook import close_line_client, drain_tasks, line_webhook
+from routes.utils.config_service import ConfigManager
+from services.async_db import dispose_async_db, init_async_db
+from services.llm_service import LLMService
+from services.metrics import HTTP_REQUESTS, HTTP_REQUEST_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# (method, path) -> (metrics endpoint label, handler)
+ASYNC_ROUTES = {
+    ("POST", "/webhook"): ("async_webhook.line_webhook", line_webhook),
+    ("POST", "/api/chat"): ("async_api.chat", chat),
+}
+
+flask_application = WsgiToAsgi(app)
+
+
+async def lifespan(receive, send):
+    """Create the async engine at startup; finish in-flight events and close clients at shutdown"""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            with app.app_context():
+                init_async_db(db.engine)
+                # Load the config snapshot up front; afterwards it is refreshed off the event loop
+                await asyncio.to_thread(ConfigManager.get_all)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            with app.app_context():
+                timeout = float(ConfigManager.get("ASYNC_SHUTDOWN_TIMEOUT", "25"))
+            await drain_tasks(timeout)
+            await close_line_client()
+            for task in list(LLMService._retiring_async_clients):
+                task.cancel()
+            for client in [*LLMService._async_clients.values(), *LLMService._retiring_async_clients.values()]:
+                await client.close()
+            await dispose_async_db()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """Dispatch to a native async handler or the Flask app"""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+
+    route = ASYNC_ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if route is None:
+        await flask_application(scope, receive, send)
+        return
+
+    endpoint, handler = route
+    response_status = []
+
+    async def send_and_record(message):
+        if message["type"] == "http.response.start":
+            response_status.append(message["status"])
+        await send(message)
+
+    started = time.perf_counter()
+    try:
+        with app.app_context():
+            # Servers without lifespan support get the engine on first use
+            init_async_db(db.engine)
+            await handler(scope, receive, send_and_record)
+    finally:
+        status = str(response_status[0]) if response_status else "500"
+        HTTP_REQUESTS.labels(endpoint, scope["method"], status).inc()
+        HTTP_REQUEST_SECONDS.labels(endpoint, scope["method"]).observe(time.perf_counter() - started)
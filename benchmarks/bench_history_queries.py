@@ -0,0 +1,166 @@
+"""Benchmark chat history queries before and after the schema migrations add their indexes.
+
+Seeds a throwaway database with synthetic LINE users and messages, drops the
+migration-managed indexes to reproduce the old schema, times the admin queries,
+then applies the migrations and times them again.
+
+The database is a temporary SQLite file; DATABASE_URL is ignored. Pass
+--database-url to benchmark another (empty) database, e.g. a scratch PostgreSQL
+one. The benchmark refuses to run against a database that already holds LINE
+users or messages.
+
+    python benchmarks/bench_history_queries.py --users 2000 --messages 500000
+    python benchmarks/bench_history_queries.py --database-url postgresql://.../scratch
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# Tables the benchmark fills with synthetic rows; they must start out empty
+SEEDED_TABLES = ["line_user", "chat_message"]
+
+MIGRATION_INDEXES = [
+    "ix_chat_message_line_user_id_timestamp",
+    "ix_chat_message_timestamp",
+    "ix_document_is_active",
+]
+
+
+def existing_rows(database_url):
+    """Count the rows already in the tables the benchmark would fill"""
+    from sqlalchemy import create_engine, inspect, text
+
+    engine = create_engine(database_url)
+    try:
+        with engine.connect() as conn:
+            tables = set(inspect(conn).get_table_names())
+            return {
+                table: conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+                for table in SEEDED_TABLES if table in tables
+            }
+    finally:
+        engine.dispose()
+
+
+def seed(db, users, messages, batch_size=10000):
+    """Insert synthetic LINE users and chat messages with bulk executemany inserts"""
+    from sqlalchemy import insert
+    from app import LineUser, ChatMessage
+
+    now = datetime.utcnow()
+    user_ids = [f"Ubench{i:08d}" for i in range(users)]
+    db.session.execute(insert(LineUser), [
+        {"line_user_id": user_id, "display_name": f"User {i}", "created_at": now, "last_interaction": now}
+        for i, user_id in enumerate(user_ids)
+    ])
+
+    rng = random.Random(42)
+    for start in range(0, messages, batch_size):
+        rows = []
+        for i in range(start, min(start + batch_size, messages)):
+            rows.append({
+                "line_user_id": rng.choice(user_ids),
+                "is_user_message": i % 2 == 0,
+                "message_text": f"synthetic message {i}",
+                "timestamp": now - timedelta(seconds=rng.randrange(90 * 86400)),
+            })
+        db.session.execute(insert(ChatMessage), rows)
+    db.session.commit()
+    return user_ids
+
+
+def time_query(db, sql, params_list, repeat):
+    """Run a query for each parameter set and return per-run latencies in milliseconds"""
+    from sqlalchemy import text
+
+    latencies = []
+    for _ in range(repeat):
+        for params in params_list:
+            started = time.perf_counter()
+            db.session.execute(text(sql), params).all()
+            latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def run_queries(db, user_ids, repeat):
+    """Time the queries behind the message history and dashboard pages"""
+    sample_users = [{"user_id": user_id} for user_id in random.Random(7).sample(user_ids, min(20, len(user_ids)))]
+    queries = {
+        "history by user": (
+            "SELECT * FROM chat_message WHERE line_user_id = :user_id ORDER BY timestamp DESC LIMIT 50",
+            sample_users,
+        ),
+        "recent messages": ("SELECT * FROM chat_message ORDER BY timestamp DESC LIMIT 10", [{}]),
+        "active documents": ("SELECT * FROM document WHERE is_active = true", [{}]),
+    }
+    results = {}
+    for name, (sql, params_list) in queries.items():
+        latencies = time_query(db, sql, params_list, repeat)
+        results[name] = (statistics.median(latencies), max(latencies))
+    return results
+
+
+def drop_migration_indexes(db):
+    """Reproduce the pre-migration schema"""
+    from sqlalchemy import text
+
+    for name in MIGRATION_INDEXES:
+        db.session.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    db.session.execute(text("DELETE FROM schema_migration"))
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000, help="number of synthetic LINE users")
+    parser.add_argument("--messages", type=int, default=200000, help="number of synthetic chat messages")
+    parser.add_argument("--repeat", type=int, default=5, help="repetitions per query")
+    parser.add_argument("--database-url", help="empty database to use instead of a temporary SQLite file")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_history_queries_")
+    database_url = args.database_url or f"sqlite:///{os.path.join(work_dir, 'bench.db')}"
+    rows = {table: count for table, count in existing_rows(database_url).items() if count}
+    if rows:
+        counts = ", ".join(f"{count} in {table}" for table, count in rows.items())
+        sys.exit(f"Refusing to benchmark a database that already has data ({counts}); use an empty database")
+
+    # The app reads DATABASE_URL when it is imported
+    os.environ["DATABASE_URL"] = database_url
+    os.chdir(work_dir)
+
+    import logging
+    from app import app, db
+    from migrations import run_migrations
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with app.app_context():
+        print(f"Seeding {args.users} users and {args.messages} messages into {db.engine.url.render_as_string()}")
+        started = time.perf_counter()
+        user_ids = seed(db, args.users, args.messages)
+        print(f"Seeded in {time.perf_counter() - started:.1f}s")
+
+        drop_migration_indexes(db)
+        before = run_queries(db, user_ids, args.repeat)
+
+        started = time.perf_counter()
+        run_migrations(db)
+        print(f"Migrations applied in {time.perf_counter() - started:.2f}s")
+        after = run_queries(db, user_ids, args.repeat)
+
+    print(f"\n{'query':<18} {'before p50':>11} {'before max':>11} {'after p50':>10} {'after max':>10}")
+    for name in before:
+        print(f"{name:<18} {before[name][0]:>9.2f}ms {before[name][1]:>9.2f}ms "
+              f"{after[name][0]:>8.2f}ms {after[name][1]:>8.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
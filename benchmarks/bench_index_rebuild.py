@@ -0,0 +1,136 @@
+"""Benchmark RAG index rebuild throughput against a local stub of the OpenAI embeddings endpoint.
+
+Times RAGService.update_index end to end (re-chunking, batched concurrent
+embedding requests, the vectorised index add and the atomic save) on synthetic
+documents, next to the old one-request-per-chunk loop over the same chunks.
+
+    python benchmarks/bench_index_rebuild.py --docs 500 --latency-ms 80
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# Always run against a throwaway database and working directory: the rebuild
+# rewrites document chunks, so an exported DATABASE_URL is never used. The database
+# is a file because an in-memory SQLite database shares one connection across the
+# engine, and ConfigManager's own connection would roll back the rebuild's session.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.chdir(tempfile.mkdtemp(prefix="bench_index_rebuild_"))
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(os.getcwd(), "bench.sqlite")
+
+
+class StubEmbeddingsHandler(BaseHTTPRequestHandler):
+    """Minimal /v1/embeddings endpoint returning random vectors after a fixed delay"""
+
+    latency = 0.08
+    per_input_latency = 0.0005
+    requests = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        inputs = payload["input"] if isinstance(payload["input"], list) else [payload["input"]]
+        with StubEmbeddingsHandler.lock:
+            StubEmbeddingsHandler.requests += 1
+        time.sleep(self.latency + self.per_input_latency * len(inputs))
+
+        vectors = np.random.default_rng().random((len(inputs), 1536), dtype=np.float32)
+        body = json.dumps({
+            "object": "list",
+            "model": payload["model"],
+            "data": [
+                {"object": "embedding", "index": i, "embedding": vector.tolist()}
+                for i, vector in enumerate(vectors)
+            ],
+            "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+        }).encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_serial(RAGService, client, texts):
+    """Old behaviour: one embeddings request per chunk, one index add per vector"""
+    index = RAGService.new_index()
+    for chunk_id, text in enumerate(texts):
+        embedding = RAGService.get_embedding(text, client)
+        index.add_with_ids(np.array([embedding], dtype="float32"), np.array([chunk_id], dtype="int64"))
+    return index.ntotal
+
+
+def run_rebuild(RAGService, RAGIndex):
+    """Current behaviour: the full RAGService.update_index rebuild the admin page queues"""
+    if not RAGService.update_index():
+        raise SystemExit("update_index failed, see the log above")
+    return RAGIndex.get()[0].ntotal
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=500, help="number of synthetic documents")
+    parser.add_argument("--doc-chars", type=int, default=400, help="characters per document")
+    parser.add_argument("--latency-ms", type=float, default=80, help="stub latency per request")
+    parser.add_argument("--batch-tokens", type=int, default=20000, help="token budget per batch")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent batch requests")
+    parser.add_argument("--skip-serial", action="store_true", help="only run the update_index rebuild")
+    args = parser.parse_args()
+
+    StubEmbeddingsHandler.latency = args.latency_ms / 1000.0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubEmbeddingsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # update_index builds its own pooled client from the settings; environment variables win
+    os.environ["OPENAI_API_KEY"] = "stub"
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/v1"
+    os.environ["EMBEDDING_BATCH_TOKENS"] = str(args.batch_tokens)
+    os.environ["EMBEDDING_CONCURRENCY"] = str(args.concurrency)
+    os.environ["RAG_ENABLED"] = "True"
+
+    import logging
+    from openai import OpenAI
+    from app import app, db
+    from models import Document, DocumentChunk
+    from rag_service import RAGIndex, RAGService
+    logging.getLogger().setLevel(logging.WARNING)
+
+    text = ("這是一段用於基準測試的知識庫內容。" * args.doc_chars)[:args.doc_chars]
+    with app.app_context():
+        db.session.add_all(Document(title=f"doc {i}", content=f"{i} {text}") for i in range(args.docs))
+        db.session.commit()
+
+        runs = [("rebuild", lambda: run_rebuild(RAGService, RAGIndex))]
+        if not args.skip_serial:
+            client = OpenAI(api_key="stub", base_url=os.environ["OPENAI_BASE_URL"], max_retries=0)
+            # Same chunks as the rebuild, which runs first and stores them
+            runs.append(("serial", lambda: run_serial(
+                RAGService, client, [content for content, in db.session.query(DocumentChunk.content)]
+            )))
+
+        print(f"{args.docs} docs x {args.doc_chars} chars, stub latency {args.latency_ms:.0f} ms/request")
+        for name, run in runs:
+            StubEmbeddingsHandler.requests = 0
+            started = time.perf_counter()
+            vectors = run()
+            elapsed = time.perf_counter() - started
+            print(f"{name:>8}: {elapsed:7.2f}s  {args.docs / elapsed:8.1f} docs/s  "
+                  f"{StubEmbeddingsHandler.requests:5d} requests  {vectors} vectors")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -38,6 +38,32 @@ class LLMSettingsForm(FlaskForm):
         validators=[DataRequired(), NumberRange(min=50, max=4000)],
         default=500
     )
+    default_model = StringField('Default Model', validators=[Optional(), Length(max=64)])
+    route_chat_model = StringField('Chat Model', validators=[Optional(), Length(max=64)])
+    route_chat_max_tokens = IntegerField('Chat Max Tokens', validators=[Optional(), NumberRange(min=50, max=4000)])
+    route_long_model = StringField('Long Message Model', validators=[Optional(), Length(max=64)])
+    route_long_max_tokens = IntegerField('Long Message Max Tokens', validators=[Optional(), NumberRange(min=50, max=4000)])
+    route_long_chars = IntegerField('Long Message Threshold', validators=[Optional(), NumberRange(min=1, max=5000)])
+    route_rag_model = StringField('Knowledge Base Model', validators=[Optional(), Length(max=64)])
+    route_rag_max_tokens = IntegerField('Knowledge Base Max Tokens', validators=[Optional(), NumberRange(min=50, max=4000)])
+    fallback_model = StringField('Fallback Model', validators=[Optional(), Length(max=64)])
+    streaming_enabled = BooleanField('Stream Long Replies')
+    response_cache_enabled = BooleanField('Enable Response Cache')
+    response_cache_ttl = IntegerField(
+        'Response Cache TTL (seconds)',
+        validators=[Optional(), NumberRange(min=60, max=604800)],
+        default=3600
+    )
+    response_cache_size = IntegerField(
+        'Response Cache Size',
+        validators=[Optional(), NumberRange(min=1, max=100000)],
+        default=1000
+    )
+    response_cache_threshold = FloatField(
+        'Similarity Threshold',
+        validators=[Optional(), NumberRange(min=0.5, max=1)],
+        default=0.95
+    )
     submit = SubmitField('Save Settings')
 
 class BotStyleForm(FlaskForm):
@@ -46,6 +72,9 @@ class BotStyleForm(FlaskForm):
     prompt = TextAreaField('System Prompt', validators=[DataRequired()])
     description = TextAreaField('Description', validators=[Optional()])
     is_default = BooleanField('Set as Default')
+    model = StringField('Model', validators=[Optional(), Length(max=64)])
+    temperature = FloatField('Temperature', validators=[Optional(), NumberRange(min=0, max=2)])
+    max_tokens = IntegerField('Max Tokens', validators=[Optional(), NumberRange(min=50, max=4000)])
     submit = SubmitField('Save Style')
 
 class BotSettingsForm(FlaskForm):
@@ -0,0 +1,22 @@
+import os
+import shutil
+
+# Gunicorn loads this file from the working directory; the CLI flags (bind, workers) still apply.
+
+# Workers write their metrics to files here so /metrics can merge them (see services/metrics.py).
+# The variable must be set before the workers import prometheus_client.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_multiproc")
+
+
+def on_starting(server):
+    """Start with an empty metrics directory so counters from a previous run are not merged in"""
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Drop the live gauges of a worker that has exited"""
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,175 @@
+import logging
+from datetime import datetime
+from sqlalchemy import insert, inspect, text
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+# db.create_all() only creates missing tables. Changes to existing tables (indexes,
+# constraints, columns) are listed here and applied once, in order, at startup.
+# Every migration must be idempotent, since a database created by create_all()
+# already has the current schema.
+
+# Arbitrary key for the PostgreSQL advisory lock that serializes concurrent workers
+MIGRATION_LOCK_ID = 72871001
+
+
+def _add_column(conn, table, column, ddl):
+    """Add a column unless it already exists (create_all() adds it on new databases)"""
+    if column in {c["name"] for c in inspect(conn).get_columns(table)}:
+        return
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def _add_chat_history_indexes(conn):
+    """Index chat history by user and time, and documents by active flag"""
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_chat_message_line_user_id_timestamp "
+        "ON chat_message (line_user_id, timestamp)"
+    ))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_chat_message_timestamp ON chat_message (timestamp)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_document_is_active ON document (is_active)"))
+
+
+def _add_chat_message_line_user_fk(conn):
+    """Reference line_user from chat_message (PostgreSQL only; SQLite cannot add constraints)"""
+    if conn.dialect.name != "postgresql":
+        return
+    exists = conn.execute(text(
+        "SELECT 1 FROM pg_constraint WHERE conname = 'fk_chat_message_line_user_id'"
+    )).first()
+    if not exists:
+        # NOT VALID skips checking existing rows, so this doesn't scan a large table at startup
+        conn.execute(text(
+            "ALTER TABLE chat_message ADD CONSTRAINT fk_chat_message_line_user_id "
+            "FOREIGN KEY (line_user_id) REFERENCES line_user (line_user_id) NOT VALID"
+        ))
+
+
+def _backfill_message_stats(conn):
+    """Build the hourly dashboard rollups from existing messages and users
+
+    This is the only place the rollups are rebuilt. Afterwards they are only
+    incremented as turns are saved, so deleting messages or users later never
+    lowers the dashboard totals.
+    """
+    # Import here: the models are mapped by app.py before migrations run
+    from models import MessageStat
+
+    if conn.dialect.name == "postgresql":
+        hour_of = "date_trunc('hour', {column})"
+    else:
+        hour_of = "strftime('%Y-%m-%d %H:00:00', {column})"
+
+    buckets = {}
+    message_counts = conn.execute(text(
+        f"SELECT {hour_of.format(column='timestamp')} AS hour, "
+        "SUM(CASE WHEN is_user_message THEN 1 ELSE 0 END), "
+        "SUM(CASE WHEN is_user_message THEN 0 ELSE 1 END) "
+        "FROM chat_message WHERE timestamp IS NOT NULL GROUP BY 1"
+    ))
+    for hour, user_messages, bot_messages in message_counts:
+        buckets[hour] = [int(user_messages), int(bot_messages), 0]
+    new_user_counts = conn.execute(text(
+        f"SELECT {hour_of.format(column='created_at')} AS hour, COUNT(*) "
+        "FROM line_user WHERE created_at IS NOT NULL GROUP BY 1"
+    ))
+    for hour, new_users in new_user_counts:
+        buckets.setdefault(hour, [0, 0, 0])[2] = int(new_users)
+
+    # Rebuild from scratch so that re-running the backfill never double counts
+    conn.execute(text("DELETE FROM message_stat"))
+    if buckets:
+        # Insert through the table so hour is stored in the same format as the ORM upserts write it
+        conn.execute(
+            insert(MessageStat.__table__),
+            [
+                {
+                    "hour": hour if isinstance(hour, datetime) else datetime.fromisoformat(hour),
+                    "user_messages": counts[0],
+                    "bot_messages": counts[1],
+                    "new_users": counts[2],
+                }
+                for hour, counts in buckets.items()
+            ]
+        )
+
+
+def _rebuild_sqlite_message_stats(conn):
+    """Rebuild the rollups on SQLite, where the first backfill stored hours in a different text format
+
+    Rows written by that backfill and by later upserts for the same hour did not
+    collide on the unique hour key, so the hour was counted twice.
+    """
+    if conn.dialect.name == "sqlite":
+        _backfill_message_stats(conn)
+
+
+def _add_line_user_conversation_summary(conn):
+    """Store the rolling summary of older conversation turns per LINE user"""
+    _add_column(conn, "line_user", "conversation_summary", "TEXT")
+
+
+def _add_bot_style_generation_settings(conn):
+    """Let each bot style choose its model, temperature and max tokens"""
+    _add_column(conn, "bot_style", "model", "VARCHAR(64)")
+    _add_column(conn, "bot_style", "temperature", "FLOAT")
+    _add_column(conn, "bot_style", "max_tokens", "INTEGER")
+
+
+def _add_chat_message_usage(conn):
+    """Record model, token usage and prompt measurements on bot replies"""
+    _add_column(conn, "chat_message", "model", "VARCHAR(64)")
+    _add_column(conn, "chat_message", "prompt_tokens", "INTEGER")
+    _add_column(conn, "chat_message", "completion_tokens", "INTEGER")
+    _add_column(conn, "chat_message", "embedding_tokens", "INTEGER")
+    _add_column(conn, "chat_message", "rag_context_tokens", "INTEGER")
+    _add_column(conn, "chat_message", "prompt_build_ms", "FLOAT")
+
+
+# (version, description, function) -- append only, never renumber
+MIGRATIONS = [
+    (1, "Add chat history and document indexes", _add_chat_history_indexes),
+    (2, "Add chat_message.line_user_id foreign key", _add_chat_message_line_user_fk),
+    (3, "Backfill hourly message statistics", _backfill_message_stats),
+    (4, "Add line_user.conversation_summary", _add_line_user_conversation_summary),
+    (5, "Add bot_style model, temperature and max_tokens", _add_bot_style_generation_settings),
+    (6, "Add chat_message token usage columns", _add_chat_message_usage),
+    (7, "Rebuild SQLite hourly message statistics", _rebuild_sqlite_message_stats),
+]
+
+
+def _applied_versions(conn):
+    """Get the set of migration versions already applied"""
+    return {row[0] for row in conn.execute(text("SELECT version FROM schema_migration"))}
+
+
+def run_migrations(db):
+    """Apply pending schema migrations, each in its own transaction"""
+    engine = db.engine
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migration ("
+            "version INTEGER PRIMARY KEY, description VARCHAR(256) NOT NULL, applied_at TIMESTAMP NOT NULL)"
+        ))
+        pending = [m for m in MIGRATIONS if m[0] not in _applied_versions(conn)]
+
+    for version, description, migrate in pending:
+        try:
+            with engine.begin() as conn:
+                if conn.dialect.name == "postgresql":
+                    # Several gunicorn workers start at once; let one of them run each migration
+                    conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID})
+                if version in _applied_versions(conn):
+                    continue
+
+                migrate(conn)
+                conn.execute(
+                    text("INSERT INTO schema_migration (version, description, applied_at) VALUES (:version, :description, :applied_at)"),
+                    {"version": version, "description": description, "applied_at": datetime.utcnow()}
+                )
+        except IntegrityError:
+            # Another worker recorded the same (idempotent) migration first
+            logger.info("Schema migration %s was applied by another worker", version)
+            continue
+        logger.info("Applied schema migration %s: %s", version, description)
@@ -1,6 +1,6 @@
 from datetime import datetime
 from flask_login import UserMixin
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, Float, ForeignKey, Index
 from sqlalchemy.sql import func
 
 # These models will be initialized with the actual db instance in app.py
@@ -30,6 +30,7 @@ class LineUser:
     picture_url = Column(String(256), nullable=True)
     status_message = Column(String(256), nullable=True)
     active_style = Column(String(64), nullable=True)
+    conversation_summary = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     last_interaction = Column(DateTime, default=datetime.utcnow)
 
@@ -39,13 +40,30 @@ class LineUser:
 class ChatMessage:
     """Model to store chat message history"""
     __tablename__ = 'chat_message'
+    __table_args__ = (
+        # Per-user history ordered by time (message history filter, conversation lookups)
+        Index('ix_chat_message_line_user_id_timestamp', 'line_user_id', 'timestamp'),
+        # Global history ordered by time (dashboard, unfiltered message history)
+        Index('ix_chat_message_timestamp', 'timestamp'),
+    )
     
     id = Column(Integer, primary_key=True)
-    line_user_id = Column(String(64), nullable=False)
+    line_user_id = Column(
+        String(64),
+        ForeignKey('line_user.line_user_id', name='fk_chat_message_line_user_id'),
+        nullable=False
+    )
     is_user_message = Column(Boolean, default=True)
     message_text = Column(Text, nullable=False)
     bot_style = Column(String(64), nullable=True)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    # Usage of the turn, stored on the bot's reply
+    model = Column(String(64), nullable=True)
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    embedding_tokens = Column(Integer, nullable=True)
+    rag_context_tokens = Column(Integer, nullable=True)
+    prompt_build_ms = Column(Float, nullable=True)
 
     def __repr__(self):
         return f'<ChatMessage {self.id}>'
@@ -59,6 +77,10 @@ class BotStyle:
     prompt = Column(Text, nullable=False)
     description = Column(Text, nullable=True)
     is_default = Column(Boolean, default=False)
+    # Optional per-style generation settings; None falls back to the model router and global settings
+    model = Column(String(64), nullable=True)
+    temperature = Column(Float, nullable=True)
+    max_tokens = Column(Integer, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -86,11 +108,38 @@ class Document:
     filename = Column(String(128), nullable=True)
     uploaded_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    is_active = Column(Boolean, default=True)
+    is_active = Column(Boolean, default=True, index=True)
     
     def __repr__(self):
         return f'<Document {self.title}>'
 
+class DocumentChunk:
+    """Model to store the retrievable passages of knowledge base documents"""
+    __tablename__ = 'document_chunk'
+    
+    id = Column(Integer, primary_key=True)
+    document_id = Column(Integer, ForeignKey('document.id', ondelete='CASCADE'), nullable=False, index=True)
+    chunk_index = Column(Integer, nullable=False)
+    content = Column(Text, nullable=False)
+    token_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<DocumentChunk {self.document_id}:{self.chunk_index}>'
+
+class MessageStat:
+    """Model to store hourly message and new user counts for the dashboard"""
+    __tablename__ = 'message_stat'
+    
+    id = Column(Integer, primary_key=True)
+    hour = Column(DateTime, unique=True, nullable=False)  # UTC start of the hour
+    user_messages = Column(Integer, nullable=False, default=0)
+    bot_messages = Column(Integer, nullable=False, default=0)
+    new_users = Column(Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<MessageStat {self.hour}>'
+
 class LogEntry:
     """Model to store system logs"""
     __tablename__ = 'log_entry'
@@ -1,135 +1,539 @@
+import asyncio
 import os
+import fcntl
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import numpy as np
 import faiss
 import pickle
-from models import Document
+import shutil
+from models import Document, DocumentChunk
 from app import db
 from config import is_rag_enabled
 from services.llm_service import LLMService
+from services.tokens import estimate_tokens
+from services.chunker import iter_chunks
+from services.embedding_cache import get_embedding_cache
+from services.resilience import call_with_resilience, acall_with_resilience
+from services.usage import record_embedding_usage
+from services.tracing import span, traced
+from services.metrics import RAG_INDEX_VECTORS, RAG_SEARCH_SECONDS, observe_openai_call
+from routes.utils.config_service import ConfigManager
 
 logger = logging.getLogger(__name__)
 
+class RAGIndex:
+    """Process-wide in-memory FAISS index, reloaded only when the files on disk change
+    
+    Searches read an immutable (index, passages, version) snapshot; rebuilds
+    publish a new snapshot in a single assignment, so readers never see a
+    half-updated index and never block on a reload in progress.
+    """
+    
+    _lock = threading.Lock()
+    _write_lock = threading.Lock()
+    _snapshot = None
+    
+    LOCK_PATH = "knowledge_base/index.lock"
+    
+    @staticmethod
+    @contextmanager
+    def write_lock():
+        """Serialize index writers across threads and gunicorn worker processes"""
+        os.makedirs(os.path.dirname(RAGIndex.LOCK_PATH), exist_ok=True)
+        with RAGIndex._write_lock:
+            with open(RAGIndex.LOCK_PATH, 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    @staticmethod
+    def disk_version():
+        """Get the version of the index on disk, or None if there is none
+        
+        This is the versioned directory the current-index link points at; indexes
+        saved before versioned directories are versioned by their files' mtimes.
+        """
+        try:
+            return os.readlink(RAGService.CURRENT_INDEX_PATH)
+        except FileNotFoundError:
+            pass
+        try:
+            return (
+                os.stat(RAGService.INDEX_PATH).st_mtime_ns,
+                os.stat(RAGService.EMBEDDINGS_PATH).st_mtime_ns
+            )
+        except FileNotFoundError:
+            return None
+    
+    @classmethod
+    def get(cls):
+        """Get the current index snapshot, loading it from disk if it is missing or stale"""
+        version = cls.disk_version()
+        snapshot = cls._snapshot
+        if snapshot is not None and snapshot[2] == version:
+            return snapshot
+        
+        with cls._lock:
+            # Another thread may have loaded it while we waited for the lock
+            snapshot = cls._snapshot
+            if snapshot is None or snapshot[2] != version:
+                index, passages = RAGService.initialize_index(version)
+                snapshot = (index, passages, version)
+                cls._snapshot = snapshot
+                RAG_INDEX_VECTORS.set(index.ntotal)
+                logger.info("Loaded RAG index into memory with %s vectors", index.ntotal)
+            return snapshot
+    
+    @classmethod
+    def publish(cls, index, passages):
+        """Swap in a freshly built index that has already been saved to disk"""
+        with cls._lock:
+            cls._snapshot = (index, passages, cls.disk_version())
+        RAG_INDEX_VECTORS.set(index.ntotal)
+    
+    @classmethod
+    def generation(cls):
+        """Get an opaque value that changes whenever the index contents change"""
+        return cls.get()[2]
+
 class RAGService:
     """Service for Retrieval Augmented Generation (RAG)"""
     
-    # Path for storing the FAISS index
+    # The FAISS index and its passages are saved together in a versioned directory
+    # under INDEX_DIR; CURRENT_INDEX_PATH is a symlink to the current one
+    INDEX_DIR = "knowledge_base"
+    CURRENT_INDEX_PATH = "knowledge_base/current"
+    INDEX_FILE = "faiss_index.idx"
+    EMBEDDINGS_FILE = "embeddings.pkl"
+    
+    # Where versions without versioned directories saved the index
     INDEX_PATH = "knowledge_base/faiss_index.idx"
     EMBEDDINGS_PATH = "knowledge_base/embeddings.pkl"
+    EMBEDDING_MODEL = "text-embedding-3-small"
+    EMBEDDING_DIM = 1536  # OpenAI's text-embedding-3-small dimension
+    
+    # The embeddings endpoint accepts at most 2048 inputs per request
+    MAX_BATCH_INPUTS = 2048
     
     @staticmethod
     def get_embedding(text, client=None):
-        """Get embedding for a text using OpenAI API"""
+        """Get embedding for a query text, served from the embedding cache when possible"""
+        cache = get_embedding_cache()
+        embedding = cache.get(text, RAGService.EMBEDDING_MODEL)
+        if embedding is not None:
+            return embedding
+        
         if client is None:
             client = LLMService.get_client()
             if not client:
                 logger.error("Failed to initialize OpenAI client for embeddings")
                 return None
         
+        started = time.perf_counter()
+        try:
+            response = call_with_resilience(
+                "embeddings",
+                lambda timeout: client.embeddings.create(
+                    model=RAGService.EMBEDDING_MODEL,
+                    input=text,
+                    timeout=timeout
+                ),
+                float(ConfigManager.get("EMBEDDING_DEADLINE", "10")),
+                int(ConfigManager.get("OPENAI_MAX_RETRIES", "2"))
+            )
+            observe_openai_call("embeddings", RAGService.EMBEDDING_MODEL, time.perf_counter() - started)
+            record_embedding_usage(response.usage)
+            embedding = response.data[0].embedding
+            cache.put(text, RAGService.EMBEDDING_MODEL, embedding)
+            return embedding
+        except Exception as e:
+            observe_openai_call("embeddings", RAGService.EMBEDDING_MODEL, time.perf_counter() - started, error=True)
+            logger.error("Error getting embedding: %s", e)
+            return None
+    
+    @staticmethod
+    async def aget_embedding(text):
+        """Async counterpart of get_embedding using the AsyncOpenAI client
+        
+        The embedding cache has a SQLite tier, so it is read and written in a worker thread.
+        """
+        cache = get_embedding_cache()
+        embedding = await asyncio.to_thread(cache.get, text, RAGService.EMBEDDING_MODEL)
+        if embedding is not None:
+            return embedding
+        
+        client = LLMService.get_async_client()
+        if not client:
+            logger.error("Failed to initialize OpenAI client for embeddings")
+            return None
+        
+        started = time.perf_counter()
         try:
-            response = client.embeddings.create(
-                model="text-embedding-3-small",
-                input=text
+            response = await acall_with_resilience(
+                "embeddings",
+                lambda timeout: client.embeddings.create(
+                    model=RAGService.EMBEDDING_MODEL,
+                    input=text,
+                    timeout=timeout
+                ),
+                float(ConfigManager.get("EMBEDDING_DEADLINE", "10")),
+                int(ConfigManager.get("OPENAI_MAX_RETRIES", "2"))
             )
-            return response.data[0].embedding
+            observe_openai_call("embeddings", RAGService.EMBEDDING_MODEL, time.perf_counter() - started)
+            record_embedding_usage(response.usage)
+            embedding = response.data[0].embedding
+            await asyncio.to_thread(cache.put, text, RAGService.EMBEDDING_MODEL, embedding)
+            return embedding
         except Exception as e:
-            logger.error(f"Error getting embedding: {e}")
+            observe_openai_call("embeddings", RAGService.EMBEDDING_MODEL, time.perf_counter() - started, error=True)
+            logger.error("Error getting embedding: %s", e)
             return None
     
     @staticmethod
-    def initialize_index():
-        """Initialize or load the FAISS index"""
+    def batch_texts(texts, max_tokens, max_inputs=MAX_BATCH_INPUTS):
+        """Group text positions into batches that fit a per-request token budget"""
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for position, text in enumerate(texts):
+            tokens = estimate_tokens(text)
+            if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_inputs):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(position)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+    
+    @staticmethod
+    def _embed_batch(client, texts, max_retries):
+        """Embed one batch of texts, retrying with jittered exponential backoff on transient errors
+        
+        Batches use their own circuit breaker, so a rebuild that runs into rate limits
+        does not open the one guarding users' query embeddings.
+        """
+        started = time.perf_counter()
+        try:
+            response = call_with_resilience(
+                "embeddings-batch",
+                lambda timeout: client.embeddings.create(
+                    model=RAGService.EMBEDDING_MODEL,
+                    input=texts,
+                    timeout=timeout
+                ),
+                float(ConfigManager.get("EMBEDDING_BATCH_DEADLINE", "300")),
+                max_retries
+            )
+        except Exception:
+            observe_openai_call("embeddings", RAGService.EMBEDDING_MODEL, time.perf_counter() - started, error=True)
+            raise
+        observe_openai_call("embeddings", RAGService.EMBEDDING_MODEL, time.perf_counter() - started)
+        # Results carry their input position; don't rely on response order
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    
+    @staticmethod
+    def get_embeddings(texts, client=None, batch_tokens=None, concurrency=None, max_retries=None):
+        """Get embeddings for many texts using batched requests with bounded concurrency
+        
+        Returns a list aligned with texts; entries are None for batches that failed.
+        """
+        if client is None:
+            client = LLMService.get_client()
+            if not client:
+                logger.error("Failed to initialize OpenAI client for embeddings")
+                return [None] * len(texts)
+        
+        if batch_tokens is None:
+            batch_tokens = int(ConfigManager.get("EMBEDDING_BATCH_TOKENS", "50000"))
+        if concurrency is None:
+            concurrency = int(ConfigManager.get("EMBEDDING_CONCURRENCY", "4"))
+        if max_retries is None:
+            max_retries = int(ConfigManager.get("EMBEDDING_MAX_RETRIES", "5"))
+        
+        embeddings = [None] * len(texts)
+        batches = RAGService.batch_texts(texts, batch_tokens)
+        
+        def embed(batch):
+            try:
+                return batch, RAGService._embed_batch(client, [texts[pos] for pos in batch], max_retries)
+            except Exception as e:
+                logger.error("Error getting embeddings for batch of %s texts: %s", len(batch), e)
+                return batch, None
+        
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            for batch, results in executor.map(embed, batches):
+                if results:
+                    for pos, embedding in zip(batch, results):
+                        embeddings[pos] = embedding
+        
+        logger.info("Embedded %s texts in %s batches", len(texts), len(batches))
+        return embeddings
+    
+    @staticmethod
+    def new_index():
+        """Create an empty FAISS index whose vectors are keyed by DocumentChunk.id"""
+        return faiss.IndexIDMap(faiss.IndexFlatL2(RAGService.EMBEDDING_DIM))
+    
+    @staticmethod
+    def index_files(version):
+        """Get the (FAISS index, passages) file paths of an index version from disk_version()"""
+        if isinstance(version, str):
+            directory = os.path.join(RAGService.INDEX_DIR, version)
+            return (
+                os.path.join(directory, RAGService.INDEX_FILE),
+                os.path.join(directory, RAGService.EMBEDDINGS_FILE)
+            )
+        return RAGService.INDEX_PATH, RAGService.EMBEDDINGS_PATH
+    
+    @staticmethod
+    def initialize_index(version=None):
+        """Initialize or load the FAISS index (the current version unless one is given)"""
         # Create knowledge_base directory if it doesn't exist
-        os.makedirs("knowledge_base", exist_ok=True)
+        os.makedirs(RAGService.INDEX_DIR, exist_ok=True)
+        
+        if version is None:
+            version = RAGIndex.disk_version()
+        index_path, embeddings_path = RAGService.index_files(version)
         
         # Check if index already exists
-        if os.path.exists(RAGService.INDEX_PATH) and os.path.exists(RAGService.EMBEDDINGS_PATH):
+        if os.path.exists(index_path) and os.path.exists(embeddings_path):
             try:
                 # Load existing index
-                index = faiss.read_index(RAGService.INDEX_PATH)
-                with open(RAGService.EMBEDDINGS_PATH, 'rb') as f:
-                    doc_embeddings = pickle.load(f)
-                logger.info("Loaded existing FAISS index")
-                return index, doc_embeddings
+                index = faiss.read_index(index_path)
+                with open(embeddings_path, 'rb') as f:
+                    passages = pickle.load(f)
+                if RAGService._is_chunk_index(index, passages):
+                    logger.info("Loaded existing FAISS index")
+                    return index, passages
+                # Indexes from older versions hold one vector per whole document
+                logger.warning("FAISS index was built by an older version without document chunks; "
+                               "rebuild the index from the knowledge base page")
             except Exception as e:
-                logger.error(f"Error loading FAISS index: {e}")
+                logger.error("Error loading FAISS index: %s", e)
         
         # Create new index
         logger.info("Creating new FAISS index")
-        embedding_dim = 1536  # OpenAI's text-embedding-3-small dimension
-        index = faiss.IndexFlatL2(embedding_dim)
-        doc_embeddings = {}
+        return RAGService.new_index(), {}
+    
+    @staticmethod
+    def _is_chunk_index(index, passages):
+        """Check that a loaded index is keyed by DocumentChunk.id"""
+        if not isinstance(index, faiss.IndexIDMap):
+            return False
+        return all("document_id" in entry for entry in passages.values())
+    
+    @staticmethod
+    def save_index(index, passages):
+        """Atomically write the index files and publish the index to this process
+        
+        Both files go into a new versioned directory and the current-index link is
+        swapped in one rename, so a reader in another process always loads an index
+        and passages saved together. The previous version is kept for readers that
+        resolved the link just before the swap; older ones are removed.
+        """
+        os.makedirs(RAGService.INDEX_DIR, exist_ok=True)
+        previous = RAGIndex.disk_version()
         
-        return index, doc_embeddings
+        version = f"index-{time.time_ns()}-{os.getpid()}"
+        index_path, embeddings_path = RAGService.index_files(version)
+        os.makedirs(os.path.dirname(index_path))
+        faiss.write_index(index, index_path)
+        with open(embeddings_path, 'wb') as f:
+            pickle.dump(passages, f)
+        
+        link_tmp = f"{RAGService.CURRENT_INDEX_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.symlink(version, link_tmp)
+        os.replace(link_tmp, RAGService.CURRENT_INDEX_PATH)
+        
+        for name in os.listdir(RAGService.INDEX_DIR):
+            if name.startswith("index-") and name not in (version, previous):
+                shutil.rmtree(os.path.join(RAGService.INDEX_DIR, name), ignore_errors=True)
+        
+        RAGIndex.publish(index, passages)
+    
+    @staticmethod
+    def _passage_entry(doc, chunk):
+        """Get the metadata stored alongside a chunk's vector"""
+        return {
+            "id": chunk.id,
+            "document_id": doc.id,
+            "title": doc.title,
+            "content": chunk.content
+        }
+    
+    @staticmethod
+    def chunk_document(doc):
+        """Split a document into chunks, replacing any chunks it already has (caller commits)"""
+        max_tokens = int(ConfigManager.get("RAG_CHUNK_TOKENS", "300"))
+        overlap_tokens = int(ConfigManager.get("RAG_CHUNK_OVERLAP_TOKENS", "50"))
+        
+        DocumentChunk.query.filter_by(document_id=doc.id).delete()
+        chunks = [
+            DocumentChunk(
+                document_id=doc.id,
+                chunk_index=position,
+                content=text,
+                token_count=estimate_tokens(text)
+            )
+            for position, text in enumerate(iter_chunks(doc.content, max_tokens, overlap_tokens))
+        ]
+        db.session.add_all(chunks)
+        return chunks
     
     @staticmethod
     def update_index():
-        """Update the FAISS index with all documents in the database"""
+        """Rebuild the FAISS index from scratch, re-chunking all documents in the database"""
         client = LLMService.get_client()
         if not client:
             logger.error("Cannot update index: OpenAI client initialization failed")
             return False
             
         try:
-            # Initialize index
-            index, doc_embeddings = RAGService.initialize_index()
-            
-            # Get all active documents
-            documents = Document.query.filter_by(is_active=True).all()
-            
-            # Reset index
-            if index.ntotal > 0:
-                index.reset()
-                doc_embeddings = {}
-            
-            # Generate embeddings for all documents
-            for doc in documents:
-                embedding = RAGService.get_embedding(doc.content, client)
-                if embedding:
-                    # Convert to numpy array and reshape
-                    embedding_np = np.array(embedding).astype('float32').reshape(1, -1)
-                    
-                    # Add to index
-                    index.add(embedding_np)
-                    doc_embeddings[index.ntotal - 1] = {
-                        "id": doc.id,
-                        "title": doc.title,
-                        "content": doc.content[:1000]  # Store a preview of the content
-                    }
-            
-            # Save index to file
-            faiss.write_index(index, RAGService.INDEX_PATH)
-            with open(RAGService.EMBEDDINGS_PATH, 'wb') as f:
-                pickle.dump(doc_embeddings, f)
+            # Hold the write lock from re-chunking to the save, so documents added or deleted
+            # meanwhile are applied after the rebuild instead of being overwritten by it
+            with RAGIndex.write_lock():
+                # Build a new index alongside the one currently serving searches
+                index = RAGService.new_index()
+                passages = {}
+                
+                # Re-chunk all active documents so chunk settings changes take effect
+                documents = Document.query.filter_by(is_active=True).all()
+                DocumentChunk.query.filter(
+                    DocumentChunk.document_id.notin_([doc.id for doc in documents])
+                ).delete(synchronize_session=False)
+                chunked = [(doc, chunk) for doc in documents for chunk in RAGService.chunk_document(doc)]
+                db.session.commit()
+                
+                # Generate embeddings for all chunks in batches
+                embeddings = RAGService.get_embeddings([chunk.content for _, chunk in chunked], client)
+                embedded = [(doc, chunk, embedding) for (doc, chunk), embedding in zip(chunked, embeddings) if embedding]
+                
+                # Add all vectors in one call
+                if embedded:
+                    vectors = np.array([embedding for _, _, embedding in embedded], dtype='float32')
+                    ids = np.array([chunk.id for _, chunk, _ in embedded], dtype='int64')
+                    index.add_with_ids(vectors, ids)
+                    passages = {chunk.id: RAGService._passage_entry(doc, chunk) for doc, chunk, _ in embedded}
+                
+                # Save index to file and swap it in
+                RAGService.save_index(index, passages)
+                
+                logger.info("Updated FAISS index with %s of %s chunks from %s documents", len(embedded), len(chunked), len(documents))
+                return True
+        except Exception as e:
+            logger.error("Error updating FAISS index: %s", e)
+            db.session.rollback()
+            return False
+    
+    @staticmethod
+    def _modify_index(upserts=None, delete_ids=None):
+        """Apply incremental changes on a copy of the current index, then save and swap it in
+        
+        upserts maps DocumentChunk.id to (embedding, entry); delete_ids lists DocumentChunk.ids to remove.
+        The caller holds RAGIndex.write_lock().
+        """
+        upserts = upserts or {}
+        delete_ids = set(delete_ids or []) | set(upserts)
+        
+        # Start from the latest saved index, which another worker may have changed
+        current_index, current_passages, _ = RAGIndex.get()
+        index = faiss.clone_index(current_index)
+        passages = dict(current_passages)
+        
+        if delete_ids:
+            index.remove_ids(np.array(sorted(delete_ids), dtype='int64'))
+            for chunk_id in delete_ids:
+                passages.pop(chunk_id, None)
+        
+        if upserts:
+            ids = np.array(list(upserts), dtype='int64')
+            vectors = np.array([embedding for embedding, _ in upserts.values()], dtype='float32')
+            index.add_with_ids(vectors, ids)
+            for chunk_id, (_, entry) in upserts.items():
+                passages[chunk_id] = entry
+        
+        RAGService.save_index(index, passages)
+    
+    @staticmethod
+    def index_document(doc):
+        """Chunk and embed a single document, replacing its passages in the index"""
+        try:
+            # Hold the write lock from re-chunking to the save so a concurrent rebuild
+            # or change to the same document cannot interleave with this one
+            with RAGIndex.write_lock():
+                old_chunk_ids = [chunk.id for chunk in DocumentChunk.query.filter_by(document_id=doc.id)]
+                chunks = RAGService.chunk_document(doc)
+                db.session.commit()
+                
+                embeddings = RAGService.get_embeddings([chunk.content for chunk in chunks])
+                upserts = {
+                    chunk.id: (embedding, RAGService._passage_entry(doc, chunk))
+                    for chunk, embedding in zip(chunks, embeddings) if embedding
+                }
+                if len(upserts) < len(chunks):
+                    logger.error("Could not embed %s of %s chunks of document %s", len(chunks) - len(upserts), len(chunks), doc.id)
                 
-            logger.info(f"Updated FAISS index with {len(documents)} documents")
+                RAGService._modify_index(upserts=upserts, delete_ids=old_chunk_ids)
+            logger.info("Indexed document %s as %s chunks", doc.id, len(upserts))
+            return bool(upserts) or not chunks
+        except Exception as e:
+            logger.error("Error indexing document %s: %s", doc.id, e)
+            db.session.rollback()
+            return False
+    
+    @staticmethod
+    def remove_chunks_from_index(chunk_ids):
+        """Remove the vectors of the given chunks from the index"""
+        with RAGIndex.write_lock():
+            return RAGService._remove_chunks(chunk_ids)
+    
+    @staticmethod
+    def _remove_chunks(chunk_ids):
+        """remove_chunks_from_index for a caller that already holds RAGIndex.write_lock()"""
+        if not chunk_ids:
+            return True
+        try:
+            RAGService._modify_index(delete_ids=chunk_ids)
+            logger.info("Removed %s chunks from index", len(chunk_ids))
             return True
         except Exception as e:
-            logger.error(f"Error updating FAISS index: {e}")
+            logger.error("Error removing chunks from index: %s", e)
             return False
     
     @staticmethod
-    def search(query, top_k=3):
-        """Search the FAISS index for relevant documents"""
+    @traced("RAGService.search")
+    @RAG_SEARCH_SECONDS.time()
+    def search(query, top_k=None):
+        """Search the FAISS index for the passages most relevant to a query, best first"""
         if not is_rag_enabled():
-            logger.info("RAG is disabled, skipping search")
+            logger.debug("RAG is disabled, skipping search")
             return None
-            
-        client = LLMService.get_client()
-        if not client:
-            logger.error("Cannot search: OpenAI client initialization failed")
+        
+        # Get embedding for query (cached queries skip the API call)
+        query_embedding = RAGService.get_embedding(query)
+        if not query_embedding:
             return None
+        return RAGService.search_by_embedding(query_embedding, top_k)
+    
+    @staticmethod
+    def search_by_embedding(query_embedding, top_k=None):
+        """Search the FAISS index with an already computed query embedding"""
+        if top_k is None:
+            top_k = int(ConfigManager.get("RAG_TOP_K", "8"))
             
         try:
-            # Get embedding for query
-            query_embedding = RAGService.get_embedding(query, client)
-            if not query_embedding:
-                return None
-                
             query_np = np.array(query_embedding).astype('float32').reshape(1, -1)
             
-            # Load index
-            index, doc_embeddings = RAGService.initialize_index()
+            # Use the in-memory index (reloaded only when the files change)
+            index, passages, _ = RAGIndex.get()
             
             # If index is empty, no results
             if index.ntotal == 0:
@@ -140,29 +544,57 @@ class RAGService:
             
             # Get results
             results = []
-            for idx in indices[0]:
-                if idx in doc_embeddings:
-                    results.append(doc_embeddings[idx])
+            for chunk_id in indices[0]:
+                if int(chunk_id) in passages:
+                    results.append(passages[int(chunk_id)])
             
             return results
         except Exception as e:
-            logger.error(f"Error searching FAISS index: {e}")
+            logger.error("Error searching FAISS index: %s", e)
             return None
     
     @staticmethod
-    def get_context_for_query(query):
-        """Get context from knowledge base for a query"""
+    def get_context_for_query(query, max_tokens=None):
+        """Get the best-matching knowledge base passages for a query within a token budget"""
         if not is_rag_enabled():
             return None
             
-        results = RAGService.search(query)
+        return RAGService.format_context(RAGService.search(query), max_tokens)
+    
+    @staticmethod
+    async def aget_context_for_query(query, max_tokens=None):
+        """Async counterpart of get_context_for_query; the FAISS search runs in a worker thread"""
+        if not is_rag_enabled():
+            return None
+        
+        with span("RAGService.search"), RAG_SEARCH_SECONDS.time():
+            query_embedding = await RAGService.aget_embedding(query)
+            if not query_embedding:
+                return None
+            results = await asyncio.to_thread(RAGService.search_by_embedding, query_embedding)
+        return RAGService.format_context(results, max_tokens)
+    
+    @staticmethod
+    def format_context(results, max_tokens=None):
+        """Combine search results into a context string, best matches first, within a token budget"""
         if not results:
             return None
+        
+        if max_tokens is None:
+            max_tokens = int(ConfigManager.get("RAG_CONTEXT_TOKENS", "1500"))
             
-        # Combine results into a context string
+        # Combine results into a context string, best matches first, until the budget is spent
         context = "Knowledge base information:\n\n"
-        for i, result in enumerate(results):
-            context += f"{i+1}. {result['title']}:\n{result['content']}\n\n"
+        used_tokens = 0
+        included = 0
+        for result in results:
+            passage = f"{included + 1}. {result['title']}:\n{result['content']}\n\n"
+            passage_tokens = estimate_tokens(passage)
+            if included and used_tokens + passage_tokens > max_tokens:
+                break
+            context += passage
+            used_tokens += passage_tokens
+            included += 1
             
         return context
     
@@ -180,12 +612,12 @@ class RAGService:
             db.session.add(doc)
             db.session.commit()
             
-            # Update index
-            RAGService.update_index()
+            # Chunk and embed only the new document
+            RAGService.index_document(doc)
             
             return True, doc.id
         except Exception as e:
-            logger.error(f"Error adding document: {e}")
+            logger.error("Error adding document: %s", e)
             db.session.rollback()
             return False, str(e)
     
@@ -197,14 +629,19 @@ class RAGService:
             if not doc:
                 return False, "Document not found"
                 
-            db.session.delete(doc)
-            db.session.commit()
-            
-            # Update index
-            RAGService.update_index()
+            # Under the write lock, a rebuild in progress finishes first and its
+            # chunks of this document are the ones removed
+            with RAGIndex.write_lock():
+                chunk_ids = [chunk.id for chunk in DocumentChunk.query.filter_by(document_id=doc_id)]
+                DocumentChunk.query.filter_by(document_id=doc_id).delete()
+                db.session.delete(doc)
+                db.session.commit()
+                
+                # Remove only this document's passages
+                RAGService._remove_chunks(chunk_ids)
             
             return True, "Document deleted successfully"
         except Exception as e:
-            logger.error(f"Error deleting document: {e}")
+            logger.error("Error deleting document: %s", e)
             db.session.rollback()
             return False, str(e)
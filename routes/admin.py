@@ -1,5 +1,6 @@
 import os
 import logging
+import threading
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
@@ -8,11 +9,23 @@ from app import db
 from forms import LLMSettingsForm, BotStyleForm, BotSettingsForm, DocumentForm, UserForm
 from routes.utils.config_service import ConfigManager
 from services.llm_service import LLMService
+from services.job_queue import get_webhook_queue, get_maintenance_queue
+from services.embedding_cache import get_embedding_cache
+from services.response_cache import get_response_cache_stats
+from services.resilience import get_resilience_stats
+from services.model_router import ModelRouter, REQUEST_CLASSES, DEFAULT_MODEL
+from services.message_history import MessageHistoryService
+from services.stats_service import StatsService
+from services.tracing import Tracer, to_otlp_json
 from rag_service import RAGService
 
 admin_bp = Blueprint('admin', __name__)
 logger = logging.getLogger(__name__)
 
+# Set while a full index rebuild waits in this worker's maintenance queue, so repeated clicks queue one rebuild
+_rebuild_pending = threading.Event()
+_rebuild_lock = threading.Lock()
+
 # Admin access decorator
 def admin_required(f):
     """Decorator to require admin access for a route"""
@@ -37,10 +50,8 @@ def date_test():
 @admin_required
 def dashboard():
     """Admin dashboard displaying system overview"""
-    # Get stats
-    user_count = LineUser.query.count()
-    message_count = ChatMessage.query.count()
-    document_count = Document.query.count()
+    # Get stats from the hourly rollups rather than counting the message table
+    totals = StatsService.get_totals()
     
     # Get recent messages
     recent_messages = ChatMessage.query.order_by(ChatMessage.timestamp.desc()).limit(10).all()
@@ -58,15 +69,34 @@ def dashboard():
     
     return render_template(
         'dashboard.html',
-        user_count=user_count,
-        message_count=message_count,
-        document_count=document_count,
+        user_count=totals['user_count'],
+        message_count=totals['message_count'],
+        document_count=totals['document_count'],
+        total_messages=totals['message_count'],
+        user_messages=totals['user_messages'],
+        bot_messages=totals['bot_messages'],
         recent_messages=recent_messages,
         active_style=active_style,
         api_status=api_status,
         rag_enabled=rag_enabled
     )
 
+@admin_bp.route('/dashboard/stats')
+@admin_required
+def dashboard_stats():
+    """Get dashboard counters and hourly message activity as JSON"""
+    days = min(max(request.args.get('days', 7, type=int), 1), 90)
+    return jsonify({
+        'totals': StatsService.get_totals(),
+        'hourly': StatsService.get_activity(days)
+    })
+
+@admin_bp.route('/webhook/stats')
+@admin_required
+def webhook_stats():
+    """Get webhook queue depth, worker utilisation and latency as JSON"""
+    return jsonify(get_webhook_queue().stats())
+
 # LLM Settings
 @admin_bp.route('/llm_settings', methods=['GET', 'POST'])
 @admin_required
@@ -79,6 +109,18 @@ def llm_settings():
         form.api_key.data = ConfigManager.get("OPENAI_API_KEY", "")
         form.temperature.data = float(ConfigManager.get("OPENAI_TEMPERATURE", "0.7"))
         form.max_tokens.data = int(ConfigManager.get("OPENAI_MAX_TOKENS", "500"))
+        form.default_model.data = ModelRouter.default_model()
+        for request_class in REQUEST_CLASSES:
+            getattr(form, f"route_{request_class}_model").data = ConfigManager.get(f"ROUTE_{request_class.upper()}_MODEL", "")
+            max_tokens = ConfigManager.get(f"ROUTE_{request_class.upper()}_MAX_TOKENS", "")
+            getattr(form, f"route_{request_class}_max_tokens").data = int(max_tokens) if max_tokens else None
+        form.route_long_chars.data = int(ConfigManager.get("ROUTE_LONG_MESSAGE_CHARS", "200"))
+        form.fallback_model.data = ConfigManager.get("OPENAI_FALLBACK_MODEL", "")
+        form.streaming_enabled.data = ConfigManager.get("LLM_STREAMING_ENABLED", "False") == "True"
+        form.response_cache_enabled.data = ConfigManager.get("RESPONSE_CACHE_ENABLED", "False") == "True"
+        form.response_cache_ttl.data = int(ConfigManager.get("RESPONSE_CACHE_TTL", "3600"))
+        form.response_cache_size.data = int(ConfigManager.get("RESPONSE_CACHE_SIZE", "1000"))
+        form.response_cache_threshold.data = float(ConfigManager.get("RESPONSE_CACHE_THRESHOLD", "0.95"))
     
     # Process form submission
     if form.validate_on_submit():
@@ -90,13 +132,50 @@ def llm_settings():
             ConfigManager.set("OPENAI_API_KEY", form.api_key.data)
             ConfigManager.set("OPENAI_TEMPERATURE", str(form.temperature.data))
             ConfigManager.set("OPENAI_MAX_TOKENS", str(form.max_tokens.data))
+            ConfigManager.set("OPENAI_MODEL", (form.default_model.data or "").strip() or DEFAULT_MODEL)
+            for request_class in REQUEST_CLASSES:
+                route_model = getattr(form, f"route_{request_class}_model").data
+                route_max_tokens = getattr(form, f"route_{request_class}_max_tokens").data
+                ConfigManager.set(f"ROUTE_{request_class.upper()}_MODEL", (route_model or "").strip())
+                ConfigManager.set(f"ROUTE_{request_class.upper()}_MAX_TOKENS", str(route_max_tokens) if route_max_tokens else "")
+            ConfigManager.set("ROUTE_LONG_MESSAGE_CHARS", str(form.route_long_chars.data or 200))
+            ConfigManager.set("OPENAI_FALLBACK_MODEL", (form.fallback_model.data or "").strip())
+            ConfigManager.set("LLM_STREAMING_ENABLED", str(form.streaming_enabled.data))
+            ConfigManager.set("RESPONSE_CACHE_ENABLED", str(form.response_cache_enabled.data))
+            ConfigManager.set("RESPONSE_CACHE_TTL", str(form.response_cache_ttl.data or 3600))
+            ConfigManager.set("RESPONSE_CACHE_SIZE", str(form.response_cache_size.data or 1000))
+            ConfigManager.set("RESPONSE_CACHE_THRESHOLD", str(form.response_cache_threshold.data or 0.95))
             
             flash('LLM settings updated successfully.', 'success')
             return redirect(url_for('admin.llm_settings'))
         else:
             flash(f'API key validation failed: {message}', 'danger')
     
-    return render_template('llm_settings.html', form=form)
+    return render_template(
+        'llm_settings.html',
+        form=form,
+        response_cache_stats=get_response_cache_stats(),
+        resilience_stats=get_resilience_stats(),
+        model_stats=ModelRouter.get_stats()
+    )
+
+@admin_bp.route('/llm_settings/response_cache/stats')
+@admin_required
+def response_cache_stats():
+    """Get semantic response cache hit-rate metrics as JSON"""
+    return jsonify(get_response_cache_stats())
+
+@admin_bp.route('/llm_settings/resilience/stats')
+@admin_required
+def resilience_stats():
+    """Get OpenAI circuit breaker states and retry counters as JSON"""
+    return jsonify(get_resilience_stats())
+
+@admin_bp.route('/llm_settings/model_stats')
+@admin_required
+def model_stats():
+    """Get per-model latency and token usage as JSON"""
+    return jsonify(ModelRouter.get_stats())
 
 # Bot Settings
 @admin_bp.route('/bot_settings', methods=['GET', 'POST'])
@@ -165,7 +244,10 @@ def add_bot_style():
             name=form.name.data,
             prompt=form.prompt.data,
             description=form.description.data,
-            is_default=form.is_default.data
+            is_default=form.is_default.data,
+            model=(form.model.data or "").strip() or None,
+            temperature=form.temperature.data,
+            max_tokens=form.max_tokens.data
         )
         
         # If this is set as default, update other styles
@@ -199,6 +281,9 @@ def edit_bot_style(style_id):
         form.prompt.data = style.prompt
         form.description.data = style.description
         form.is_default.data = style.is_default
+        form.model.data = style.model
+        form.temperature.data = style.temperature
+        form.max_tokens.data = style.max_tokens
         return render_template('edit_bot_style.html', style=style, form=form)
     
     if form.validate_on_submit():
@@ -213,6 +298,9 @@ def edit_bot_style(style_id):
         style.name = form.name.data
         style.prompt = form.prompt.data
         style.description = form.description.data
+        style.model = (form.model.data or "").strip() or None
+        style.temperature = form.temperature.data
+        style.max_tokens = form.max_tokens.data
         
         # Handle default status
         if form.is_default.data and not style.is_default:
@@ -276,7 +364,10 @@ def get_bot_style(style_id):
         'name': style.name,
         'prompt': style.prompt,
         'description': style.description,
-        'is_default': style.is_default
+        'is_default': style.is_default,
+        'model': style.model,
+        'temperature': style.temperature,
+        'max_tokens': style.max_tokens
     })
 
 # Message History
@@ -285,22 +376,89 @@ def get_bot_style(style_id):
 def message_history():
     """Message history page"""
     # Get filter parameters
-    user_id = request.args.get('user_id')
-    page = request.args.get('page', 1, type=int)
+    user_id = request.args.get('user_id') or None
+    before = request.args.get('before')
+    after = request.args.get('after')
     per_page = 50
     
-    # Build query
-    query = ChatMessage.query
-    if user_id:
-        query = query.filter_by(line_user_id=user_id)
-    
-    # Get paginated messages
-    messages = query.order_by(ChatMessage.timestamp.desc()).paginate(page=page, per_page=per_page)
+    # Get one page of messages by (timestamp, id) cursor instead of OFFSET
+    messages, newer_cursor, older_cursor = MessageHistoryService.get_page(
+        line_user_id=user_id, before=before, after=after, per_page=per_page
+    )
+    total = MessageHistoryService.count_messages(user_id)
     
-    # Get all LINE users for filter dropdown
-    users = LineUser.query.all()
+    # Show the selected user in the filter; others are found via the search endpoint
+    current_user_label = None
+    if user_id:
+        line_user = LineUser.query.filter_by(line_user_id=user_id).first()
+        current_user_label = line_user.display_name if line_user and line_user.display_name else user_id
     
-    return render_template('message_history.html', messages=messages, users=users, current_user_id=user_id)
+    return render_template(
+        'message_history.html',
+        messages=messages,
+        newer_cursor=newer_cursor,
+        older_cursor=older_cursor,
+        total=total,
+        current_user_id=user_id,
+        current_user_label=current_user_label
+    )
+
+@admin_bp.route('/message_history/users')
+@admin_required
+def search_line_users():
+    """Search LINE users by ID prefix or display name for the history filter"""
+    users = MessageHistoryService.search_users(request.args.get('q', ''))
+    return jsonify([
+        {'line_user_id': user.line_user_id, 'display_name': user.display_name}
+        for user in users
+    ])
+
+# Token Usage
+@admin_bp.route('/usage')
+@admin_required
+def token_usage():
+    """Token usage and prompt size page"""
+    days = min(max(request.args.get('days', 14, type=int), 1), 90)
+    return render_template('usage.html', usage=StatsService.get_token_usage(days))
+
+@admin_bp.route('/usage/stats')
+@admin_required
+def token_usage_stats():
+    """Get token usage per day and per model as JSON"""
+    days = min(max(request.args.get('days', 14, type=int), 1), 90)
+    return jsonify(StatsService.get_token_usage(days))
+
+# Tracing
+@admin_bp.route('/tracing')
+@admin_required
+def tracing():
+    """Per-stage latency and recent traces page"""
+    return render_template('tracing.html', stats=Tracer.get_stats(), traces=Tracer.get_recent_traces(20))
+
+@admin_bp.route('/tracing/stats')
+@admin_required
+def tracing_stats():
+    """Get per-stage latency percentiles and recent traces as JSON"""
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 200)
+    return jsonify({**Tracer.get_stats(), 'traces': Tracer.get_recent_traces(limit)})
+
+@admin_bp.route('/tracing/export')
+@admin_required
+def tracing_export():
+    """Export the buffered spans as OpenTelemetry (OTLP/JSON) trace data"""
+    spans = Tracer.spans()
+    trace_id = request.args.get('trace_id')
+    if trace_id:
+        spans = [span for span in spans if span.trace_id == trace_id]
+    return jsonify(to_otlp_json(spans))
+
+@admin_bp.route('/tracing/clear', methods=['POST'])
+@admin_required
+def clear_tracing():
+    """Drop the buffered spans and stage latencies"""
+    Tracer.clear()
+    flash('Tracing data cleared.', 'success')
+    return redirect(url_for('admin.tracing'))
 
 # Knowledge Base
 @admin_bp.route('/knowledge_base')
@@ -381,16 +539,36 @@ def view_document(doc_id):
 @admin_bp.route('/knowledge_base/rebuild_index', methods=['POST'])
 @admin_required
 def rebuild_index():
-    """Rebuild the FAISS index"""
-    success = RAGService.update_index()
+    """Rebuild the FAISS index in the background"""
+    # A full rebuild re-embeds every document, so don't hold the request open for it
+    with _rebuild_lock:
+        if _rebuild_pending.is_set():
+            flash('An index rebuild is already queued. Searches use the current index until it completes.', 'info')
+            return redirect(url_for('admin.knowledge_base'))
+        
+        _rebuild_pending.set()
+        queued = get_maintenance_queue().submit(_rebuild_index_job)
+        if not queued:
+            _rebuild_pending.clear()
     
-    if success:
-        flash('Knowledge base index rebuilt successfully.', 'success')
+    if queued:
+        flash('Knowledge base index rebuild started. Searches use the current index until it completes.', 'success')
     else:
-        flash('Error rebuilding knowledge base index.', 'danger')
+        flash('The maintenance queue is full. Please try again later.', 'danger')
     
     return redirect(url_for('admin.knowledge_base'))
 
+def _rebuild_index_job():
+    """Run a queued index rebuild; from here on, another rebuild can be queued"""
+    _rebuild_pending.clear()
+    return RAGService.update_index()
+
+@admin_bp.route('/knowledge_base/embedding_cache/stats')
+@admin_required
+def embedding_cache_stats():
+    """Get query embedding cache hit/miss counters as JSON"""
+    return jsonify(get_embedding_cache().stats())
+
 # User Management
 @admin_bp.route('/user_management')
 @admin_required
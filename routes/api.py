@@ -1,9 +1,11 @@
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
 from services.llm_service import LLMService
 from routes.utils.config_service import is_rag_enabled
 from rag_service import RAGService
+import json
 import logging
 import datetime
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -44,7 +46,7 @@ def test_date_response():
         })
     
     except Exception as e:
-        logger.error(f"Error in date test API: {str(e)}", exc_info=True)
+        logger.error("Error in date test API: %s", e, exc_info=True)
         return jsonify({'error': f'處理請求時發生錯誤: {str(e)}'}), 500
 
 @api_bp.route('/chat', methods=['POST'])
@@ -69,5 +71,51 @@ def chat():
         return jsonify({'response': response})
     
     except Exception as e:
-        logger.error(f"Error in chat API: {str(e)}", exc_info=True)
-        return jsonify({'error': f'處理請求時發生錯誤: {str(e)}'}), 500
\ No newline at end of file
+        logger.error("Error in chat API: %s", e, exc_info=True)
+        return jsonify({'error': f'處理請求時發生錯誤: {str(e)}'}), 500
+
+def _sse(event, data):
+    """Format a server-sent event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@api_bp.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """API endpoint for testing chat with a streamed (server-sent events) response
+    
+    Emits "delta" events as text arrives and a final "done" event with the
+    time to first token and the total generation time in milliseconds.
+    """
+    data = request.json or {}
+    message = data.get('message', '')
+    
+    if not message:
+        return jsonify({'error': '訊息內容不能為空'}), 400
+    
+    @stream_with_context
+    def generate():
+        started = time.perf_counter()
+        first_token_ms = None
+        try:
+            # Get context from knowledge base if RAG is enabled
+            rag_context = None
+            if is_rag_enabled():
+                logger.debug("RAG enabled, retrieving context")
+                rag_context = RAGService.get_context_for_query(message)
+            
+            for delta in LLMService.stream_response(message, rag_context=rag_context):
+                if first_token_ms is None:
+                    first_token_ms = round((time.perf_counter() - started) * 1000, 1)
+                yield _sse('delta', {'text': delta})
+        except Exception as e:
+            logger.error("Error in chat stream API: %s", e, exc_info=True)
+            yield _sse('error', {'error': f'處理請求時發生錯誤: {str(e)}'})
+        
+        yield _sse('done', {
+            'first_token_ms': first_token_ms,
+            'total_ms': round((time.perf_counter() - started) * 1000, 1)
+        })
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
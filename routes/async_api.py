@@ -0,0 +1,38 @@
+import json
+import logging
+
+from routes.utils.asgi import read_body, send_json
+from routes.utils.config_service import is_rag_enabled
+from services.async_db import async_session
+from services.llm_service import LLMService
+from rag_service import RAGService
+
+logger = logging.getLogger(__name__)
+
+async def chat(scope, receive, send):
+    """Async counterpart of the /api/chat endpoint"""
+    try:
+        data = json.loads(await read_body(receive) or b"{}")
+    except ValueError:
+        data = {}
+    message = data.get('message', '') if isinstance(data, dict) else ''
+
+    if not message:
+        await send_json(send, {'error': '訊息內容不能為空'}, 400)
+        return
+
+    try:
+        # Get context from knowledge base if RAG is enabled
+        rag_context = None
+        if is_rag_enabled():
+            rag_context = await RAGService.aget_context_for_query(message)
+
+        async with async_session() as session:
+            style = await LLMService.aget_bot_style(session)
+        response = await LLMService.agenerate_response(message, style, rag_context)
+
+        await send_json(send, {'response': response})
+
+    except Exception as e:
+        logger.error("Error in async chat API: %s", e, exc_info=True)
+        await send_json(send, {'error': f'處理請求時發生錯誤: {str(e)}'}, 500)
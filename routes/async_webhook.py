@@ -0,0 +1,346 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import MessageEvent, TextMessage
+from linebot.v3.messaging import (
+    AsyncApiClient, AsyncMessagingApi, Configuration, PushMessageRequest, ReplyMessageRequest,
+    TextMessage as TextSendMessage,
+)
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from app import app
+from models import LineUser
+from routes.utils.asgi import get_header, read_body, send_response
+from routes.utils.config_service import ConfigManager
+from routes.webhook import (
+    LINE_MESSAGES_PER_CALL, LINE_TEXT_LIMIT, PendingTurn, coalesce_events, first_turns_of_new_users,
+    get_line_access_token, get_line_webhook_parser, group_events_by_user, prepare_turn_users,
+    replace_concurrent_users, turns_by_user,
+)
+from services.async_db import async_session
+from services.conversation_memory import ConversationMemory
+from services.llm_service import LLMService
+from services.logging_setup import correlation, redact
+from services.stats_service import StatsService
+from services.tracing import span, traced
+from services.usage import current_usage, recording_usage
+from services.user_queue import UserMessageQueue
+from rag_service import RAGService
+
+logger = logging.getLogger(__name__)
+
+# Deliveries being handled on the event loop; strong references keep the tasks alive
+_tasks = set()
+
+# Number of message events in those deliveries
+_in_flight_events = 0
+
+# Serialises each user's messages across deliveries and coalesces bursts
+_user_queue = UserMessageQueue()
+
+# (access token, AsyncApiClient, AsyncMessagingApi) for the current channel
+_line_client = None
+
+def get_async_line_api():
+    """Get the async LINE Messaging API client for the current config, rebuilding it if the token changed"""
+    global _line_client
+    token = get_line_access_token()
+    if _line_client is not None and _line_client[0] == token:
+        return _line_client[2]
+
+    previous = _line_client
+    api_client = AsyncApiClient(Configuration(access_token=token))
+    _line_client = (token, api_client, AsyncMessagingApi(api_client))
+    if previous is not None:
+        logger.info("LINE channel configuration changed, rebuilding AsyncMessagingApi")
+        asyncio.get_running_loop().create_task(previous[1].close())
+    return _line_client[2]
+
+async def close_line_client():
+    """Close the async LINE client's HTTP session"""
+    global _line_client
+    if _line_client is not None:
+        await _line_client[1].close()
+    _line_client = None
+
+async def fetch_new_line_user(user_id):
+    """Build (but don't save) a LineUser for a first-time user, with their LINE profile if available"""
+    logger.info("Creating new LINE user with ID: %s", user_id)
+    try:
+        profile = await get_async_line_api().get_profile(user_id)
+        return LineUser(
+            line_user_id=user_id,
+            display_name=profile.display_name,
+            picture_url=profile.picture_url,
+            status_message=profile.status_message
+        )
+    except Exception as e:
+        logger.error("Error getting user profile: %s", e)
+        return LineUser(line_user_id=user_id)
+
+async def save_turns(session, turns):
+    """Persist conversation turns (PendingTurns) in a single transaction (see routes.webhook.save_turns)"""
+    dialect = session.bind.dialect.name
+    user_ids = list({turn.line_user.line_user_id for turn in turns})
+    for attempt in range(2):
+        try:
+            line_users = prepare_turn_users(turns)
+            new_user_ids = {line_user.line_user_id for line_user in line_users if line_user.id is None}
+            session.add_all(line_users)
+            if new_user_ids:
+                # Insert new users before the messages that reference them
+                await session.flush()
+            session.add_all([message for turn in turns for message in turn.to_chat_messages()])
+            for hour, (turn_count, new_users) in StatsService.hourly_counts(
+                    first_turns_of_new_users(turns, new_user_ids)):
+                await session.execute(StatsService.upsert_statement(
+                    dialect, hour, user_messages=turn_count, bot_messages=turn_count, new_users=new_users
+                ))
+            await session.commit()
+            break
+        except IntegrityError:
+            # Another worker created some of these LINE users first; attach the turns to those rows instead
+            await session.rollback()
+            stored_users = {
+                line_user.line_user_id: line_user
+                for line_user in (await session.execute(
+                    select(LineUser).where(LineUser.line_user_id.in_(user_ids))
+                )).scalars()
+            }
+            created = new_user_ids & set(stored_users)
+            if attempt or not created:
+                raise
+            logger.info("LINE users %s were created concurrently, retrying with existing records",
+                        ", ".join(sorted(created)))
+            replace_concurrent_users(turns, stored_users)
+
+    for user_turns in turns_by_user(turns):
+        await ConversationMemory.arecord_turns(
+            user_turns[-1].line_user, [(turn.user_message, turn.response_text) for turn in user_turns], session
+        )
+
+@traced("send_text")
+async def send_text(event, text):
+    """Send text through the reply token, pushing whatever exceeds one reply call"""
+    line_api = get_async_line_api()
+    messages = [TextSendMessage(text=text[i:i + LINE_TEXT_LIMIT]) for i in range(0, len(text), LINE_TEXT_LIMIT)]
+    if not messages:
+        return
+    await line_api.reply_message(
+        ReplyMessageRequest(reply_token=event.reply_token, messages=messages[:LINE_MESSAGES_PER_CALL])
+    )
+    for start in range(LINE_MESSAGES_PER_CALL, len(messages), LINE_MESSAGES_PER_CALL):
+        await line_api.push_message(
+            PushMessageRequest(to=event.source.user_id, messages=messages[start:start + LINE_MESSAGES_PER_CALL])
+        )
+
+async def handle_text_message(session, event, line_user, pending_turns=()):
+    """Handle a text message on the event loop (async counterpart of routes.webhook.handle_text_message)
+
+    Replies are always generated in full; LLM_STREAMING_ENABLED applies to the
+    synchronous path only.
+    """
+    try:
+        user_id = event.source.user_id
+        user_message = event.message.text
+        received_at = datetime.utcnow()
+
+        logger.info("Received message from user %s: %s", user_id, redact(user_message))
+
+        # Check for style command
+        if user_message.startswith('/style '):
+            style_name = user_message[7:].strip()
+            logger.info("Setting user %s style to: %s", user_id, style_name)
+
+            response_text = f"風格設定為: {style_name}"
+            try:
+                await send_text(event, response_text)
+            except Exception as e:
+                logger.error("Error sending LINE response: %s", e, exc_info=True)
+            return PendingTurn(line_user, user_message, received_at, response_text, style_name,
+                               style_update=style_name)
+
+        # Get RAG context if enabled
+        rag_context = None
+        try:
+            if ConfigManager.get("RAG_ENABLED", "False").lower() == "true":
+                rag_context = await RAGService.aget_context_for_query(user_message)
+        except Exception as e:
+            logger.error("Error retrieving RAG context: %s", e)
+
+        # Use the user's preferred style if set, including one set earlier in this delivery
+        style_updates = [turn.style_update for turn in pending_turns if turn.style_update is not None]
+        bot_style = (style_updates[-1] if style_updates else line_user.active_style) \
+            or ConfigManager.get("ACTIVE_BOT_STYLE", "預設")
+        style = await LLMService.aget_bot_style(session, bot_style)
+
+        # Get the earlier turns of this conversation
+        history = []
+        try:
+            with span("ConversationMemory.get_history"):
+                history = await ConversationMemory.aget_history(
+                    line_user, session, pending=[(turn.user_message, turn.response_text) for turn in pending_turns]
+                )
+        except Exception as e:
+            logger.error("Error retrieving conversation history: %s", e)
+
+        # Return the DB connection to the pool while waiting on the LLM
+        await session.close()
+
+        try:
+            response_text = await LLMService.agenerate_response(user_message, style, rag_context, history=history)
+        except Exception as e:
+            logger.error("Error generating LLM response: %s", e, exc_info=True)
+            response_text = LLMService.ERROR_REPLY
+
+        # Send response; the turn is saved with the rest of the delivery
+        try:
+            await send_text(event, response_text)
+        except Exception as e:
+            logger.error("Error sending LINE response: %s", e, exc_info=True)
+
+        return PendingTurn(line_user, user_message, received_at, response_text, bot_style, usage=current_usage())
+
+    except Exception as e:
+        logger.error("Unhandled exception in async handle_text_message: %s", e, exc_info=True)
+        return None
+
+async def next_user_batch(user_id):
+    """Wait until the user's queued messages are ready and take them (empty when none are queued)"""
+    while True:
+        events, wait = _user_queue.take(user_id)
+        if not wait:
+            return events
+        await asyncio.sleep(wait)
+
+async def handle_user_events(session, user_id, line_user):
+    """Handle a user's queued events in order until none are left, returning the turns to save"""
+    turns = []
+    while True:
+        events = await next_user_batch(user_id)
+        if not events:
+            return turns
+        for event in coalesce_events(events):
+            # Collect the token usage of this event for its ChatMessage; its logs carry the LINE event ID
+            with correlation(getattr(event, "webhook_event_id", None)), recording_usage(), \
+                    span("handle_text_message"):
+                turn = await handle_text_message(session, event, line_user, turns)
+            if turn is not None:
+                turns.append(turn)
+
+def discard_user_queue(user_id):
+    """Give up a user this task owns after a failure, logging the events that will not be answered"""
+    dropped = _user_queue.discard(user_id)
+    if dropped:
+        logger.error("Dropped %d queued events of user %s", len(dropped), user_id)
+
+async def serve_user(user_id, line_user):
+    """Handle a user's queued events until none are left, then release the user (see routes.webhook.serve_user)"""
+    released = False
+    try:
+        if line_user is None:
+            line_user = await fetch_new_line_user(user_id)
+        async with async_session() as session:
+            while not released:
+                turns = await handle_user_events(session, user_id, line_user)
+                if turns:
+                    try:
+                        with span("save_turns"):
+                            await save_turns(session, turns)
+                        # save_turns may have swapped in a concurrently created user
+                        line_user = turns[-1].line_user
+                    except Exception as e:
+                        logger.error("Error saving %d conversation turns of user %s: %s", len(turns), user_id, e,
+                                     exc_info=True)
+                        await session.rollback()
+                released = _user_queue.release(user_id)
+    finally:
+        if not released:
+            discard_user_queue(user_id)
+
+async def process_delivery(events):
+    """Task: handle the text message events of one webhook delivery (see routes.webhook.process_delivery)
+
+    The users this task owns are served concurrently on the event loop, each
+    saved and released as soon as their own events are done.
+    """
+    by_user = group_events_by_user(events)
+    with app.app_context(), span("handle_delivery", events=len(events), users=len(by_user)):
+        user_ids = [user_id for user_id, user_events in by_user.items() if _user_queue.push(user_id, user_events)]
+        if not user_ids:
+            return
+
+        try:
+            async with async_session() as session:
+                line_users = {
+                    line_user.line_user_id: line_user
+                    for line_user in (await session.execute(
+                        select(LineUser).where(LineUser.line_user_id.in_(user_ids))
+                    )).scalars()
+                }
+        except Exception:
+            for user_id in user_ids:
+                discard_user_queue(user_id)
+            raise
+
+        # The users are detached from the closed session; save_turns reattaches them
+        await asyncio.gather(*[serve_user(user_id, line_users.get(user_id)) for user_id in user_ids])
+
+@traced("line_webhook")
+async def line_webhook(scope, receive, send):
+    """Handle LINE webhook events on the event loop
+
+    Only the signature is checked before answering; the delivery's text message
+    events are handled in one task, up to ASYNC_MAX_IN_FLIGHT events at a time.
+    """
+    body = (await read_body(receive)).decode("utf-8")
+    signature = get_header(scope, "X-Line-Signature")
+    if signature is None:
+        await send_response(send, 400, "Missing signature")
+        return
+
+    try:
+        events = get_line_webhook_parser().parse(body, signature)
+    except InvalidSignatureError:
+        logger.error("Invalid signature. Check your channel secret.")
+        await send_response(send, 400, "Invalid signature")
+        return
+
+    text_events = [
+        event for event in events
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage)
+    ]
+
+    if text_events:
+        # Refuse the whole delivery while saturated so LINE can redeliver it later
+        max_in_flight = int(ConfigManager.get("ASYNC_MAX_IN_FLIGHT", "500"))
+        if _in_flight_events + len(text_events) > max_in_flight:
+            logger.error("%d events in flight, rejecting delivery of %d events",
+                         _in_flight_events, len(text_events))
+            await send_response(send, 503, "Busy")
+            return
+        _track(asyncio.create_task(process_delivery(text_events)), len(text_events))
+
+    await send_response(send, 200, "OK")
+
+def _track(task, event_count):
+    """Keep a delivery task alive and count its events as in flight until it finishes"""
+    global _in_flight_events
+    _in_flight_events += event_count
+    _tasks.add(task)
+
+    def finished(done_task):
+        global _in_flight_events
+        _in_flight_events -= event_count
+        _tasks.discard(done_task)
+
+    task.add_done_callback(finished)
+
+async def drain_tasks(timeout):
+    """Wait (up to timeout seconds) for the events still being handled"""
+    if _tasks:
+        logger.info("Waiting for %d in-flight events", _in_flight_events)
+        await asyncio.wait(list(_tasks), timeout=timeout)
@@ -25,13 +25,13 @@ def login():
             next_page = request.args.get('next')
             
             # Log successful login
-            logger.info(f"User {user.username} logged in successfully")
+            logger.info("User %s logged in successfully", user.username)
             
             flash(f'Welcome, {user.username}!', 'success')
             return redirect(next_page or url_for('admin.dashboard'))
         else:
             # Log failed login attempt
-            logger.warning(f"Failed login attempt for username: {form.username.data}")
+            logger.warning("Failed login attempt for username: %s", form.username.data)
             
             flash('Login failed. Please check your username and password.', 'danger')
     
@@ -45,7 +45,7 @@ def logout():
     logout_user()
     
     # Log logout
-    logger.info(f"User {username} logged out")
+    logger.info("User %s logged out", username)
     
     flash('You have been logged out.', 'info')
     return redirect(url_for('auth.login'))
@@ -0,0 +1,44 @@
+import hmac
+import logging
+import time
+
+from flask import Blueprint, Response, abort, g, request
+from flask_login import current_user
+
+from routes.utils.config_service import ConfigManager
+from services.metrics import HTTP_REQUESTS, HTTP_REQUEST_SECONDS, render_metrics
+
+metrics_bp = Blueprint('metrics', __name__)
+logger = logging.getLogger(__name__)
+
+# Endpoints left out of the request metrics
+UNMEASURED_ENDPOINTS = {'static', 'metrics.metrics'}
+
+@metrics_bp.before_app_request
+def start_request_timer():
+    """Remember when the request started"""
+    g.request_started = time.perf_counter()
+
+@metrics_bp.after_app_request
+def record_request(response):
+    """Count the request and record its duration, labelled by endpoint rather than URL"""
+    started = g.pop('request_started', None)
+    endpoint = request.endpoint or 'unmatched'
+    if started is None or endpoint in UNMEASURED_ENDPOINTS:
+        return response
+
+    HTTP_REQUESTS.labels(endpoint, request.method, str(response.status_code)).inc()
+    HTTP_REQUEST_SECONDS.labels(endpoint, request.method).observe(time.perf_counter() - started)
+    return response
+
+@metrics_bp.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint for a logged-in admin or a scraper sending METRICS_TOKEN as a bearer token"""
+    token = ConfigManager.get("METRICS_TOKEN", "")
+    supplied = request.headers.get('Authorization', '')
+    has_token = bool(token) and hmac.compare_digest(supplied, f"Bearer {token}")
+    if not has_token and not (current_user.is_authenticated and current_user.is_admin):
+        abort(401)
+
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
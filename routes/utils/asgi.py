@@ -0,0 +1,40 @@
+import json
+
+# Helpers for the plain ASGI handlers served by asgi.py
+
+
+async def read_body(receive):
+    """Read the whole request body"""
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+def get_header(scope, name):
+    """Get a request header by (case-insensitive) name, or None"""
+    name = name.lower().encode("latin-1")
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def send_response(send, status, body, content_type="text/plain; charset=utf-8"):
+    """Send a complete response"""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode("latin-1")), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, data, status=200):
+    """Send a JSON response"""
+    await send_response(send, status, json.dumps(data, ensure_ascii=False), "application/json")
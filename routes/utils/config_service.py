@@ -1,54 +1,134 @@
+import asyncio
+import contextvars
 import os
+import time
+import uuid
 import logging
+import threading
+
+from flask import has_app_context
+
+from services.metrics import CONFIG_CACHE_LOOKUPS
 
 logger = logging.getLogger(__name__)
 
 class ConfigManager:
-    """Configuration manager for the application"""
+    """Configuration manager for the application
+    
+    All Config rows are held in a per-process snapshot loaded with one query. A
+    generation row, rewritten by every set(), is checked at most once per
+    CONFIG_REFRESH_INTERVAL_MS; when another worker has changed a setting the
+    snapshot is reloaded, so all gunicorn workers converge on the same values.
+    On an asyncio event loop the check runs in a worker thread and reads are
+    served from the current snapshot meanwhile.
+    """
     
-    # Cache for configuration values
-    _config_cache = {}
+    # Config row whose value changes whenever any setting is written
+    GENERATION_KEY = "_CONFIG_GENERATION"
+    
+    _snapshot = None
+    _generation = None
+    _checked_at = 0.0
+    _refreshing = False
+    _lock = threading.Lock()
+    _refresh_interval = float(os.environ.get("CONFIG_REFRESH_INTERVAL_MS", "1000")) / 1000.0
     
     @staticmethod
-    def get(key, default=None):
-        """Get a configuration value from the database or cache"""
-        # Try to get the value from cache first
-        if key in ConfigManager._config_cache:
-            return ConfigManager._config_cache[key]
+    def _ensure_fresh():
+        """Reload the snapshot if it is missing or another worker has changed the config"""
+        now = time.monotonic()
+        if ConfigManager._snapshot is not None and now - ConfigManager._checked_at < ConfigManager._refresh_interval:
+            return
+        
+        # The database is only reachable inside an application context; elsewhere (e.g.
+        # background threads) serve the current snapshot without taking the lock
+        if not has_app_context():
+            return
         
-        # Check environment variables first
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None and ConfigManager._snapshot is not None:
+            # Never query the database on the event loop: serve the current snapshot
+            # and check the generation in a worker thread
+            with ConfigManager._lock:
+                if ConfigManager._refreshing:
+                    return
+                ConfigManager._refreshing = True
+            loop.run_in_executor(None, contextvars.copy_context().run, ConfigManager._background_refresh, now)
+            return
+        
+        ConfigManager._refresh(now)
+    
+    @staticmethod
+    def _background_refresh(now):
+        """Refresh the snapshot from a worker thread scheduled by _ensure_fresh"""
+        try:
+            ConfigManager._refresh(now)
+        finally:
+            ConfigManager._refreshing = False
+    
+    @staticmethod
+    def _refresh(now):
+        """Check the generation row and reload the snapshot when it has changed"""
+        with ConfigManager._lock:
+            # Another thread may have refreshed it while we waited for the lock
+            if ConfigManager._snapshot is not None and now - ConfigManager._checked_at < ConfigManager._refresh_interval:
+                return
+            
+            try:
+                # Import Flask dependencies inside the function to avoid circular imports
+                from sqlalchemy import select
+                from app import db
+                import models
+                
+                # Use a separate connection so the check never flushes or joins the caller's session
+                table = models.Config.__table__
+                with db.engine.connect() as conn:
+                    generation = conn.execute(
+                        select(table.c.value).where(table.c.key == ConfigManager.GENERATION_KEY)
+                    ).scalar()
+                    if ConfigManager._snapshot is None or generation != ConfigManager._generation:
+                        rows = conn.execute(select(table.c.key, table.c.value)).all()
+                        ConfigManager._snapshot = {key: value for key, value in rows}
+                        ConfigManager._generation = generation
+                        CONFIG_CACHE_LOOKUPS.labels("reloaded").inc()
+                        logger.debug("Loaded config snapshot (generation %s)", generation)
+                    else:
+                        CONFIG_CACHE_LOOKUPS.labels("revalidated").inc()
+                ConfigManager._checked_at = now
+            except Exception as e:
+                # Keep serving the previous snapshot if the database is unavailable
+                logger.debug("Could not refresh config snapshot: %s", e)
+    
+    @staticmethod
+    def get(key, default=None):
+        """Get a configuration value from the environment or the config snapshot"""
+        # Environment variables override the database
         env_value = os.environ.get(key)
         if env_value is not None:
-            ConfigManager._config_cache[key] = env_value
             return env_value
         
-        # Try to get from database, but only if within flask app context
-        try:
-            # Import Flask dependencies inside the function to avoid circular imports
-            from flask import current_app
-            from app import db
-            import models
-            
-            # Only try to query the database if we're inside an application context
-            with current_app.app_context():
-                # Then check the database
-                config_entry = models.Config.query.filter_by(key=key).first()
-                if config_entry and config_entry.value:
-                    ConfigManager._config_cache[key] = config_entry.value
-                    return config_entry.value
-        except Exception as e:
-            # Either not in app context, or another error occurred
-            logger.debug(f"Could not query database for config {key}: {str(e)}")
-            # Fall back to default
+        ConfigManager._ensure_fresh()
+        value = (ConfigManager._snapshot or {}).get(key)
+        if value:
+            return value
         
         # Return the default value if nothing found
         return default
     
+    @staticmethod
+    def generation():
+        """Get the loaded config generation, which changes whenever any setting is written"""
+        ConfigManager._ensure_fresh()
+        return ConfigManager._generation
+    
     @staticmethod
     def set(key, value):
-        """Set a configuration value in the database and cache"""
-        # Update cache
-        ConfigManager._config_cache[key] = value
+        """Set a configuration value in the database and the local snapshot"""
+        generation = uuid.uuid4().hex
+        stored = False
         
         try:
             # Import Flask dependencies inside the function to avoid circular imports
@@ -59,51 +139,51 @@ class ConfigManager:
             # Only try to update the database if we're inside an application context
             with current_app.app_context():
                 # Update database
-                config_entry = models.Config.query.filter_by(key=key).first()
-                if config_entry:
-                    config_entry.value = value
-                else:
-                    new_config = models.Config(key=key, value=value)
-                    db.session.add(new_config)
+                for entry_key, entry_value in ((key, value), (ConfigManager.GENERATION_KEY, generation)):
+                    config_entry = models.Config.query.filter_by(key=entry_key).first()
+                    if config_entry:
+                        config_entry.value = entry_value
+                    else:
+                        db.session.add(models.Config(key=entry_key, value=entry_value))
                 
                 db.session.commit()
+                stored = True
         except Exception as e:
             # Either not in app context, or another error occurred
-            logger.debug(f"Could not update database for config {key}: {str(e)}")
-            # Cache is still updated
+            logger.debug("Could not update database for config %s: %s", key, e)
+            # Snapshot is still updated
+        
+        # Update this worker's snapshot immediately; others pick the change up via the
+        # generation row. Both change under one lock, so a reload that read the rows
+        # before the commit cannot leave a snapshot without the key marked current.
+        with ConfigManager._lock:
+            if stored and ConfigManager._snapshot is not None:
+                ConfigManager._generation = generation
+            snapshot = dict(ConfigManager._snapshot or {})
+            snapshot[key] = value
+            ConfigManager._snapshot = snapshot
     
     @staticmethod
     def get_all():
-        """Get all configuration entries from the database"""
-        result = {}
+        """Get all configuration entries"""
+        ConfigManager._ensure_fresh()
         
-        try:
-            # Import Flask dependencies inside the function to avoid circular imports
-            from flask import current_app
-            import models
-            
-            # Only try to query the database if we're inside an application context
-            with current_app.app_context():
-                configs = models.Config.query.all()
-                
-                for config in configs:
-                    # Check if there's an environment variable that overrides the database value
-                    env_value = os.environ.get(config.key)
-                    if env_value is not None:
-                        result[config.key] = env_value
-                    else:
-                        result[config.key] = config.value
-        except Exception as e:
-            # Either not in app context, or another error occurred
-            logger.debug(f"Could not query database for all configs: {str(e)}")
-            # Return empty result
+        result = {}
+        for key, value in (ConfigManager._snapshot or {}).items():
+            if key == ConfigManager.GENERATION_KEY:
+                continue
+            # Check if there's an environment variable that overrides the database value
+            env_value = os.environ.get(key)
+            result[key] = env_value if env_value is not None else value
             
         return result
     
     @staticmethod
     def clear_cache():
-        """Clear the configuration cache"""
-        ConfigManager._config_cache = {}
+        """Clear the configuration snapshot so the next read reloads it"""
+        with ConfigManager._lock:
+            ConfigManager._snapshot = None
+            ConfigManager._generation = None
 
 # Helper function to get the OpenAI API key with fallback
 def get_openai_api_key():
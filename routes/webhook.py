@@ -1,9 +1,19 @@
+import contextvars
 import json
 import logging
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import requests
+from sqlalchemy.exc import IntegrityError
+from requests.adapters import HTTPAdapter
 from flask import Blueprint, request, abort, current_app
-from linebot import LineBotApi, WebhookHandler
+from linebot import LineBotApi, WebhookParser
 from linebot.exceptions import InvalidSignatureError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage,
 )
@@ -11,22 +21,82 @@ from app import db
 from models import LineUser, ChatMessage
 from routes.utils.config_service import ConfigManager
 from services.llm_service import LLMService
+from services.job_queue import get_webhook_queue
+from services.stats_service import StatsService
+from services.conversation_memory import ConversationMemory
+from services.chunker import split_complete_sentences
+from services.usage import recording_usage, current_usage
+from services.tracing import span, traced, current_context
+from services.logging_setup import correlation, redact
+from services.metrics import LINE_MESSAGES_COALESCED
+from services.user_queue import UserMessageQueue
 from rag_service import RAGService
 
 webhook_bp = Blueprint('webhook', __name__)
 logger = logging.getLogger(__name__)
 
-# Use default values for initialization at module level
-# These will be replaced with actual values during request processing
+# Fallback credentials used when none are configured
 DEFAULT_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', "dummy_token")
 DEFAULT_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET', "dummy_secret")
 
-# Initialize a global handler that will be replaced during request processing
-_line_bot_api = LineBotApi(DEFAULT_ACCESS_TOKEN)
-_webhook_handler = WebhookHandler(DEFAULT_CHANNEL_SECRET)
+# LINE Messaging API limits for text messages
+LINE_TEXT_LIMIT = 5000  # characters per message
+LINE_MESSAGES_PER_CALL = 5  # messages per reply or push call
 
-def get_line_bot_api():
-    """Get a LINE Bot API instance with current config"""
+class PooledRequestsHttpClient(RequestsHttpClient):
+    """LINE SDK HTTP client that reuses keep-alive connections through one requests.Session"""
+    
+    POOL_SIZE = 20
+    
+    def __init__(self, timeout=RequestsHttpClient.DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+    
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self.session.get(
+            url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout
+        )
+        return RequestsHttpResponse(response)
+    
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self.session.post(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+    
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self.session.delete(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+    
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = self.session.put(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+# Serialises each user's messages across deliveries and coalesces bursts
+_user_queue = UserMessageQueue()
+
+# LINE clients are built once per credential and rebuilt only when the credential changes
+_line_clients = {}
+_line_clients_lock = threading.Lock()
+
+def _get_cached_line_client(kind, credential, factory):
+    """Get the cached LINE client of a kind for a credential, replacing it if the credential changed"""
+    cached = _line_clients.get(kind)
+    if cached is not None and cached[0] == credential:
+        return cached[1]
+    
+    with _line_clients_lock:
+        cached = _line_clients.get(kind)
+        if cached is None or cached[0] != credential:
+            if cached is not None:
+                logger.info("LINE channel configuration changed, rebuilding %s", kind)
+            cached = (credential, factory(credential))
+            _line_clients[kind] = cached
+        return cached[1]
+
+def get_line_access_token():
+    """Get the LINE channel access token for the current config"""
     # First check for an environment variable
     token = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
     
@@ -34,10 +104,16 @@ def get_line_bot_api():
     if not token:
         token = ConfigManager.get("LINE_CHANNEL_ACCESS_TOKEN", DEFAULT_ACCESS_TOKEN)
     
-    return LineBotApi(token)
+    return token
+
+def get_line_bot_api():
+    """Get the LINE Bot API client for the current config"""
+    return _get_cached_line_client(
+        "LineBotApi", get_line_access_token(), lambda token: LineBotApi(token, http_client=PooledRequestsHttpClient)
+    )
 
-def get_line_webhook_handler():
-    """Get a LINE Webhook handler with current config"""
+def get_line_webhook_parser():
+    """Get the LINE webhook parser for the current config"""
     # First check for an environment variable
     secret = os.environ.get('LINE_CHANNEL_SECRET')
     
@@ -45,182 +121,487 @@ def get_line_webhook_handler():
     if not secret:
         secret = ConfigManager.get("LINE_CHANNEL_SECRET", DEFAULT_CHANNEL_SECRET)
     
-    return WebhookHandler(secret)
+    return _get_cached_line_client("WebhookParser", secret, WebhookParser)
 
 # LINE Bot webhook route
 @webhook_bp.route('/webhook', methods=['POST'])
+@traced("line_webhook")
 def line_webhook():
-    """Handle LINE webhook events"""
+    """Handle LINE webhook events
+    
+    Only the signature is checked inline; the delivery's text message events are
+    queued as one job for the background worker pool so LINE gets its 200 without
+    waiting on the LLM.
+    """
     # Get X-Line-Signature header value
     signature = request.headers['X-Line-Signature']
     
     # Get request body as text
     body = request.get_data(as_text=True)
     
-    # Log the request
-    logger.info("Request body: %s", body)
+    # Log the delivery size only; the body holds user messages
+    logger.debug("Webhook delivery of %d bytes", len(body))
     
-    # Initialize the webhook handler with current config
-    handler = get_line_webhook_handler()
+    # Verify the signature and parse the events with current config
+    parser = get_line_webhook_parser()
     
     try:
-        # Define the message handler here, inside the request context
-        @handler.add(MessageEvent, message=TextMessage)
-        def handle_message(event):
-            handle_text_message(event)
-            
-        # Handle the webhook
-        handler.handle(body, signature)
+        events = parser.parse(body, signature)
     except InvalidSignatureError:
         logger.error("Invalid signature. Check your channel secret.")
         abort(400)
     
+    text_events = [
+        event for event in events
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage)
+    ]
+    if not text_events:
+        return 'OK'
+    
+    # Events are queued as JSON dicts so they can also be sent to process workers
+    payloads = [event.as_json_dict() for event in text_events]
+    if not get_webhook_queue().submit(process_delivery, payloads, current_context()):
+        # Refuse the whole delivery while saturated so LINE can redeliver it later
+        logger.error("Webhook queue is full, rejecting delivery of %d events", len(text_events))
+        abort(503)
+    
     return 'OK'
 
-# Define the actual message handling function (not decorated directly)
-def handle_text_message(event):
-    """Handle text messages from LINE users"""
-    try:
-        # Get message content
-        user_id = event.source.user_id
-        user_message = event.message.text
+def group_events_by_user(events):
+    """Group message events by LINE user, keeping each user's events in delivery order"""
+    by_user = OrderedDict()
+    for event in events:
+        by_user.setdefault(event.source.user_id, []).append(event)
+    return by_user
+
+def process_delivery(payloads, trace_context=None):
+    """Background job: handle the text message events of one webhook delivery
+    
+    Events of users whose earlier messages are still being handled are queued
+    behind that handler; this job serves the rest. Their LINE users are loaded
+    with one IN query and different users are served concurrently (up to
+    WEBHOOK_DELIVERY_CONCURRENCY at a time), each independently of the others.
+    trace_context continues the webhook request's trace in this worker.
+    """
+    by_user = group_events_by_user(MessageEvent.new_from_json_dict(payload) for payload in payloads)
+    
+    with span("handle_delivery", context=trace_context, events=len(payloads), users=len(by_user)):
+        user_ids = [user_id for user_id, events in by_user.items() if _user_queue.push(user_id, events)]
+        if not user_ids:
+            return
         
-        logger.info(f"Received message from user {user_id}: {user_message}")
+        try:
+            line_users = {
+                line_user.line_user_id: line_user
+                for line_user in LineUser.query.filter(LineUser.line_user_id.in_(user_ids))
+            }
+            # Detach the users and return the connection while the events are handled; save_turns reattaches them
+            db.session.close()
+        except Exception:
+            for user_id in user_ids:
+                discard_user_queue(user_id)
+            raise
         
-        # Get or create the LINE user
-        line_user = LineUser.query.filter_by(line_user_id=user_id).first()
-        if not line_user:
-            logger.info(f"Creating new LINE user with ID: {user_id}")
-            # Initialize LINE Bot API
-            line_bot_api = get_line_bot_api()
-            
-            try:
-                # Get user profile from LINE
-                profile = line_bot_api.get_profile(user_id)
-                line_user = LineUser(
-                    line_user_id=user_id,
-                    display_name=profile.display_name,
-                    picture_url=profile.picture_url,
-                    status_message=profile.status_message
+        concurrency = int(ConfigManager.get("WEBHOOK_DELIVERY_CONCURRENCY", "8"))
+        if len(user_ids) == 1 or concurrency <= 1:
+            for user_id in user_ids:
+                serve_user(user_id, line_users.get(user_id))
+            return
+        
+        app = current_app._get_current_object()
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(user_ids))) as executor:
+            # Each thread gets its own app context (and so DB session) and a copy of the trace context
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run, _serve_user_in_app_context,
+                    app, user_id, line_users.get(user_id)
                 )
-                logger.info(f"Retrieved profile for user {user_id}: {profile.display_name}")
-            except Exception as e:
-                logger.error(f"Error getting user profile: {e}")
-                # Create a minimal user record
-                line_user = LineUser(line_user_id=user_id)
-            
-            db.session.add(line_user)
-            db.session.commit()
-            logger.info(f"New LINE user created: {user_id}")
+                for user_id in user_ids
+            ]
+            for future in futures:
+                future.result()
+
+def _serve_user_in_app_context(app, user_id, line_user):
+    """Run serve_user in a worker thread"""
+    with app.app_context():
+        serve_user(user_id, line_user)
+
+def discard_user_queue(user_id):
+    """Give up a user this job owns after a failure, logging the events that will not be answered"""
+    dropped = _user_queue.discard(user_id)
+    if dropped:
+        logger.error("Dropped %d queued events of user %s", len(dropped), user_id)
+
+def serve_user(user_id, line_user):
+    """Handle a user's queued events until none are left, then release the user
+    
+    Each round's turns are saved in one transaction before ownership is given up,
+    so the next handler of the user sees them. line_user is the user's stored
+    LineUser, or None for a first-time user.
+    """
+    released = False
+    try:
+        if line_user is None:
+            line_user = fetch_new_line_user(user_id)
+        while not released:
+            turns = handle_user_events(user_id, line_user)
+            if turns:
+                try:
+                    save_turns(turns)
+                    # save_turns may have swapped in a concurrently created user
+                    line_user = turns[-1].line_user
+                except Exception as e:
+                    logger.error("Error saving %d conversation turns of user %s: %s", len(turns), user_id, e,
+                                 exc_info=True)
+                    db.session.rollback()
+            released = _user_queue.release(user_id)
+    finally:
+        if not released:
+            discard_user_queue(user_id)
+
+def is_style_command(event):
+    """Check whether a message event is a /style command"""
+    return event.message.text.startswith('/style ')
+
+def coalesce_events(events):
+    """Merge runs of consecutive messages into one event each, keeping /style commands on their own
+    
+    A merged event carries the messages' text joined by newlines and answers
+    through the reply token of the newest message.
+    """
+    runs = []
+    for event in events:
+        if runs and not is_style_command(event) and not is_style_command(runs[-1][-1]):
+            runs[-1].append(event)
         else:
-            logger.info(f"Found existing LINE user: {line_user.line_user_id}, display name: {line_user.display_name}")
-        
-        # Save user message to database
-        chat_message = ChatMessage(
+            runs.append([event])
+    
+    merged = []
+    for run in runs:
+        event = run[-1]
+        if len(run) > 1:
+            logger.info("Coalescing %d messages from user %s", len(run), event.source.user_id)
+            LINE_MESSAGES_COALESCED.inc(len(run) - 1)
+            event.message.text = "\n".join(item.message.text for item in run)
+        merged.append(event)
+    return merged
+
+def next_user_batch(user_id):
+    """Wait until the user's queued messages are ready and take them (empty when none are queued)"""
+    while True:
+        events, wait = _user_queue.take(user_id)
+        if not wait:
+            return events
+        time.sleep(wait)
+
+def handle_user_events(user_id, line_user):
+    """Handle a user's queued events in order until none are left, returning the turns to save"""
+    turns = []
+    while True:
+        events = next_user_batch(user_id)
+        if not events:
+            return turns
+        for event in coalesce_events(events):
+            # Collect the token usage of this event for its ChatMessage; its logs carry the LINE event ID
+            with recording_usage(), correlation(getattr(event, "webhook_event_id", None)), \
+                    span("handle_text_message"):
+                turn = handle_text_message(event, line_user, turns)
+            if turn is not None:
+                turns.append(turn)
+
+def fetch_new_line_user(user_id):
+    """Build (but don't save) a LineUser for a first-time user, with their LINE profile if available"""
+    logger.info("Creating new LINE user with ID: %s", user_id)
+    try:
+        # Get user profile from LINE
+        profile = get_line_bot_api().get_profile(user_id)
+        logger.debug("Retrieved profile for user %s", user_id)
+        return LineUser(
             line_user_id=user_id,
-            is_user_message=True,
-            message_text=user_message
+            display_name=profile.display_name,
+            picture_url=profile.picture_url,
+            status_message=profile.status_message
         )
-        db.session.add(chat_message)
-        db.session.commit()
-        logger.info(f"Saved user message to database: {chat_message.id}")
+    except Exception as e:
+        logger.error("Error getting user profile: %s", e)
+        # Create a minimal user record
+        return LineUser(line_user_id=user_id)
+
+class PendingTurn:
+    """A handled message and its reply, waiting to be saved with the rest of its delivery
+    
+    replied_at defaults to the time the turn is created, i.e. when the reply was
+    produced, so a user's turns keep their order however late they are saved.
+    """
+    
+    __slots__ = ("line_user", "user_message", "received_at", "response_text", "bot_style",
+                 "style_update", "usage", "replied_at")
+    
+    def __init__(self, line_user, user_message, received_at, response_text, bot_style,
+                 style_update=None, usage=None, replied_at=None):
+        self.line_user = line_user
+        self.user_message = user_message
+        self.received_at = received_at
+        self.response_text = response_text
+        self.bot_style = bot_style
+        self.style_update = style_update
+        self.usage = usage
+        self.replied_at = replied_at or datetime.utcnow()
+    
+    def to_chat_messages(self):
+        """Build the user's and the bot's ChatMessage for this turn"""
+        usage_columns = self.usage.as_columns() if self.usage is not None else {}
+        user_id = self.line_user.line_user_id
+        return [
+            ChatMessage(
+                line_user_id=user_id,
+                is_user_message=True,
+                message_text=self.user_message,
+                timestamp=self.received_at
+            ),
+            ChatMessage(
+                line_user_id=user_id,
+                is_user_message=False,
+                message_text=self.response_text,
+                bot_style=self.bot_style,
+                timestamp=self.replied_at,
+                **usage_columns
+            ),
+        ]
+
+def prepare_turn_users(turns):
+    """Apply the turns' style changes and interaction time to their users, returning the users once each"""
+    line_users = OrderedDict()
+    now = datetime.utcnow()
+    for turn in turns:
+        if turn.style_update is not None:
+            turn.line_user.active_style = turn.style_update
+        turn.line_user.last_interaction = now
+        line_users[turn.line_user.line_user_id] = turn.line_user
+    return list(line_users.values())
+
+def first_turns_of_new_users(turns, new_user_ids):
+    """Get (received_at, is_new_user) for the turns, counting each new user on their first turn only"""
+    counted = set()
+    entries = []
+    for turn in turns:
+        user_id = turn.line_user.line_user_id
+        entries.append((turn.received_at, user_id in new_user_ids and user_id not in counted))
+        if user_id in new_user_ids:
+            counted.add(user_id)
+    return entries
+
+def replace_concurrent_users(turns, stored_users):
+    """Point the turns at the stored LineUsers reloaded after a failed insert
+
+    stored_users maps line_user_id to LineUser; turns of users still missing from
+    the database keep their new LineUser.
+    """
+    for turn in turns:
+        user_id = turn.line_user.line_user_id
+        turn.line_user = stored_users.get(user_id, turn.line_user)
+
+def turns_by_user(turns):
+    """Group turns by LINE user, keeping their order"""
+    grouped = {}
+    for turn in turns:
+        grouped.setdefault(turn.line_user.line_user_id, []).append(turn)
+    return list(grouped.values())
+
+@traced("save_turns")
+def save_turns(turns):
+    """Persist conversation turns (PendingTurns) in a single transaction
+    
+    Writes each LineUser once (insert for new users, style and last_interaction
+    update for existing ones) together with every turn's user and bot
+    ChatMessages and the hourly dashboard rollups, so a whole webhook delivery
+    costs one commit. Each turn's usage (a UsageRecord) is stored on its bot
+    message.
+    """
+    user_ids = list({turn.line_user.line_user_id for turn in turns})
+    for attempt in range(2):
+        try:
+            line_users = prepare_turn_users(turns)
+            new_user_ids = {line_user.line_user_id for line_user in line_users if line_user.id is None}
+            db.session.add_all(line_users)
+            if new_user_ids:
+                # Insert new users before the messages that reference them
+                db.session.flush()
+            db.session.add_all([message for turn in turns for message in turn.to_chat_messages()])
+            StatsService.record_turns(first_turns_of_new_users(turns, new_user_ids))
+            db.session.commit()
+            break
+        except IntegrityError:
+            # Another worker created some of these LINE users first; attach the turns to those rows instead
+            db.session.rollback()
+            stored_users = {
+                line_user.line_user_id: line_user
+                for line_user in LineUser.query.filter(LineUser.line_user_id.in_(user_ids))
+            }
+            created = new_user_ids & set(stored_users)
+            if attempt or not created:
+                raise
+            logger.info("LINE users %s were created concurrently, retrying with existing records",
+                        ", ".join(sorted(created)))
+            replace_concurrent_users(turns, stored_users)
+    
+    for user_turns in turns_by_user(turns):
+        ConversationMemory.record_turns(
+            user_turns[-1].line_user, [(turn.user_message, turn.response_text) for turn in user_turns]
+        )
+
+def to_text_messages(text):
+    """Split text into LINE text messages within the per-message character limit"""
+    return [TextSendMessage(text=text[i:i + LINE_TEXT_LIMIT]) for i in range(0, len(text), LINE_TEXT_LIMIT)]
+
+@traced("send_text")
+def send_text(event, text, reply_token_used=False):
+    """Send text to the event's user, through the reply token first and as push messages beyond it
+    
+    A reply or push call carries at most LINE_MESSAGES_PER_CALL messages, so longer
+    text (or text sent after the reply token is spent) goes out in push batches.
+    """
+    line_bot_api = get_line_bot_api()
+    messages = to_text_messages(text)
+    if not reply_token_used and messages:
+        line_bot_api.reply_message(event.reply_token, messages[:LINE_MESSAGES_PER_CALL])
+        messages = messages[LINE_MESSAGES_PER_CALL:]
+    for start in range(0, len(messages), LINE_MESSAGES_PER_CALL):
+        line_bot_api.push_message(event.source.user_id, messages[start:start + LINE_MESSAGES_PER_CALL])
+
+def stream_reply(event, user_message, bot_style, rag_context, history):
+    """Generate a response with streaming and send it while it is being generated
+    
+    The first complete sentences go out through the reply token as soon as they
+    reach STREAM_FIRST_REPLY_CHARS characters; the remainder is pushed once
+    generation finishes. Returns the full response text.
+    """
+    first_reply_chars = int(ConfigManager.get("STREAM_FIRST_REPLY_CHARS", "40"))
+    parts = []
+    sent_chars = 0
+    reply_token_used = False
+    started = time.monotonic()
+    
+    with span("LLMService.stream_response") as stream_span:
+        for delta in LLMService.stream_response(user_message, bot_style, rag_context, history=history):
+            parts.append(delta)
+            if reply_token_used:
+                continue
+            
+            complete, _ = split_complete_sentences("".join(parts))
+            if len(complete.strip()) >= first_reply_chars:
+                reply_token_used = True
+                if stream_span is not None:
+                    stream_span.set_attribute("first_reply_ms", round((time.monotonic() - started) * 1000, 1))
+                try:
+                    send_text(event, complete.strip())
+                    sent_chars = len(complete)
+                    logger.info("Sent first %d characters after %.2fs", sent_chars, time.monotonic() - started)
+                except Exception as e:
+                    # The reply token is spent or expired; push the whole response at the end
+                    logger.error("Error sending early LINE reply: %s", e, exc_info=True)
+    
+    response_text = "".join(parts)
+    remainder = response_text[sent_chars:].strip()
+    if remainder:
+        try:
+            send_text(event, remainder, reply_token_used=reply_token_used)
+        except Exception as e:
+            logger.error("Error sending LINE response: %s", e, exc_info=True)
+    return response_text
+
+# Define the actual message handling function (not decorated directly)
+def handle_text_message(event, line_user, pending_turns=()):
+    """Handle a text message from a LINE user and reply to it
+    
+    Returns the PendingTurn to save, or None if the message could not be handled.
+    pending_turns are the user's earlier turns of the same delivery, not saved yet;
+    they count towards the conversation history and the user's style.
+    """
+    try:
+        # Get message content
+        user_id = event.source.user_id
+        user_message = event.message.text
+        received_at = datetime.utcnow()
+        
+        logger.info("Received message from user %s: %s", user_id, redact(user_message))
         
         # Check for style command
-        bot_style = None
         if user_message.startswith('/style '):
             style_name = user_message[7:].strip()
-            logger.info(f"Style command detected: {style_name}")
-            # Set user's preferred style
-            line_user.active_style = style_name
-            db.session.commit()
+            logger.info("Setting user %s style to: %s", user_id, style_name)
             
             response_text = f"風格設定為: {style_name}"
-            logger.info(f"Setting user style to: {style_name}")
-            
-            # Save bot response to database
-            bot_message = ChatMessage(
-                line_user_id=user_id,
-                is_user_message=False,
-                message_text=response_text,
-                bot_style=style_name
-            )
-            db.session.add(bot_message)
-            db.session.commit()
             
             # Send response
-            line_bot_api = get_line_bot_api()
-            logger.info(f"Replying to style command with token: {event.reply_token}")
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=response_text)
-            )
-            logger.info("Style command response sent successfully")
-            return
-        
-        # Log LINE configuration values
-        access_token = ConfigManager.get("LINE_CHANNEL_ACCESS_TOKEN", "not_set")
-        channel_secret = ConfigManager.get("LINE_CHANNEL_SECRET", "not_set")
-        logger.info(f"LINE credentials - Access token length: {len(access_token)}, Channel secret length: {len(channel_secret)}")
+            try:
+                line_bot_api = get_line_bot_api()
+                line_bot_api.reply_message(
+                    event.reply_token,
+                    TextSendMessage(text=response_text)
+                )
+            except Exception as e:
+                logger.error("Error sending LINE response: %s", e, exc_info=True)
+            
+            # Save the user's preferred style with both messages
+            return PendingTurn(line_user, user_message, received_at, response_text, style_name,
+                               style_update=style_name)
         
         # Get RAG context if enabled
         rag_context = None
         try:
-            rag_enabled = ConfigManager.get("RAG_ENABLED", "False")
-            logger.info(f"RAG enabled: {rag_enabled}")
-            if rag_enabled.lower() == "true":
-                logger.info("Getting RAG context for query")
+            if ConfigManager.get("RAG_ENABLED", "False").lower() == "true":
                 rag_context = RAGService.get_context_for_query(user_message)
-                logger.info(f"RAG context retrieved, length: {len(rag_context) if rag_context else 0}")
+                logger.debug("RAG context retrieved, length: %d", len(rag_context) if rag_context else 0)
         except Exception as e:
-            logger.error(f"Error retrieving RAG context: {e}")
+            logger.error("Error retrieving RAG context: %s", e)
         
-        # Use the user's preferred style if set
-        active_bot_style = ConfigManager.get("ACTIVE_BOT_STYLE", "預設")
-        if line_user.active_style:
-            bot_style = line_user.active_style
-            logger.info(f"Using user's preferred style: {bot_style}")
-        else:
-            bot_style = active_bot_style
-            logger.info(f"Using default bot style: {bot_style}")
+        # Use the user's preferred style if set, including one set earlier in this delivery
+        style_updates = [turn.style_update for turn in pending_turns if turn.style_update is not None]
+        bot_style = (style_updates[-1] if style_updates else line_user.active_style) \
+            or ConfigManager.get("ACTIVE_BOT_STYLE", "預設")
         
-        # Get OpenAI API key
-        openai_api_key = ConfigManager.get("OPENAI_API_KEY", "not_set")
-        logger.info(f"OpenAI API key length: {len(openai_api_key)}")
+        # Get the earlier turns of this conversation
+        history = []
+        try:
+            with span("ConversationMemory.get_history"):
+                history = ConversationMemory.get_history(
+                    line_user, pending=[(turn.user_message, turn.response_text) for turn in pending_turns]
+                )
+        except Exception as e:
+            logger.error("Error retrieving conversation history: %s", e)
+        
+        # Return the DB connection to the pool while waiting on the LLM
+        db.session.close()
+        
+        # Stream long answers so the first sentences reach the user early
+        if ConfigManager.get("LLM_STREAMING_ENABLED", "False").lower() == "true":
+            logger.debug("Streaming response with style: %s, history messages: %d", bot_style, len(history))
+            response_text = stream_reply(event, user_message, bot_style, rag_context, history)
+            return PendingTurn(line_user, user_message, received_at, response_text, bot_style, usage=current_usage())
         
         # Generate response using OpenAI
-        logger.info(f"Generating response with style: {bot_style}")
+        logger.debug("Generating response with style: %s, history messages: %d", bot_style, len(history))
         try:
-            response_text = LLMService.generate_response(user_message, bot_style, rag_context)
-            logger.info(f"Response generated, length: {len(response_text)}")
+            response_text = LLMService.generate_response(user_message, bot_style, rag_context, history=history)
+            logger.debug("Response generated, length: %d", len(response_text))
         except Exception as e:
-            logger.error(f"Error generating LLM response: {e}", exc_info=True)
-            response_text = "抱歉，目前無法處理您的請求。請稍後再試。"
-        
-        # Save bot response to database
-        bot_message = ChatMessage(
-            line_user_id=user_id,
-            is_user_message=False,
-            message_text=response_text,
-            bot_style=bot_style
-        )
-        db.session.add(bot_message)
-        db.session.commit()
-        logger.info(f"Bot response saved to database: {bot_message.id}")
+            logger.error("Error generating LLM response: %s", e, exc_info=True)
+            response_text = LLMService.ERROR_REPLY
         
-        # Send response
+        # Send response; the turn is saved with the rest of the delivery
         try:
-            logger.info(f"Sending response with reply token: {event.reply_token}")
-            line_bot_api = get_line_bot_api()
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=response_text)
-            )
-            logger.info("Response sent successfully")
+            send_text(event, response_text)
+            logger.debug("Response sent to user %s", user_id)
         except Exception as e:
-            logger.error(f"Error sending LINE response: {e}", exc_info=True)
+            logger.error("Error sending LINE response: %s", e, exc_info=True)
+        
+        return PendingTurn(line_user, user_message, received_at, response_text, bot_style, usage=current_usage())
     
     except Exception as e:
-        logger.error(f"Unhandled exception in handle_text_message: {e}", exc_info=True)
+        logger.error("Unhandled exception in handle_text_message: %s", e, exc_info=True)
+        db.session.rollback()
+        return None
 
 # Webhook verification endpoint
 @webhook_bp.route('/webhook', methods=['GET'])
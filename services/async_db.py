@@ -0,0 +1,59 @@
+import logging
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+logger = logging.getLogger(__name__)
+
+# Async drivers for the databases the app supports
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+_engine = None
+_sessionmaker = None
+
+
+def init_async_db(sync_engine):
+    """Create the async engine for the database the Flask app uses
+
+    The URL is taken from the app's resolved engine (so relative SQLite paths point
+    at the same instance file) with its driver swapped for an async one.
+    """
+    global _engine, _sessionmaker
+    if _engine is not None:
+        return _engine
+
+    dialect = sync_engine.dialect.name
+    if dialect not in ASYNC_DRIVERS:
+        raise RuntimeError(f"No async driver configured for {dialect} databases")
+
+    url = sync_engine.url.set(drivername=ASYNC_DRIVERS[dialect])
+    options = {"pool_pre_ping": True, "pool_recycle": 300}
+    if dialect == "postgresql":
+        # asyncpg takes libpq's sslmode values as its ssl argument, not as a URL parameter
+        sslmode = url.query.get("sslmode")
+        if sslmode:
+            url = url.difference_update_query(["sslmode"])
+            options["connect_args"] = {"ssl": sslmode}
+
+    _engine = create_async_engine(url, **options)
+    _sessionmaker = async_sessionmaker(_engine, expire_on_commit=False)
+    logger.info("Created async database engine (%s)", ASYNC_DRIVERS[dialect])
+    return _engine
+
+
+def async_session():
+    """Open an AsyncSession (use as an async context manager)"""
+    if _sessionmaker is None:
+        raise RuntimeError("Async database is not initialised; call init_async_db() first")
+    return _sessionmaker()
+
+
+async def dispose_async_db():
+    """Close the async engine's connections"""
+    global _engine, _sessionmaker
+    if _engine is not None:
+        await _engine.dispose()
+    _engine = None
+    _sessionmaker = None
@@ -0,0 +1,74 @@
+import re
+
+from services.tokens import estimate_tokens
+
+# Sentence-ending punctuation (Chinese and Western) with any closing quotes/brackets, or line breaks
+_SENTENCE_BOUNDARY = re.compile(r'(?:[。！？!?；;…]+[」』）)"\'”’]*|\.(?=\s)|\n)+\s*')
+
+
+def iter_sentences(text):
+    """Lazily yield the sentences of a text, keeping their punctuation and trailing whitespace"""
+    start = 0
+    for match in _SENTENCE_BOUNDARY.finditer(text):
+        segment = text[start:match.end()]
+        start = match.end()
+        if segment.strip():
+            yield segment
+    if text[start:].strip():
+        yield text[start:]
+
+
+def split_complete_sentences(text):
+    """Split text into its complete sentences and the unfinished remainder after the last boundary"""
+    end = 0
+    for match in _SENTENCE_BOUNDARY.finditer(text):
+        end = match.end()
+    return text[:end], text[end:]
+
+
+def _split_long(segment, max_tokens):
+    """Split a segment that exceeds the token limit into roughly equal-sized pieces"""
+    tokens = estimate_tokens(segment)
+    if tokens <= max_tokens:
+        return [segment]
+
+    piece_chars = max(1, int(len(segment) * max_tokens / tokens))
+    return [segment[i:i + piece_chars] for i in range(0, len(segment), piece_chars)]
+
+
+def iter_chunks(text, max_tokens=300, overlap_tokens=50):
+    """Lazily split a text into chunks of whole sentences that fit max_tokens
+
+    Consecutive chunks share up to overlap_tokens of trailing sentences so that
+    passages cut at a chunk boundary can still be retrieved with their context.
+    Sentences longer than max_tokens are split by characters, which keeps Chinese
+    text without punctuation within the limit.
+    """
+    window = []
+    window_tokens = 0
+
+    for sentence in iter_sentences(text):
+        for piece in _split_long(sentence, max_tokens):
+            tokens = estimate_tokens(piece)
+            if window and window_tokens + tokens > max_tokens:
+                yield "".join(segment for segment, _ in window).strip()
+
+                # Carry trailing sentences over as the overlap for the next chunk
+                overlap = []
+                overlap_total = 0
+                for segment, segment_tokens in reversed(window):
+                    if overlap_total + segment_tokens > overlap_tokens:
+                        break
+                    overlap.insert(0, (segment, segment_tokens))
+                    overlap_total += segment_tokens
+                window, window_tokens = overlap, overlap_total
+
+                # Never let the overlap push the next chunk over the limit
+                while window and window_tokens + tokens > max_tokens:
+                    window_tokens -= window.pop(0)[1]
+
+            window.append((piece, tokens))
+            window_tokens += tokens
+
+    if window:
+        yield "".join(segment for segment, _ in window).strip()
@@ -0,0 +1,282 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+
+from sqlalchemy import select
+
+from app import db
+from models import ChatMessage, LineUser
+from routes.utils.config_service import ConfigManager
+from services.job_queue import get_summary_queue
+from services.tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Style commands only change the user's bot style; they are stored but left out of the history
+STYLE_COMMAND_PREFIX = "/style "
+
+
+class _Buffer:
+    """Recent messages of one LINE user, tagged with the interaction they are current as of"""
+
+    __slots__ = ("messages", "synced_at")
+
+    def __init__(self, messages, max_messages, synced_at):
+        self.messages = deque(messages, maxlen=max_messages)
+        self.synced_at = synced_at
+
+
+class ConversationMemory:
+    """Per-user conversation history for multi-turn prompts
+
+    Each worker keeps a bounded LRU of per-user ring buffers. A buffer is tagged
+    with the LineUser.last_interaction it reflects; when another worker has since
+    handled a turn for the user, the tags differ and the buffer is reloaded from
+    the (line_user_id, timestamp) index.
+    """
+
+    _buffers = OrderedDict()  # line_user_id -> _Buffer
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _settings():
+        """Get the number of turns kept, the prompt token budget and the user LRU size"""
+        return (
+            int(ConfigManager.get("CONVERSATION_HISTORY_TURNS", "6")),
+            int(ConfigManager.get("CONVERSATION_HISTORY_TOKENS", "1500")),
+            int(ConfigManager.get("CONVERSATION_MEMORY_USERS", "1000")),
+        )
+
+    @staticmethod
+    def _recent_messages_query(line_user_id, max_messages):
+        """Select the most recent messages of a user, newest first"""
+        return select(ChatMessage).where(
+            ChatMessage.line_user_id == line_user_id
+        ).order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc()).limit(max_messages)
+
+    @staticmethod
+    def _to_chat_messages(rows):
+        """Convert newest-first ChatMessage rows into chat messages, oldest first"""
+        return ConversationMemory._without_style_commands([
+            {"role": "user" if row.is_user_message else "assistant", "content": row.message_text}
+            for row in reversed(rows)
+        ])
+
+    @staticmethod
+    def _without_style_commands(messages):
+        """Drop /style commands and the bot's confirmations that follow them"""
+        kept = []
+        skip_reply = False
+        for message in messages:
+            if message["role"] == "user":
+                skip_reply = message["content"].startswith(STYLE_COMMAND_PREFIX)
+                if skip_reply:
+                    continue
+            elif skip_reply:
+                skip_reply = False
+                continue
+            kept.append(message)
+        return kept
+
+    @staticmethod
+    def _load_from_db(line_user_id, max_messages):
+        """Load the most recent messages of a user, oldest first"""
+        query = ConversationMemory._recent_messages_query(line_user_id, max_messages)
+        return ConversationMemory._to_chat_messages(db.session.execute(query).scalars().all())
+
+    @staticmethod
+    def _cached_messages(line_user, max_messages):
+        """Get the user's buffered messages if the buffer is current, else None"""
+        with ConversationMemory._lock:
+            buffer = ConversationMemory._buffers.get(line_user.line_user_id)
+            if buffer is not None and buffer.synced_at == line_user.last_interaction \
+                    and buffer.messages.maxlen == max_messages:
+                ConversationMemory._buffers.move_to_end(line_user.line_user_id)
+                return list(buffer.messages)
+        return None
+
+    @staticmethod
+    def _store_loaded(line_user, messages, max_messages, max_users):
+        """Cache messages just loaded from the database for the user"""
+        with ConversationMemory._lock:
+            ConversationMemory._store(
+                line_user.line_user_id, _Buffer(messages, max_messages, line_user.last_interaction), max_users
+            )
+
+    @staticmethod
+    def _store(line_user_id, buffer, max_users):
+        """Insert or refresh a buffer, evicting least recently used users (lock held)"""
+        ConversationMemory._buffers[line_user_id] = buffer
+        ConversationMemory._buffers.move_to_end(line_user_id)
+        while len(ConversationMemory._buffers) > max(1, max_users):
+            ConversationMemory._buffers.popitem(last=False)
+
+    @staticmethod
+    def _pending_messages(pending):
+        """Convert (user_message, response_text) turns not saved yet into chat messages"""
+        messages = []
+        for user_message, response_text in pending:
+            messages.append({"role": "user", "content": user_message})
+            messages.append({"role": "assistant", "content": response_text})
+        return ConversationMemory._without_style_commands(messages)
+
+    @staticmethod
+    def get_history(line_user, pending=()):
+        """Get the user's recent messages as chat messages, trimmed to the token budget
+
+        The rolling summary of older turns, if any, comes first as a system message.
+        pending holds (user_message, response_text) turns handled earlier in the same
+        webhook delivery that are not saved yet; they follow the stored messages.
+        """
+        turns, token_budget, max_users = ConversationMemory._settings()
+        if turns <= 0:
+            return []
+        max_messages = turns * 2
+
+        messages = []
+        if line_user.id is not None:
+            messages = ConversationMemory._cached_messages(line_user, max_messages)
+            if messages is None:
+                messages = ConversationMemory._load_from_db(line_user.line_user_id, max_messages)
+                ConversationMemory._store_loaded(line_user, messages, max_messages, max_users)
+        messages = messages + ConversationMemory._pending_messages(pending)
+        return ConversationMemory._to_history(line_user, messages[-max_messages:], token_budget)
+
+    @staticmethod
+    async def aget_history(line_user, session, pending=()):
+        """Async counterpart of get_history, loading through an AsyncSession on a cache miss"""
+        turns, token_budget, max_users = ConversationMemory._settings()
+        if turns <= 0:
+            return []
+        max_messages = turns * 2
+
+        messages = []
+        if line_user.id is not None:
+            messages = ConversationMemory._cached_messages(line_user, max_messages)
+            if messages is None:
+                query = ConversationMemory._recent_messages_query(line_user.line_user_id, max_messages)
+                messages = ConversationMemory._to_chat_messages((await session.execute(query)).scalars().all())
+                ConversationMemory._store_loaded(line_user, messages, max_messages, max_users)
+        messages = messages + ConversationMemory._pending_messages(pending)
+        return ConversationMemory._to_history(line_user, messages[-max_messages:], token_budget)
+
+    @staticmethod
+    def _to_history(line_user, messages, token_budget):
+        """Prefix the rolling summary and keep the newest messages that fit the token budget"""
+        history = []
+        summary_enabled = ConfigManager.get("CONVERSATION_SUMMARY_ENABLED", "False").lower() == "true"
+        if summary_enabled and line_user.conversation_summary:
+            summary = f"先前對話摘要：{line_user.conversation_summary}"
+            history.append({"role": "system", "content": summary})
+            token_budget -= estimate_tokens(summary)
+
+        # Keep the newest messages that fit the budget
+        kept = []
+        for message in reversed(messages):
+            tokens = estimate_tokens(message["content"])
+            if tokens > token_budget:
+                break
+            kept.append(message)
+            token_budget -= tokens
+        # Never start the history with a dangling bot reply
+        while kept and kept[-1]["role"] == "assistant":
+            kept.pop()
+        history.extend(reversed(kept))
+        return history
+
+    @staticmethod
+    def _append_turns(line_user, turns, max_messages, max_users):
+        """Append (user_message, response_text) turns to the user's buffer, returning the messages they push out
+
+        Returns None when this worker has no current buffer for the user.
+        """
+        user_id = line_user.line_user_id
+        with ConversationMemory._lock:
+            buffer = ConversationMemory._buffers.get(user_id)
+            if buffer is None or buffer.messages.maxlen != max_messages:
+                # Not cached (or cached under other settings): the next turn loads from the database
+                ConversationMemory._buffers.pop(user_id, None)
+                return None
+
+            messages = list(buffer.messages) + ConversationMemory._pending_messages(turns)
+            buffer.messages.extend(messages[len(buffer.messages):])
+            buffer.synced_at = line_user.last_interaction
+            ConversationMemory._store(user_id, buffer, max_users)
+        return messages[:-max_messages]
+
+    @staticmethod
+    def _store_window(line_user, rows, max_messages, max_users):
+        """Cache the window from rows loaded after turns were saved, returning the messages just before it
+
+        rows are the user's newest messages, newest first: the window plus the
+        messages of the saved turns, so anything beyond the window is what those
+        turns pushed out.
+        """
+        messages = ConversationMemory._to_chat_messages(rows)
+        ConversationMemory._store_loaded(line_user, messages[-max_messages:], max_messages, max_users)
+        return messages[:-max_messages]
+
+    @staticmethod
+    def _summaries_enabled():
+        """Check whether turns leaving the history window are folded into a rolling summary"""
+        return ConfigManager.get("CONVERSATION_SUMMARY_ENABLED", "False").lower() == "true"
+
+    @staticmethod
+    def _summarize(line_user_id, evicted):
+        """Queue the summary of messages that left the history window"""
+        if evicted and ConversationMemory._summaries_enabled():
+            get_summary_queue().submit(summarize_evicted_turns, line_user_id, evicted)
+
+    @staticmethod
+    def record_turns(line_user, turns):
+        """Append a user's saved (user_message, response_text) turns to their buffer and summarise what they push out
+
+        Without a buffer in this worker (after a restart, or when the user's last
+        turn went to another worker), the window is loaded from the database when
+        summaries are on, so the pushed-out turns are still summarised.
+        """
+        history_turns, _, max_users = ConversationMemory._settings()
+        if history_turns <= 0:
+            return
+        max_messages = history_turns * 2
+
+        evicted = ConversationMemory._append_turns(line_user, turns, max_messages, max_users)
+        if evicted is None and ConversationMemory._summaries_enabled():
+            query = ConversationMemory._recent_messages_query(line_user.line_user_id, max_messages + 2 * len(turns))
+            evicted = ConversationMemory._store_window(
+                line_user, db.session.execute(query).scalars().all(), max_messages, max_users
+            )
+        ConversationMemory._summarize(line_user.line_user_id, evicted)
+
+    @staticmethod
+    async def arecord_turns(line_user, turns, session):
+        """Async counterpart of record_turns, loading through an AsyncSession without a buffer"""
+        history_turns, _, max_users = ConversationMemory._settings()
+        if history_turns <= 0:
+            return
+        max_messages = history_turns * 2
+
+        evicted = ConversationMemory._append_turns(line_user, turns, max_messages, max_users)
+        if evicted is None and ConversationMemory._summaries_enabled():
+            query = ConversationMemory._recent_messages_query(line_user.line_user_id, max_messages + 2 * len(turns))
+            evicted = ConversationMemory._store_window(
+                line_user, (await session.execute(query)).scalars().all(), max_messages, max_users
+            )
+        ConversationMemory._summarize(line_user.line_user_id, evicted)
+
+
+def summarize_evicted_turns(line_user_id, evicted_messages):
+    """Fold messages that left the history window into the user's rolling summary"""
+    # Import here to avoid circular imports
+    from services.llm_service import LLMService
+
+    line_user = LineUser.query.filter_by(line_user_id=line_user_id).first()
+    if line_user is None:
+        return
+
+    summary = LLMService.summarize_conversation(line_user.conversation_summary, evicted_messages)
+    if summary:
+        # Update only the summary column so a concurrent turn's changes are not overwritten
+        LineUser.query.filter_by(id=line_user.id).update({"conversation_summary": summary})
+        db.session.commit()
+        logger.debug("Updated conversation summary for user %s", line_user_id)
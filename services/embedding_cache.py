@@ -0,0 +1,185 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    """Normalise text for cache keys: NFKC (full-width to half-width), collapsed whitespace, lower case"""
+    return _WHITESPACE.sub(' ', unicodedata.normalize('NFKC', text)).strip().lower()
+
+
+class EmbeddingCache:
+    """Bounded LRU/TTL cache of embeddings with an optional SQLite tier shared across workers"""
+
+    def __init__(self, max_entries=5000, ttl_seconds=86400, db_path=None):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl_seconds = float(ttl_seconds)
+        self.db_path = db_path or None
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+        if self.db_path:
+            try:
+                self._init_db()
+            except sqlite3.Error as e:
+                logger.error("Could not open embedding cache database %s, using memory only: %s", self.db_path, e)
+                self.db_path = None
+
+    def _connection(self):
+        """Get this thread's SQLite connection"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        """Create the shared cache table"""
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache ("
+            "model TEXT NOT NULL, text TEXT NOT NULL, embedding BLOB NOT NULL, created_at REAL NOT NULL, "
+            "PRIMARY KEY (model, text))"
+        )
+        # Expired rows are never served; drop them whenever a worker opens the cache
+        conn.execute("DELETE FROM embedding_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        conn.commit()
+
+    def get(self, text, model):
+        """Get a cached embedding, or None on a miss"""
+        return self._lookup(text, model, count=True)
+
+    def peek(self, text, model):
+        """Get a cached embedding like get(), without counting a hit or miss
+
+        For callers that only use an embedding if one happens to be cached, so
+        the hit rate keeps describing the lookups that would call the API.
+        """
+        return self._lookup(text, model, count=False)
+
+    def _lookup(self, text, model, count):
+        """Look an embedding up in memory, then on disk"""
+        key = (model, normalize_text(text))
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                embedding, created_at = entry
+                if now - created_at <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    if count:
+                        self._counters["hits"] += 1
+                    return embedding
+                del self._entries[key]
+
+        if self.db_path:
+            embedding, created_at = self._get_from_db(key, now)
+            if embedding is not None:
+                with self._lock:
+                    self._store(key, embedding, created_at)
+                    if count:
+                        self._counters["disk_hits"] += 1
+                return embedding
+
+        if count:
+            with self._lock:
+                self._counters["misses"] += 1
+        return None
+
+    def put(self, text, model, embedding):
+        """Store an embedding in the cache"""
+        key = (model, normalize_text(text))
+        now = time.time()
+        with self._lock:
+            self._store(key, embedding, now)
+
+        if self.db_path:
+            try:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO embedding_cache (model, text, embedding, created_at) VALUES (?, ?, ?, ?)",
+                    (key[0], key[1], np.asarray(embedding, dtype='float32').tobytes(), now)
+                )
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.warning("Could not write embedding cache entry: %s", e)
+
+    def _store(self, key, embedding, created_at):
+        """Insert into the in-memory tier, evicting the least recently used entries (lock held)"""
+        self._entries[key] = (embedding, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def _get_from_db(self, key, now):
+        """Look an entry up in the SQLite tier"""
+        try:
+            row = self._connection().execute(
+                "SELECT embedding, created_at FROM embedding_cache WHERE model = ? AND text = ? AND created_at >= ?",
+                (key[0], key[1], now - self.ttl_seconds)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Could not read embedding cache entry: %s", e)
+            return None, None
+        if row is None:
+            return None, None
+        return np.frombuffer(row[0], dtype='float32').tolist(), row[1]
+
+    def stats(self):
+        """Get hit/miss counters and the hit rate"""
+        with self._lock:
+            counters = dict(self._counters)
+            size = len(self._entries)
+
+        lookups = counters["hits"] + counters["disk_hits"] + counters["misses"]
+        hit_rate = (counters["hits"] + counters["disk_hits"]) / lookups if lookups else 0.0
+        return {
+            **counters,
+            "size": size,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "shared_tier": bool(self.db_path),
+            "hit_rate": round(hit_rate, 3),
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """Get the process-wide query embedding cache, creating it from config on first use"""
+    global _cache
+
+    if _cache is None:
+        # Import here to avoid circular imports
+        from routes.utils.config_service import ConfigManager
+
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache(
+                    max_entries=int(ConfigManager.get("EMBEDDING_CACHE_SIZE", "5000")),
+                    ttl_seconds=float(ConfigManager.get("EMBEDDING_CACHE_TTL", "86400")),
+                    db_path=ConfigManager.get("EMBEDDING_CACHE_PATH", "")
+                )
+    return _cache
@@ -0,0 +1,231 @@
+import atexit
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Number of recent latency samples kept per stage
+LATENCY_WINDOW = 1000
+
+
+def summarize_latencies(samples):
+    """Summarize latency samples (seconds) as count/avg/p50/p95/p99/max in milliseconds"""
+    values = sorted(samples)
+    if not values:
+        return {"count": 0, "avg_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+
+    def percentile(pct):
+        index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+        return round(values[index] * 1000, 2)
+
+    return {
+        "count": len(values),
+        "avg_ms": round(sum(values) / len(values) * 1000, 2),
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": round(values[-1] * 1000, 2),
+    }
+
+
+def _run_in_app_context(func, args):
+    """Run a job inside a Flask application context"""
+    # Import here to avoid circular imports (and so process workers load the app)
+    from app import app
+
+    with app.app_context():
+        return func(*args)
+
+
+class JobQueue:
+    """Bounded in-process job queue served by a pool of worker threads or processes"""
+
+    def __init__(self, name, workers=4, max_size=100, mode="thread"):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown worker mode: {mode}")
+
+        self.name = name
+        self.workers = max(1, int(workers))
+        self.max_size = max(1, int(max_size))
+        self.mode = mode
+
+        self._queue = queue.Queue(maxsize=self.max_size)
+        self._threads = []
+        self._executor = None
+        self._lock = threading.Lock()
+        self._started = False
+        self._busy = 0
+        self._counters = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0}
+        self._latencies = {
+            "wait": deque(maxlen=LATENCY_WINDOW),
+            "run": deque(maxlen=LATENCY_WINDOW),
+            "total": deque(maxlen=LATENCY_WINDOW),
+        }
+
+    def start(self):
+        """Start the worker pool (idempotent)"""
+        with self._lock:
+            if self._started:
+                return
+            if self.mode == "process":
+                # Spawn rather than fork: the parent holds threads, DB connections and HTTP pools
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._worker_loop,
+                    name=f"{self.name}-worker-{i}",
+                    daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            self._started = True
+        logger.info("Started job queue '%s' with %s %s workers (max size %s)", self.name, self.workers, self.mode, self.max_size)
+
+    def free_slots(self):
+        """Get the number of jobs that can still be queued without blocking"""
+        return self.max_size - self._queue.qsize()
+
+    def submit(self, func, *args):
+        """Queue a job for background execution, returning False if the queue is full
+
+        In process mode the function must be importable at module level and its
+        arguments picklable.
+        """
+        self.start()
+        try:
+            self._queue.put_nowait((func, args, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self._counters["rejected"] += 1
+            logger.warning("Job queue '%s' is full, rejecting job %s", self.name, getattr(func, "__name__", func))
+            return False
+
+        with self._lock:
+            self._counters["submitted"] += 1
+        return True
+
+    def _worker_loop(self):
+        """Take jobs off the queue and execute them until a shutdown sentinel arrives"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+
+            func, args, enqueued_at = item
+            started_at = time.monotonic()
+            with self._lock:
+                self._busy += 1
+
+            failed = False
+            try:
+                if self._executor is not None:
+                    self._executor.submit(_run_in_app_context, func, args).result()
+                else:
+                    _run_in_app_context(func, args)
+            except Exception as e:
+                failed = True
+                logger.error("Job %s failed in queue '%s': %s", getattr(func, "__name__", func), self.name, e, exc_info=True)
+            finally:
+                finished_at = time.monotonic()
+                with self._lock:
+                    self._busy -= 1
+                    self._counters["failed" if failed else "completed"] += 1
+                    self._latencies["wait"].append(started_at - enqueued_at)
+                    self._latencies["run"].append(finished_at - started_at)
+                    self._latencies["total"].append(finished_at - enqueued_at)
+                self._queue.task_done()
+
+    def stats(self):
+        """Get queue depth, worker utilisation and per-stage latency statistics"""
+        with self._lock:
+            busy = self._busy
+            counters = dict(self._counters)
+            latencies = {stage: list(samples) for stage, samples in self._latencies.items()}
+
+        return {
+            "name": self.name,
+            "mode": self.mode,
+            "started": self._started,
+            "workers": self.workers,
+            "busy_workers": busy,
+            "utilization": round(busy / self.workers, 3),
+            "queue_depth": self._queue.qsize(),
+            "queue_capacity": self.max_size,
+            "counters": counters,
+            "latency": {stage: summarize_latencies(samples) for stage, samples in latencies.items()},
+        }
+
+    def shutdown(self, wait=True):
+        """Stop the workers after the queued jobs have been processed"""
+        with self._lock:
+            if not self._started:
+                return
+            self._started = False
+            threads, self._threads = self._threads, []
+
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+# Process-wide queues, created on first use
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def _get_queue(name, factory):
+    """Get a named process-wide queue, creating it with factory() on first use"""
+    job_queue = _queues.get(name)
+    if job_queue is None:
+        with _queues_lock:
+            job_queue = _queues.get(name)
+            if job_queue is None:
+                job_queue = factory()
+                _queues[name] = job_queue
+                atexit.register(job_queue.shutdown)
+    return job_queue
+
+
+def get_webhook_queue():
+    """Get the job queue that processes LINE webhook events"""
+    # Import here to avoid circular imports
+    from routes.utils.config_service import ConfigManager
+
+    def create():
+        mode = ConfigManager.get("WEBHOOK_WORKER_MODE", "thread")
+        if mode == "process":
+            # services.user_queue keeps its per-user state in the process that runs the job
+            logger.warning("Webhook queue in process mode: per-user message ordering and coalescing "
+                           "only apply to events handled by the same worker process")
+        return JobQueue(
+            "webhook",
+            workers=int(ConfigManager.get("WEBHOOK_WORKERS", "4")),
+            max_size=int(ConfigManager.get("WEBHOOK_QUEUE_SIZE", "100")),
+            mode=mode
+        )
+
+    return _get_queue("webhook", create)
+
+
+def get_maintenance_queue():
+    """Get the single-worker job queue for slow admin tasks such as index rebuilds"""
+    return _get_queue("maintenance", lambda: JobQueue("maintenance", workers=1, max_size=10))
+
+
+def get_summary_queue():
+    """Get the single-worker job queue that folds old conversation turns into summaries"""
+    return _get_queue("summary", lambda: JobQueue("summary", workers=1, max_size=200))
@@ -1,24 +1,148 @@
-import os
-import json
+import asyncio
+import hashlib
 import logging
 import datetime
-from openai import OpenAI
-from routes.utils.config_service import ConfigManager, get_openai_api_key, get_llm_settings
+import threading
+import time
+import httpx
+from openai import AsyncOpenAI, OpenAI
+from routes.utils.config_service import ConfigManager, get_openai_api_key
+from services.embedding_cache import get_embedding_cache
+from services.response_cache import get_response_cache
+from services.resilience import call_with_resilience, acall_with_resilience, CircuitOpenError, RETRYABLE_ERRORS
+from services.model_router import ModelRouter
+from services.tokens import estimate_tokens, truncate_to_tokens
+from services.usage import record_chat_usage, record_prompt
+from services.tracing import traced
 
 logger = logging.getLogger(__name__)
 
+# Tokens the chat format adds around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+RAG_CONTEXT_PREFIX = "Here is some additional context that might be helpful: "
+
 class LLMService:
     """Service for interacting with OpenAI LLM"""
     
+    # Pooled clients keyed by (API key, connection settings); the newest one serves all calls
+    _clients = {}
+    _clients_lock = threading.Lock()
+    _async_clients = {}
+    _retiring_async_clients = {}  # closing task -> replaced AsyncOpenAI client
+    
+    # Reply sent to LINE users when no model could answer; details only go to the log
+    ERROR_REPLY = "抱歉，目前無法處理您的請求。請稍後再試。"
+    
+    @staticmethod
+    def _connection_settings():
+        """Get the HTTP connection pool settings for OpenAI clients"""
+        return (
+            int(ConfigManager.get("OPENAI_POOL_SIZE", "20")),
+            float(ConfigManager.get("OPENAI_TIMEOUT", "30")),
+            float(ConfigManager.get("OPENAI_CONNECT_TIMEOUT", "5")),
+        )
+    
+    @staticmethod
+    def _retry_settings():
+        """Get the per-call deadline (seconds) and retry limit applied by the resilience layer"""
+        return (
+            float(ConfigManager.get("OPENAI_DEADLINE", "30")),
+            int(ConfigManager.get("OPENAI_MAX_RETRIES", "2")),
+        )
+    
+    @staticmethod
+    def _build_client(api_key, settings):
+        """Create an OpenAI client with a persistent keep-alive connection pool
+        
+        The SDK's own retries are disabled; call_with_resilience retries within a
+        deadline and feeds the circuit breakers instead.
+        """
+        pool_size, timeout, connect_timeout = settings
+        http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=60
+            ),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            follow_redirects=True
+        )
+        return OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+    
+    @staticmethod
+    def _retire_clients(clients):
+        """Close replaced clients once the calls still running on them have reached their deadline"""
+        delay = LLMService._retry_settings()[0]
+        for client in clients:
+            timer = threading.Timer(delay, client.close)
+            timer.daemon = True
+            timer.start()
+    
+    @staticmethod
+    async def _aclose_later(client):
+        """Async counterpart of _retire_clients for one AsyncOpenAI client"""
+        await asyncio.sleep(LLMService._retry_settings()[0])
+        await client.close()
+    
     @staticmethod
     def get_client():
-        """Get an OpenAI client instance with the current API key"""
+        """Get the pooled OpenAI client for the current API key
+        
+        The client (and its keep-alive connections) is reused across requests and
+        threads. When the API key or pool settings change, a new client is built and
+        swapped in; calls still running on the old client finish normally, and it is
+        closed once OPENAI_DEADLINE has passed.
+        """
         api_key = get_openai_api_key()
         if not api_key:
             logger.error("OpenAI API key not configured")
             return None
         
-        return OpenAI(api_key=api_key)
+        registry_key = (api_key, LLMService._connection_settings())
+        client = LLMService._clients.get(registry_key)
+        if client is not None:
+            return client
+        
+        with LLMService._clients_lock:
+            client = LLMService._clients.get(registry_key)
+            if client is None:
+                client = LLMService._build_client(api_key, registry_key[1])
+                if LLMService._clients:
+                    logger.info("OpenAI API key or connection settings changed, replacing pooled client")
+                    LLMService._retire_clients(LLMService._clients.values())
+                # Replace the whole mapping in one assignment so lock-free readers never see it half-updated
+                LLMService._clients = {registry_key: client}
+        return client
+    
+    @staticmethod
+    def get_async_client():
+        """Get the pooled AsyncOpenAI client for the current API key (ASGI path, one event loop)"""
+        api_key = get_openai_api_key()
+        if not api_key:
+            logger.error("OpenAI API key not configured")
+            return None
+        
+        registry_key = (api_key, LLMService._connection_settings())
+        client = LLMService._async_clients.get(registry_key)
+        if client is None:
+            pool_size, timeout, connect_timeout = registry_key[1]
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size,
+                    keepalive_expiry=60
+                ),
+                timeout=httpx.Timeout(timeout, connect=connect_timeout),
+                follow_redirects=True
+            )
+            client = AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+            for old_client in LLMService._async_clients.values():
+                task = asyncio.get_running_loop().create_task(LLMService._aclose_later(old_client))
+                LLMService._retiring_async_clients[task] = old_client
+                task.add_done_callback(LLMService._retiring_async_clients.pop)
+            LLMService._async_clients = {registry_key: client}
+        return client
     
     @staticmethod
     def get_bot_style(style_name=None):
@@ -47,19 +171,26 @@ class LLMService:
         return style
     
     @staticmethod
-    def generate_response(user_message, style_name=None, rag_context=None):
-        """Generate a response using the OpenAI API with the specified style"""
-        client = LLMService.get_client()
-        if not client:
-            return "抱歉，無法連接 AI 服務，請檢查 API 設定。"
+    async def aget_bot_style(session, style_name=None):
+        """Async counterpart of get_bot_style, reading through an AsyncSession"""
+        # Import here to avoid circular imports
+        from sqlalchemy import select
+        from app import BotStyle
         
-        # Get the bot style
-        style = LLMService.get_bot_style(style_name)
+        if not style_name:
+            style_name = ConfigManager.get("ACTIVE_BOT_STYLE", "貼心")
         
-        # Get OpenAI settings
-        settings = get_llm_settings()
+        for name in (style_name, "貼心"):
+            style = (await session.execute(select(BotStyle).where(BotStyle.name == name))).scalars().first()
+            if style:
+                return style
         
-        # Get current date information
+        # No default style yet: let the synchronous path create it
+        return await asyncio.to_thread(LLMService.get_bot_style, "貼心")
+    
+    @staticmethod
+    def _date_context():
+        """Get the current date fields and the system prompt that tells the model about them"""
         current_date = datetime.datetime.now()
         date_info = {
             "year": current_date.year,
@@ -80,8 +211,55 @@ class LLMService:
 當前時間是 {date_info['full_time']}。
 如果用戶詢問當前日期或時間，請使用以上信息回答。
 """
+        return date_info, date_prompt
+    
+    @staticmethod
+    def _fit_prompt_budget(style, date_prompt, user_message, rag_context, history):
+        """Trim the RAG context and history so the assembled prompt fits PROMPT_TOKEN_BUDGET
         
-        # Build the messages
+        The style prompt, date and user message are always kept. The RAG context
+        is kept next (cut at the end if needed), then as much of the history as
+        fits, newest messages first.
+        """
+        budget = int(ConfigManager.get("PROMPT_TOKEN_BUDGET", "6000"))
+        remaining = budget - sum(
+            estimate_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+            for text in (style.prompt, date_prompt, user_message)
+        )
+        
+        if rag_context:
+            rag_budget = remaining - estimate_tokens(RAG_CONTEXT_PREFIX) - MESSAGE_OVERHEAD_TOKENS
+            if estimate_tokens(rag_context) > rag_budget:
+                logger.warning("Truncating RAG context to %d tokens to fit the prompt budget", max(0, rag_budget))
+                rag_context = truncate_to_tokens(rag_context, rag_budget)
+            if rag_context:
+                remaining -= estimate_tokens(RAG_CONTEXT_PREFIX + rag_context) + MESSAGE_OVERHEAD_TOKENS
+        
+        kept = []
+        for message in reversed(history or []):
+            tokens = estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+            if tokens > remaining:
+                logger.info("Dropping %d history messages to fit the prompt budget", len(history) - len(kept))
+                break
+            kept.append(message)
+            remaining -= tokens
+        return rag_context, list(reversed(kept))
+    
+    @staticmethod
+    def _assemble_prompt(style, date_prompt, user_message, rag_context=None, history=None):
+        """Fit the prompt to the token budget and build its messages, recording size and timing"""
+        started = time.perf_counter()
+        rag_context, history = LLMService._fit_prompt_budget(style, date_prompt, user_message, rag_context, history)
+        messages = LLMService._build_messages(style, date_prompt, user_message, rag_context, history)
+        record_prompt(
+            estimate_tokens(rag_context) if rag_context else 0,
+            round((time.perf_counter() - started) * 1000, 3)
+        )
+        return messages
+    
+    @staticmethod
+    def _build_messages(style, date_prompt, user_message, rag_context=None, history=None):
+        """Build the chat messages sent to the model"""
         messages = [
             {"role": "system", "content": style.prompt},
             {"role": "system", "content": date_prompt}
@@ -91,39 +269,318 @@ class LLMService:
         if rag_context:
             messages.append({
                 "role": "system", 
-                "content": f"Here is some additional context that might be helpful: {rag_context}"
+                "content": f"{RAG_CONTEXT_PREFIX}{rag_context}"
             })
         
+        # Add earlier turns of the conversation
+        if history:
+            messages.extend(history)
+        
         # Add user message
         messages.append({"role": "user", "content": user_message})
+        return messages
+    
+    @staticmethod
+    def _lookup_cached_reply(user_message, style, model, rag_context, date_info, history):
+        """Look up a cached reply to a near-identical question asked in the same setting
+        
+        Returns (cache, key, embedding, reply); cache is None when the cache is
+        disabled, the reply depends on earlier turns (never cached), or no query
+        embedding is cached yet (the cache never pays for an embeddings call).
+        With conversation history on (CONVERSATION_HISTORY_TURNS > 0), only a
+        user's first message has no earlier turns, which is why the cache is off
+        by default.
+        """
+        response_cache = None if history else get_response_cache()
+        if response_cache is None:
+            return None, None, None, None
+        cache_key, query_embedding = LLMService._response_cache_key(user_message, style, model, rag_context, date_info)
+        if query_embedding is None:
+            return None, None, None, None
+        return response_cache, cache_key, query_embedding, response_cache.lookup(cache_key, query_embedding)
+    
+    @staticmethod
+    def _chat_completion(client, model, **kwargs):
+        """Create a chat completion with the routed model, falling back to OPENAI_FALLBACK_MODEL
+        
+        Each model has its own circuit breaker, so while the routed model is unhealthy
+        calls go straight to the fallback model instead of waiting for it to time out.
+        The fallback only gets what is left of OPENAI_DEADLINE.
+        Returns (model used, response). Non-streaming calls are recorded in the
+        per-model statistics here; streaming callers record once the stream ends.
+        """
+        models = [model]
+        fallback_model = ConfigManager.get("OPENAI_FALLBACK_MODEL", "")
+        if fallback_model and fallback_model not in models:
+            models.append(fallback_model)
+        
+        deadline, max_retries = LLMService._retry_settings()
+        expires_at = time.monotonic() + deadline
+        last_error = None
+        for candidate in models:
+            started = time.monotonic()
+            if last_error is not None and started >= expires_at:
+                break
+            try:
+                response = call_with_resilience(
+                    f"chat:{candidate}",
+                    lambda timeout: client.chat.completions.create(model=candidate, timeout=timeout, **kwargs),
+                    expires_at - started,
+                    max_retries
+                )
+            except (CircuitOpenError,) + RETRYABLE_ERRORS as e:
+                logger.warning("Chat completion with %s unavailable: %s", candidate, e)
+                if not isinstance(e, CircuitOpenError):
+                    ModelRouter.record(candidate, time.monotonic() - started, error=True)
+                last_error = e
+                continue
+            if not kwargs.get("stream"):
+                ModelRouter.record(candidate, time.monotonic() - started, response.usage)
+                record_chat_usage(candidate, response.usage)
+            return candidate, response
+        raise last_error
+    
+    @staticmethod
+    async def _achat_completion(client, model, **kwargs):
+        """Async counterpart of _chat_completion (non-streaming), sharing its breakers and fallback"""
+        models = [model]
+        fallback_model = ConfigManager.get("OPENAI_FALLBACK_MODEL", "")
+        if fallback_model and fallback_model not in models:
+            models.append(fallback_model)
+        
+        deadline, max_retries = LLMService._retry_settings()
+        expires_at = time.monotonic() + deadline
+        last_error = None
+        for candidate in models:
+            started = time.monotonic()
+            if last_error is not None and started >= expires_at:
+                break
+            try:
+                response = await acall_with_resilience(
+                    f"chat:{candidate}",
+                    lambda timeout: client.chat.completions.create(model=candidate, timeout=timeout, **kwargs),
+                    expires_at - started,
+                    max_retries
+                )
+            except (CircuitOpenError,) + RETRYABLE_ERRORS as e:
+                logger.warning("Chat completion with %s unavailable: %s", candidate, e)
+                if not isinstance(e, CircuitOpenError):
+                    ModelRouter.record(candidate, time.monotonic() - started, error=True)
+                last_error = e
+                continue
+            ModelRouter.record(candidate, time.monotonic() - started, response.usage)
+            record_chat_usage(candidate, response.usage)
+            return candidate, response
+        raise last_error
+    
+    @staticmethod
+    @traced("LLMService.generate_response")
+    def generate_response(user_message, style_name=None, rag_context=None, history=None):
+        """Generate a response using the OpenAI API with the specified style
+        
+        history is the user's earlier conversation as chat messages (see
+        ConversationMemory.get_history), inserted between the system prompts and
+        the new message.
+        """
+        # Get the bot style
+        style = LLMService.get_bot_style(style_name)
+        
+        # Pick the model and parameters for this style and request class
+        route = ModelRouter.route(style, user_message, rag_context)
+        
+        # Get current date information
+        date_info, date_prompt = LLMService._date_context()
+        
+        response_cache, cache_key, query_embedding, cached_reply = LLMService._lookup_cached_reply(
+            user_message, style, route["model"], rag_context, date_info, history
+        )
+        if cached_reply is not None:
+            return cached_reply
+        
+        client = LLMService.get_client()
+        if not client:
+            return "抱歉，無法連接 AI 服務，請檢查 API 設定。"
+        
+        messages = LLMService._assemble_prompt(style, date_prompt, user_message, rag_context, history)
         
         try:
-            # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
-            # do not change this unless explicitly requested by the user
-            response = client.chat.completions.create(
-                model="gpt-4o",
+            model, response = LLMService._chat_completion(
+                client,
+                route["model"],
                 messages=messages,
-                temperature=settings["temperature"],
-                max_tokens=settings["max_tokens"]
+                temperature=route["temperature"],
+                max_tokens=route["max_tokens"]
             )
+            logger.debug("Generated %s response with %s", route["request_class"], model)
             
+            reply = response.choices[0].message.content
+            if response_cache is not None and reply:
+                response_cache.store(cache_key, query_embedding, reply)
+            return reply
+        except Exception as e:
+            logger.error("Error generating response: %s", e)
+            return LLMService.ERROR_REPLY
+    
+    @staticmethod
+    @traced("LLMService.generate_response")
+    async def agenerate_response(user_message, style, rag_context=None, history=None):
+        """Async counterpart of generate_response for the ASGI path
+        
+        style is a BotStyle the caller has already loaded, so no database access
+        happens here. The response cache lookup runs in a worker thread because
+        the embedding cache can read from disk.
+        """
+        route = ModelRouter.route(style, user_message, rag_context)
+        date_info, date_prompt = LLMService._date_context()
+        
+        response_cache, cache_key, query_embedding, cached_reply = await asyncio.to_thread(
+            LLMService._lookup_cached_reply, user_message, style, route["model"], rag_context, date_info, history
+        )
+        if cached_reply is not None:
+            return cached_reply
+        
+        client = LLMService.get_async_client()
+        if not client:
+            return "抱歉，無法連接 AI 服務，請檢查 API 設定。"
+        
+        messages = LLMService._assemble_prompt(style, date_prompt, user_message, rag_context, history)
+        
+        try:
+            model, response = await LLMService._achat_completion(
+                client,
+                route["model"],
+                messages=messages,
+                temperature=route["temperature"],
+                max_tokens=route["max_tokens"]
+            )
+            logger.debug("Generated %s response with %s", route["request_class"], model)
+            
+            reply = response.choices[0].message.content
+            if response_cache is not None and reply:
+                response_cache.store(cache_key, query_embedding, reply)
+            return reply
+        except Exception as e:
+            logger.error("Error generating response: %s", e)
+            return LLMService.ERROR_REPLY
+    
+    @staticmethod
+    def stream_response(user_message, style_name=None, rag_context=None, history=None):
+        """Generate a response like generate_response, yielding text as the model produces it"""
+        style = LLMService.get_bot_style(style_name)
+        route = ModelRouter.route(style, user_message, rag_context)
+        date_info, date_prompt = LLMService._date_context()
+        
+        response_cache, cache_key, query_embedding, cached_reply = LLMService._lookup_cached_reply(
+            user_message, style, route["model"], rag_context, date_info, history
+        )
+        if cached_reply is not None:
+            yield cached_reply
+            return
+        
+        client = LLMService.get_client()
+        if not client:
+            yield "抱歉，無法連接 AI 服務，請檢查 API 設定。"
+            return
+        
+        messages = LLMService._assemble_prompt(style, date_prompt, user_message, rag_context, history)
+        
+        parts = []
+        usage = None
+        started = time.monotonic()
+        try:
+            # Only opening the stream is retried; text already sent cannot be taken back
+            model, stream = LLMService._chat_completion(
+                client,
+                route["model"],
+                messages=messages,
+                temperature=route["temperature"],
+                max_tokens=route["max_tokens"],
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            with stream:
+                for chunk in stream:
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        parts.append(delta)
+                        yield delta
+            ModelRouter.record(model, time.monotonic() - started, usage)
+            record_chat_usage(model, usage)
+        except Exception as e:
+            logger.error("Error streaming response: %s", e)
+            if not parts:
+                yield LLMService.ERROR_REPLY
+            return
+        
+        reply = "".join(parts)
+        if response_cache is not None and reply:
+            response_cache.store(cache_key, query_embedding, reply)
+    
+    @staticmethod
+    def summarize_conversation(previous_summary, messages):
+        """Fold older conversation messages into a short rolling summary, or return None on failure"""
+        client = LLMService.get_client()
+        if not client:
+            return None
+        
+        transcript = "\n".join(
+            f"{'用戶' if message['role'] == 'user' else '機器人'}：{message['content']}" for message in messages
+        )
+        prompt = (
+            "請將以下對話內容整合進既有摘要，以繁體中文寫成不超過 200 字的摘要，"
+            "保留用戶的需求、偏好與重要事實。\n\n"
+            f"既有摘要：{previous_summary or '（無）'}\n\n新的對話：\n{transcript}"
+        )
+        try:
+            _, response = LLMService._chat_completion(
+                client,
+                ModelRouter.route(None, "")["model"],
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.3,
+                max_tokens=400
+            )
             return response.choices[0].message.content
         except Exception as e:
-            logger.error(f"Error generating response: {e}")
-            return f"抱歉，生成回應時發生錯誤：{str(e)}"
+            logger.error("Error summarizing conversation: %s", e)
+            return None
+    
+    @staticmethod
+    def _response_cache_key(user_message, style, model, rag_context, date_info):
+        """Get the response cache partition key and the query embedding for a message
+        
+        The embedding is only taken from the embedding cache, where the RAG search
+        for the same message has usually just put it; it is None otherwise.
+        """
+        # Import here to avoid circular imports
+        from rag_service import RAGService
+        
+        query_embedding = get_embedding_cache().peek(user_message, RAGService.EMBEDDING_MODEL)
+        context_hash = hashlib.sha256(rag_context.encode("utf-8")).hexdigest() if rag_context else None
+        return (style.name, model, context_hash, date_info["iso_date"]), query_embedding
     
     @staticmethod
     def validate_api_key(api_key):
         """Validate that the provided OpenAI API key works"""
         try:
-            client = OpenAI(api_key=api_key)
-            # Make a small request to validate the key
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": "Hello"}],
-                max_tokens=5
-            )
+            # Use a short-lived client so a candidate key never replaces the pooled one
+            with LLMService._build_client(api_key, LLMService._connection_settings()) as client:
+                # Make a small request to validate the key; its own breaker keeps a bad
+                # candidate key from opening the circuit used for user traffic
+                deadline, max_retries = LLMService._retry_settings()
+                call_with_resilience(
+                    "validate",
+                    lambda timeout: client.chat.completions.create(
+                        model=ModelRouter.default_model(),
+                        messages=[{"role": "user", "content": "Hello"}],
+                        max_tokens=5,
+                        timeout=timeout
+                    ),
+                    deadline,
+                    max_retries
+                )
             return True, "API key is valid"
         except Exception as e:
-            logger.error(f"API key validation error: {e}")
+            logger.error("API key validation error: %s", e)
             return False, f"API key validation failed: {str(e)}"
\ No newline at end of file
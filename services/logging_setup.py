@@ -0,0 +1,271 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Chatty third-party loggers, quieted unless LOG_LEVELS says otherwise
+DEFAULT_MODULE_LEVELS = {
+    "urllib3": "WARNING",
+    "httpx": "WARNING",
+    "httpcore": "WARNING",
+    "openai": "WARNING",
+    "faiss": "WARNING",
+}
+
+# Credentials that must never reach a log line
+SECRET_PATTERNS = [
+    (re.compile(r"sk-[A-Za-z0-9_\-]{16,}"), "sk-***"),
+    (re.compile(r"(?i)(bearer\s+)[A-Za-z0-9._\-+/=]{16,}"), r"\1***"),
+]
+
+_correlation_id = contextvars.ContextVar("correlation_id", default=None)
+_listener = None
+
+
+def new_correlation_id():
+    return uuid.uuid4().hex[:16]
+
+
+def get_correlation_id():
+    """Get the correlation ID of the request or event being handled, if any"""
+    return _correlation_id.get()
+
+
+@contextmanager
+def correlation(correlation_id=None):
+    """Tag every log record emitted inside the block with a correlation ID"""
+    token = _correlation_id.set(correlation_id or new_correlation_id())
+    try:
+        yield _correlation_id.get()
+    finally:
+        _correlation_id.reset(token)
+
+
+class RedactedText:
+    """A user message passed as a log argument, rendered according to LOG_MESSAGE_BODIES
+
+    full: the text as is; redact (default): only its length, except for a
+    LOG_BODY_SAMPLE_RATE fraction of messages logged in full. Rendering happens
+    only if the record is actually emitted.
+    """
+
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        text = self.text or ""
+        if os.environ.get("LOG_MESSAGE_BODIES", "redact").lower() == "full":
+            return text
+        sample_rate = float(os.environ.get("LOG_BODY_SAMPLE_RATE", "0"))
+        if sample_rate > 0 and random.random() < sample_rate:
+            return text
+        return f"<{len(text)} chars>"
+
+    __repr__ = __str__
+
+
+def redact(text):
+    """Wrap a message body for logging (see RedactedText)"""
+    return RedactedText(text)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Queue records for the listener thread, rendered and tagged in the thread that logged them
+
+    The message is formatted only here, after the level check, so records that are
+    filtered out cost no formatting. Credentials are masked and the correlation ID
+    of the current context is attached.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        message = record.getMessage()
+        for pattern, replacement in SECRET_PATTERNS:
+            message = pattern.sub(replacement, message)
+        record.msg = record.message = message
+        record.args = None
+        record.correlation_id = _correlation_id.get()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        correlation_id = getattr(record, "correlation_id", None)
+        if correlation_id:
+            entry["correlation_id"] = correlation_id
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """Plain text with the correlation ID, for local development"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(correlation_id)s] %(message)s")
+
+    def format(self, record):
+        if not getattr(record, "correlation_id", None):
+            record.correlation_id = "-"
+        return super().format(record)
+
+
+class DatabaseLogHandler(logging.Handler):
+    """Write records to the LogEntry table in batches
+
+    Runs in the queue listener thread, so request threads never wait on the
+    database. A batch is written once LOG_DB_BATCH_SIZE records are pending, when
+    a record arrives LOG_DB_FLUSH_SECONDS after the last write, and at exit.
+    """
+
+    # Never store the handler's own database traffic, or each write would log another
+    IGNORED_PREFIXES = ("sqlalchemy", __name__)
+
+    def __init__(self, level, batch_size=50, flush_interval=5.0):
+        super().__init__(level)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._flushed_at = time.monotonic()
+
+    def emit(self, record):
+        if record.name.startswith(self.IGNORED_PREFIXES):
+            return
+        message = record.getMessage()
+        correlation_id = getattr(record, "correlation_id", None)
+        if correlation_id:
+            message = f"[{correlation_id}] {message}"
+        if record.exc_text:
+            message = f"{message}\n{record.exc_text}"
+        self._pending.append({
+            "level": record.levelname[:10],
+            "message": message,
+            "module": record.name[:64],
+            "timestamp": datetime.utcfromtimestamp(record.created),
+        })
+        if len(self._pending) >= self.batch_size or time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        rows, self._pending = self._pending, []
+        self._flushed_at = time.monotonic()
+        if not rows:
+            return
+        try:
+            # Import here: logging is configured before the app and models exist
+            from app import app, db
+            import models
+
+            with app.app_context(), db.engine.begin() as conn:
+                conn.execute(models.LogEntry.__table__.insert(), rows)
+        except Exception:
+            self.handleError(logging.makeLogRecord({"msg": f"Dropped {len(rows)} log entries"}))
+
+
+def init_app(app):
+    """Give each Flask request a correlation ID (X-Request-ID if the caller sent one)"""
+    from flask import g, request
+
+    @app.before_request
+    def bind_correlation_id():
+        g.correlation_token = _correlation_id.set(request.headers.get("X-Request-ID") or new_correlation_id())
+
+    @app.after_request
+    def add_request_id_header(response):
+        correlation_id = _correlation_id.get()
+        if correlation_id:
+            response.headers.setdefault("X-Request-ID", correlation_id)
+        return response
+
+    @app.teardown_request
+    def unbind_correlation_id(exc):
+        token = g.pop("correlation_token", None)
+        if token is not None:
+            _correlation_id.reset(token)
+
+
+def _parse_module_levels(spec):
+    """Parse LOG_LEVELS ("module=LEVEL,other.module=LEVEL") into a dict"""
+    levels = {}
+    for item in (spec or "").split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging():
+    """Route all logging through a queue to JSON (or text) output and, optionally, the database
+
+    Settings come from the environment, since logging starts before the database:
+    LOG_LEVEL (root level, default INFO), LOG_LEVELS (per-module levels), LOG_FORMAT
+    (json or text), LOG_DB_LEVEL (store records at or above this level in LogEntry).
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    root = logging.getLogger()
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    module_levels = {**DEFAULT_MODULE_LEVELS, **_parse_module_levels(os.environ.get("LOG_LEVELS"))}
+    for name, level in module_levels.items():
+        logging.getLogger(name).setLevel(level)
+
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if os.environ.get("LOG_FORMAT", "json").lower() == "json" else TextFormatter())
+    handlers = [output]
+
+    db_level = os.environ.get("LOG_DB_LEVEL", "")
+    if db_level:
+        handlers.append(DatabaseLogHandler(
+            db_level.upper(),
+            batch_size=int(os.environ.get("LOG_DB_BATCH_SIZE", "50")),
+            flush_interval=float(os.environ.get("LOG_DB_FLUSH_SECONDS", "5"))
+        ))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = ContextQueueHandler(log_queue)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_stop_listener)
+
+
+def _stop_listener():
+    """Drain the queue and write any batched database records"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.flush()
+    _listener = None
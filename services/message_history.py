@@ -0,0 +1,127 @@
+import base64
+import logging
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import and_, or_, text
+
+from app import db
+from models import ChatMessage, LineUser
+from routes.utils.config_service import ConfigManager
+
+logger = logging.getLogger(__name__)
+
+# Cached message totals: line_user_id (None for all users) -> (count, cached_at)
+_count_cache = {}
+_count_cache_lock = threading.Lock()
+
+
+class MessageHistoryService:
+    """Keyset-paginated access to the chat history for the admin pages"""
+
+    @staticmethod
+    def encode_cursor(message):
+        """Encode a message's (timestamp, id) position as an opaque URL-safe cursor, or None without a timestamp"""
+        if message.timestamp is None:
+            return None
+        raw = f"{message.timestamp.isoformat()}|{message.id}"
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Decode a cursor into (timestamp, id), or None if it is malformed"""
+        if not cursor:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+            timestamp, message_id = raw.rsplit("|", 1)
+            return datetime.fromisoformat(timestamp), int(message_id)
+        except (ValueError, UnicodeDecodeError):
+            logger.warning("Ignoring invalid message history cursor: %r", cursor)
+            return None
+
+    @staticmethod
+    def get_page(line_user_id=None, before=None, after=None, per_page=50):
+        """Get one page of messages, newest first, before or after a cursor
+
+        Returns (messages, newer_cursor, older_cursor); a cursor is None when
+        there is no page in that direction. Legacy rows without a timestamp have
+        no position in the (timestamp, id) order and are left out.
+        """
+        query = ChatMessage.query.filter(ChatMessage.timestamp.isnot(None))
+        if line_user_id:
+            query = query.filter(ChatMessage.line_user_id == line_user_id)
+
+        before_key = MessageHistoryService.decode_cursor(before)
+        after_key = MessageHistoryService.decode_cursor(after)
+
+        if after_key:
+            # Walk forward in time from the cursor, then flip back to newest-first
+            timestamp, message_id = after_key
+            query = query.filter(or_(
+                ChatMessage.timestamp > timestamp,
+                and_(ChatMessage.timestamp == timestamp, ChatMessage.id > message_id)
+            ))
+            rows = query.order_by(ChatMessage.timestamp.asc(), ChatMessage.id.asc()).limit(per_page + 1).all()
+            has_newer = len(rows) > per_page
+            messages = list(reversed(rows[:per_page]))
+            has_older = True
+        else:
+            if before_key:
+                timestamp, message_id = before_key
+                query = query.filter(or_(
+                    ChatMessage.timestamp < timestamp,
+                    and_(ChatMessage.timestamp == timestamp, ChatMessage.id < message_id)
+                ))
+            rows = query.order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc()).limit(per_page + 1).all()
+            has_older = len(rows) > per_page
+            messages = rows[:per_page]
+            has_newer = before_key is not None
+
+        if not messages:
+            return messages, None, None
+
+        newer_cursor = MessageHistoryService.encode_cursor(messages[0]) if has_newer else None
+        older_cursor = MessageHistoryService.encode_cursor(messages[-1]) if has_older else None
+        return messages, newer_cursor, older_cursor
+
+    @staticmethod
+    def count_messages(line_user_id=None):
+        """Get the (possibly approximate) number of messages, cached for MESSAGE_COUNT_CACHE_TTL seconds"""
+        ttl = float(ConfigManager.get("MESSAGE_COUNT_CACHE_TTL", "60"))
+        now = time.time()
+        with _count_cache_lock:
+            cached = _count_cache.get(line_user_id)
+        if cached and now - cached[1] < ttl:
+            return cached[0]
+
+        count = None
+        if line_user_id is None and db.engine.dialect.name == "postgresql":
+            # The planner's row estimate avoids a full COUNT(*) over the table
+            estimate = db.session.execute(
+                text("SELECT reltuples::bigint FROM pg_class WHERE relname = 'chat_message'")
+            ).scalar()
+            if estimate is not None and estimate >= 0:
+                count = int(estimate)
+        if count is None:
+            query = ChatMessage.query
+            if line_user_id:
+                query = query.filter(ChatMessage.line_user_id == line_user_id)
+            count = query.count()
+
+        with _count_cache_lock:
+            _count_cache[line_user_id] = (count, now)
+        return count
+
+    @staticmethod
+    def search_users(term, limit=10):
+        """Find LINE users whose ID starts with term or whose display name contains it"""
+        term = (term or "").strip()
+        if not term:
+            return []
+        escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return LineUser.query.filter(or_(
+            LineUser.line_user_id.like(f"{escaped}%", escape="\\"),
+            LineUser.display_name.ilike(f"%{escaped}%", escape="\\")
+        )).order_by(LineUser.last_interaction.desc()).limit(limit).all()
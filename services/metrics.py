@@ -0,0 +1,89 @@
+import logging
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess,
+)
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+# Upstream calls take seconds, not milliseconds
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+# Pool checkouts should be nearly instant; anything slow means the pool is exhausted
+POOL_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "HTTP requests handled", ["endpoint", "method", "status"]
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP request handling time", ["endpoint", "method"]
+)
+OPENAI_REQUEST_SECONDS = Histogram(
+    "openai_request_duration_seconds", "OpenAI API call time, including retries", ["operation", "model"],
+    buckets=SLOW_BUCKETS
+)
+OPENAI_REQUEST_ERRORS = Counter(
+    "openai_request_errors_total", "OpenAI API calls that failed after their retries", ["operation", "model"]
+)
+RAG_SEARCH_SECONDS = Histogram(
+    "rag_search_duration_seconds", "Knowledge base search time, including the query embedding",
+    buckets=SLOW_BUCKETS
+)
+RAG_INDEX_VECTORS = Gauge(
+    "rag_index_vectors", "Vectors in the loaded FAISS index", multiprocess_mode="livemax"
+)
+CONFIG_CACHE_LOOKUPS = Counter(
+    "config_cache_lookups_total",
+    "ConfigManager snapshot checks against the database: revalidated (generation unchanged) or reloaded",
+    ["result"]
+)
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    "db_pool_checkout_wait_seconds", "Time spent waiting for a database connection from the pool",
+    buckets=POOL_BUCKETS
+)
+LINE_MESSAGES_COALESCED = Counter(
+    "line_messages_coalesced_total", "LINE messages answered together with an earlier message of the same burst"
+)
+DB_POOL_CHECKOUT_TIMEOUTS = Counter(
+    "db_pool_checkout_timeouts_total", "Database connection checkouts that failed or timed out"
+)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each connection checkout waits"""
+
+    # Keep pool logging under the sqlalchemy logger, like the stock pools
+    _sqla_logger_namespace = "sqlalchemy.pool.impl.TimedQueuePool"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            DB_POOL_CHECKOUT_TIMEOUTS.inc()
+            raise
+        finally:
+            DB_POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+
+
+def observe_openai_call(operation, model, seconds, error=False):
+    """Record the duration or failure of one OpenAI call"""
+    if error:
+        OPENAI_REQUEST_ERRORS.labels(operation, model).inc()
+    else:
+        OPENAI_REQUEST_SECONDS.labels(operation, model).observe(seconds)
+
+
+def render_metrics():
+    """Render all metrics in the Prometheus text format, merged across gunicorn workers when multiprocess
+
+    Multiprocess mode is on when PROMETHEUS_MULTIPROC_DIR is set (see gunicorn.conf.py).
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,94 @@
+import logging
+import threading
+from collections import deque
+
+from routes.utils.config_service import ConfigManager, get_llm_settings
+from services.job_queue import LATENCY_WINDOW, summarize_latencies
+from services.metrics import observe_openai_call
+
+logger = logging.getLogger(__name__)
+
+# the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
+# do not change this unless explicitly requested by the user
+DEFAULT_MODEL = "gpt-4o"
+
+# Request classes, in the order they are checked
+REQUEST_CLASSES = ("rag", "long", "chat")
+
+
+class ModelRouter:
+    """Pick the model and generation parameters for each request
+
+    Precedence: a setting pinned on the bot style, then the route configured for
+    the request class (ROUTE_<CLASS>_MODEL / ROUTE_<CLASS>_MAX_TOKENS), then the
+    global OPENAI_MODEL / OPENAI_TEMPERATURE / OPENAI_MAX_TOKENS.
+    """
+
+    _stats = {}  # model -> {"latencies": deque, "calls", "errors", "prompt_tokens", "completion_tokens"}
+    _stats_lock = threading.Lock()
+
+    @staticmethod
+    def default_model():
+        """Get the model used when neither the style nor the route chooses one"""
+        return ConfigManager.get("OPENAI_MODEL", DEFAULT_MODEL) or DEFAULT_MODEL
+
+    @staticmethod
+    def classify(user_message, rag_context=None):
+        """Classify a request as rag (knowledge base hit), long (long message) or chat"""
+        if rag_context:
+            return "rag"
+        if len(user_message or "") >= int(ConfigManager.get("ROUTE_LONG_MESSAGE_CHARS", "200")):
+            return "long"
+        return "chat"
+
+    @staticmethod
+    def route(style, user_message, rag_context=None):
+        """Get the request class, model, temperature and max_tokens for a request"""
+        request_class = ModelRouter.classify(user_message, rag_context)
+        settings = get_llm_settings()
+        prefix = f"ROUTE_{request_class.upper()}"
+
+        route_max_tokens = ConfigManager.get(f"{prefix}_MAX_TOKENS", "")
+        return {
+            "request_class": request_class,
+            "model": (style.model if style and style.model else None)
+                     or ConfigManager.get(f"{prefix}_MODEL", "")
+                     or ModelRouter.default_model(),
+            "temperature": style.temperature if style and style.temperature is not None else settings["temperature"],
+            "max_tokens": (style.max_tokens if style and style.max_tokens else None)
+                          or (int(route_max_tokens) if route_max_tokens else settings["max_tokens"]),
+        }
+
+    @staticmethod
+    def record(model, latency, usage=None, error=False):
+        """Record the latency (seconds) and token usage of one completion"""
+        observe_openai_call("chat", model, latency, error)
+        with ModelRouter._stats_lock:
+            stats = ModelRouter._stats.get(model)
+            if stats is None:
+                stats = {
+                    "latencies": deque(maxlen=LATENCY_WINDOW),
+                    "calls": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                }
+                ModelRouter._stats[model] = stats
+            stats["calls"] += 1
+            if error:
+                stats["errors"] += 1
+                return
+            stats["latencies"].append(latency)
+            if usage is not None:
+                stats["prompt_tokens"] += usage.prompt_tokens or 0
+                stats["completion_tokens"] += usage.completion_tokens or 0
+
+    @staticmethod
+    def get_stats():
+        """Get per-model call counts, token usage and latency percentiles"""
+        with ModelRouter._stats_lock:
+            snapshot = {
+                model: (list(stats["latencies"]), {k: v for k, v in stats.items() if k != "latencies"})
+                for model, stats in ModelRouter._stats.items()
+            }
+        return {
+            model: {**counters, "latency": summarize_latencies(latencies)}
+            for model, (latencies, counters) in snapshot.items()
+        }
@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+# Transient upstream errors worth retrying: 429, timeouts, connection failures and 5xx
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Fail fast while an upstream keeps failing, probing it again after a cool-down
+
+    closed: calls go through; consecutive transient failures are counted.
+    open: calls are rejected until reset_timeout seconds have passed.
+    half_open: one probe call goes through; its outcome closes or re-opens the circuit.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = float(reset_timeout)
+
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "successes": 0, "failures": 0, "retries": 0, "rejected": 0, "opened": 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def allow(self):
+        """Check whether a call may go through, moving an expired open circuit to half-open"""
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self._state == self.CLOSED or (self._state == self.HALF_OPEN and not self._probe_in_flight):
+                self._probe_in_flight = self._state == self.HALF_OPEN
+                self._counters["calls"] += 1
+                return True
+            self._counters["rejected"] += 1
+            return False
+
+    def record_success(self):
+        """Record a call that reached the upstream and got an answer"""
+        with self._lock:
+            self._counters["successes"] += 1
+            self._failures = 0
+            self._probe_in_flight = False
+            if self._state != self.CLOSED:
+                logger.info("Circuit '%s' closed", self.name)
+            self._state = self.CLOSED
+
+    def record_rejected(self):
+        """Record a call the upstream answered with a non-retryable error (bad request, authentication)
+
+        The upstream is reachable but the call says nothing about its health, so the
+        failure count is left as it is; a half-open probe slot is freed for the next call.
+        """
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        """Record a call that failed with a transient upstream error after its retries"""
+        with self._lock:
+            self._counters["failures"] += 1
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self._counters["opened"] += 1
+                    logger.warning("Circuit '%s' opened after %s failures", self.name, self._failures)
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def record_retry(self):
+        """Count a retried attempt"""
+        with self._lock:
+            self._counters["retries"] += 1
+
+    def configure(self, failure_threshold, reset_timeout):
+        """Apply changed admin settings, keeping the current state and counters"""
+        with self._lock:
+            self.failure_threshold = max(1, int(failure_threshold))
+            self.reset_timeout = float(reset_timeout)
+
+    def stats(self):
+        """Get the breaker state and call counters"""
+        with self._lock:
+            return {
+                "state": self._state,
+                "consecutive_failures": self._failures,
+                "failure_threshold": self.failure_threshold,
+                "reset_timeout": self.reset_timeout,
+                **self._counters,
+            }
+
+
+_breakers = {}
+_breakers_generation = None
+_breakers_lock = threading.Lock()
+
+
+def _breaker_settings():
+    """Get the configured (failure threshold, reset timeout) for circuit breakers"""
+    # Import here to avoid circular imports
+    from routes.utils.config_service import ConfigManager
+
+    return (
+        int(ConfigManager.get("CIRCUIT_FAILURE_THRESHOLD", "5")),
+        float(ConfigManager.get("CIRCUIT_RESET_SECONDS", "30")),
+    )
+
+
+def get_breaker(name):
+    """Get the process-wide circuit breaker for an upstream, creating it from config on first use
+
+    When the config generation changes, every breaker picks up the current
+    CIRCUIT_* settings, so admin changes apply without a restart.
+    """
+    # Import here to avoid circular imports
+    from routes.utils.config_service import ConfigManager
+
+    global _breakers_generation
+    generation = ConfigManager.generation()
+    breaker = _breakers.get(name)
+    if breaker is None or generation != _breakers_generation:
+        with _breakers_lock:
+            settings = _breaker_settings()
+            if generation != _breakers_generation:
+                for existing in _breakers.values():
+                    existing.configure(*settings)
+                _breakers_generation = generation
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(name, *settings)
+                _breakers[name] = breaker
+    return breaker
+
+
+def call_with_resilience(name, func, deadline, max_retries):
+    """Call func(timeout=...) through the named circuit breaker, within a deadline
+
+    Transient errors are retried with jittered exponential backoff while both
+    retries and time remain; each attempt's timeout is the time left until the
+    deadline. Other errors (bad request, authentication) are raised at once and
+    leave the breaker's failure count unchanged, since the upstream itself answered.
+    """
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise CircuitOpenError(f"Circuit '{name}' is open")
+
+    expires_at = time.monotonic() + deadline
+    attempt = 0
+    settled = False
+    try:
+        while True:
+            try:
+                result = func(timeout=max(0.1, expires_at - time.monotonic()))
+            except RETRYABLE_ERRORS as e:
+                delay = min(30.0, 0.5 * 2 ** attempt) * (0.5 + random.random())
+                if attempt >= max_retries or time.monotonic() + delay >= expires_at:
+                    settled = True
+                    breaker.record_failure()
+                    raise
+                attempt += 1
+                breaker.record_retry()
+                logger.warning("%s call failed (%s), retry %d/%d in %.1fs", name, e, attempt, max_retries, delay)
+                time.sleep(delay)
+                continue
+            settled = True
+            breaker.record_success()
+            return result
+    finally:
+        # Anything else (bad request, authentication, cancellation) leaves the failure
+        # count alone but must still free a half-open probe slot
+        if not settled:
+            breaker.record_rejected()
+
+
+async def acall_with_resilience(name, func, deadline, max_retries):
+    """Async counterpart of call_with_resilience: func(timeout=...) returns an awaitable
+
+    Shares the named circuit breaker with the synchronous path.
+    """
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise CircuitOpenError(f"Circuit '{name}' is open")
+
+    expires_at = time.monotonic() + deadline
+    attempt = 0
+    settled = False
+    try:
+        while True:
+            try:
+                result = await func(timeout=max(0.1, expires_at - time.monotonic()))
+            except RETRYABLE_ERRORS as e:
+                delay = min(30.0, 0.5 * 2 ** attempt) * (0.5 + random.random())
+                if attempt >= max_retries or time.monotonic() + delay >= expires_at:
+                    settled = True
+                    breaker.record_failure()
+                    raise
+                attempt += 1
+                breaker.record_retry()
+                logger.warning("%s call failed (%s), retry %d/%d in %.1fs", name, e, attempt, max_retries, delay)
+                await asyncio.sleep(delay)
+                continue
+            settled = True
+            breaker.record_success()
+            return result
+    finally:
+        # Anything else (bad request, authentication, cancellation) leaves the failure
+        # count alone but must still free a half-open probe slot
+        if not settled:
+            breaker.record_rejected()
+
+
+def get_resilience_stats():
+    """Get the state and counters of every circuit breaker"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.stats() for breaker in breakers}
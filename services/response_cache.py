@@ -0,0 +1,139 @@
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Semantic cache of bot replies, matched by query embedding similarity
+
+    Entries are partitioned by an exact key (style, model, RAG context hash,
+    date bucket); within a partition, a stored reply is reused when the cosine
+    similarity between the new query and the cached query passes the threshold.
+    """
+
+    def __init__(self, max_entries=1000, ttl_seconds=3600, threshold=0.95):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl_seconds = float(ttl_seconds)
+        self.threshold = float(threshold)
+
+        self._entries = OrderedDict()  # entry id -> (key, unit vector, reply, created_at)
+        self._partitions = {}  # key -> set of entry ids
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def configure(self, max_entries, ttl_seconds, threshold):
+        """Apply changed admin settings without dropping cached replies"""
+        with self._lock:
+            self.max_entries = max(1, int(max_entries))
+            self.ttl_seconds = float(ttl_seconds)
+            self.threshold = float(threshold)
+            self._evict()
+
+    @staticmethod
+    def _unit(embedding):
+        """Normalise an embedding so that a dot product gives cosine similarity"""
+        vector = np.asarray(embedding, dtype='float32')
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, key, embedding):
+        """Get the cached reply for the most similar query under key, or None"""
+        query = self._unit(embedding)
+        now = time.time()
+
+        with self._lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._partitions.get(key, ())):
+                _, vector, _, created_at = self._entries[entry_id]
+                if now - created_at > self.ttl_seconds:
+                    self._remove(entry_id)
+                    continue
+                score = float(np.dot(query, vector))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                self._counters["misses"] += 1
+                return None
+
+            self._entries.move_to_end(best_id)
+            self._counters["hits"] += 1
+            logger.debug("Response cache hit with similarity %.3f", best_score)
+            return self._entries[best_id][2]
+
+    def store(self, key, embedding, reply):
+        """Cache a reply for a query"""
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = (key, self._unit(embedding), reply, time.time())
+            self._partitions.setdefault(key, set()).add(entry_id)
+            self._counters["stores"] += 1
+            self._evict()
+
+    def _remove(self, entry_id):
+        """Drop an entry (lock held)"""
+        key = self._entries.pop(entry_id)[0]
+        partition = self._partitions.get(key)
+        if partition is not None:
+            partition.discard(entry_id)
+            if not partition:
+                del self._partitions[key]
+
+    def _evict(self):
+        """Drop least recently used entries beyond the size limit (lock held)"""
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self._counters["evictions"] += 1
+
+    def clear(self):
+        """Drop all cached replies"""
+        with self._lock:
+            self._entries.clear()
+            self._partitions.clear()
+
+    def stats(self):
+        """Get hit/miss counters and the hit rate"""
+        with self._lock:
+            counters = dict(self._counters)
+            size = len(self._entries)
+
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            **counters,
+            "size": size,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "threshold": self.threshold,
+            "hit_rate": round(counters["hits"] / lookups, 3) if lookups else 0.0,
+        }
+
+
+_cache = ResponseCache()
+
+
+def get_response_cache():
+    """Get the process-wide response cache, or None if it is disabled in the settings"""
+    # Import here to avoid circular imports
+    from routes.utils.config_service import ConfigManager
+
+    if ConfigManager.get("RESPONSE_CACHE_ENABLED", "False").lower() != "true":
+        return None
+
+    max_entries = int(ConfigManager.get("RESPONSE_CACHE_SIZE", "1000"))
+    ttl_seconds = float(ConfigManager.get("RESPONSE_CACHE_TTL", "3600"))
+    threshold = float(ConfigManager.get("RESPONSE_CACHE_THRESHOLD", "0.95"))
+    if (max_entries, ttl_seconds, threshold) != (_cache.max_entries, _cache.ttl_seconds, _cache.threshold):
+        _cache.configure(max_entries, ttl_seconds, threshold)
+    return _cache
+
+
+def get_response_cache_stats():
+    """Get response cache statistics, whether or not the cache is currently enabled"""
+    return _cache.stats()
@@ -0,0 +1,160 @@
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import db
+from models import ChatMessage, Document, MessageStat
+
+logger = logging.getLogger(__name__)
+
+
+def hour_bucket(moment):
+    """Truncate a UTC datetime to the start of its hour"""
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+class StatsService:
+    """Hourly message rollups maintained as messages are written
+
+    The rollups are only ever incremented: deleting messages or users does not
+    lower them (see migrations._backfill_message_stats).
+    """
+
+    @staticmethod
+    def _turn_values(received_at, user_messages, bot_messages, new_users):
+        """Get the row inserted for an hour's first turn and the increments applied to later ones"""
+        values = {
+            "hour": hour_bucket(received_at),
+            "user_messages": user_messages,
+            "bot_messages": bot_messages,
+            "new_users": new_users,
+        }
+        increments = {
+            "user_messages": MessageStat.user_messages + user_messages,
+            "bot_messages": MessageStat.bot_messages + bot_messages,
+            "new_users": MessageStat.new_users + new_users,
+        }
+        return values, increments
+
+    @staticmethod
+    def upsert_statement(dialect, received_at, user_messages=1, bot_messages=1, new_users=0):
+        """Get the single-statement rollup upsert for PostgreSQL and SQLite, or None for other databases"""
+        if dialect not in ("postgresql", "sqlite"):
+            return None
+        values, increments = StatsService._turn_values(received_at, user_messages, bot_messages, new_users)
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        return insert(MessageStat).values(**values).on_conflict_do_update(
+            index_elements=[MessageStat.hour], set_=increments
+        )
+
+    @staticmethod
+    def record_turn(received_at, user_messages=1, bot_messages=1, new_users=0):
+        """Add a conversation turn to its hourly rollup in the current transaction
+
+        Must be called before the caller commits, so the counters are written
+        atomically with the messages they count.
+        """
+        dialect = db.session.get_bind().dialect.name
+        statement = StatsService.upsert_statement(dialect, received_at, user_messages, bot_messages, new_users)
+        if statement is not None:
+            db.session.execute(statement)
+            return
+
+        # Other databases: update the bucket, creating it if this is the hour's first turn
+        values, increments = StatsService._turn_values(received_at, user_messages, bot_messages, new_users)
+        result = db.session.execute(
+            update(MessageStat).where(MessageStat.hour == values["hour"]).values(**increments)
+        )
+        if result.rowcount == 0:
+            db.session.add(MessageStat(**values))
+
+    @staticmethod
+    def hourly_counts(turns):
+        """Group (received_at, is_new_user) pairs into (hour, (turns, new_users)) counts, oldest hour first"""
+        counts = {}
+        for received_at, is_new_user in turns:
+            hour = hour_bucket(received_at)
+            turn_count, new_users = counts.get(hour, (0, 0))
+            counts[hour] = (turn_count + 1, new_users + (1 if is_new_user else 0))
+        return sorted(counts.items())
+
+    @staticmethod
+    def record_turns(turns):
+        """Add several (received_at, is_new_user) turns to their hourly rollups in the current transaction
+
+        Issues one statement per hour rather than one per turn.
+        """
+        for hour, (turn_count, new_users) in StatsService.hourly_counts(turns):
+            StatsService.record_turn(hour, user_messages=turn_count, bot_messages=turn_count, new_users=new_users)
+
+    @staticmethod
+    def get_totals():
+        """Get overall counters from the rollups instead of counting the message table"""
+        user_messages, bot_messages, new_users = db.session.query(
+            func.coalesce(func.sum(MessageStat.user_messages), 0),
+            func.coalesce(func.sum(MessageStat.bot_messages), 0),
+            func.coalesce(func.sum(MessageStat.new_users), 0),
+        ).one()
+        return {
+            "user_count": int(new_users),
+            "message_count": int(user_messages + bot_messages),
+            "user_messages": int(user_messages),
+            "bot_messages": int(bot_messages),
+            "document_count": Document.query.count(),
+        }
+
+    @staticmethod
+    def get_activity(days=7):
+        """Get hourly rollups for the last number of days, oldest first"""
+        since = hour_bucket(datetime.utcnow()) - timedelta(days=days)
+        rows = MessageStat.query.filter(MessageStat.hour >= since).order_by(MessageStat.hour.asc()).all()
+        return [
+            {
+                "hour": row.hour.isoformat() + "Z",
+                "user_messages": row.user_messages,
+                "bot_messages": row.bot_messages,
+                "new_users": row.new_users,
+            }
+            for row in rows
+        ]
+
+    @staticmethod
+    def get_token_usage(days=14):
+        """Get token usage and prompt measurements of bot replies, per day and per model"""
+        since = datetime.utcnow() - timedelta(days=days)
+        base = db.session.query(ChatMessage).filter(
+            ChatMessage.is_user_message.is_(False),
+            ChatMessage.timestamp >= since,
+            ChatMessage.prompt_tokens.isnot(None)
+        )
+        aggregates = (
+            func.count(ChatMessage.id),
+            func.coalesce(func.sum(ChatMessage.prompt_tokens), 0),
+            func.coalesce(func.sum(ChatMessage.completion_tokens), 0),
+            func.coalesce(func.sum(ChatMessage.embedding_tokens), 0),
+            func.avg(ChatMessage.rag_context_tokens),
+            func.avg(ChatMessage.prompt_build_ms),
+        )
+
+        def row_to_dict(row):
+            replies, prompt_tokens, completion_tokens, embedding_tokens, rag_tokens, build_ms = row
+            return {
+                "replies": int(replies),
+                "prompt_tokens": int(prompt_tokens),
+                "completion_tokens": int(completion_tokens),
+                "embedding_tokens": int(embedding_tokens),
+                "avg_rag_context_tokens": round(float(rag_tokens), 1) if rag_tokens is not None else None,
+                "avg_prompt_build_ms": round(float(build_ms), 3) if build_ms is not None else None,
+            }
+
+        day = func.date(ChatMessage.timestamp)
+        by_day = base.with_entities(day, *aggregates).group_by(day).order_by(day.desc()).all()
+        by_model = base.with_entities(ChatMessage.model, *aggregates).group_by(ChatMessage.model).all()
+        return {
+            "days": days,
+            "totals": row_to_dict(base.with_entities(*aggregates).one()),
+            "by_day": [{"date": str(row[0]), **row_to_dict(row[1:])} for row in by_day],
+            "by_model": [{"model": row[0] or "-", **row_to_dict(row[1:])} for row in by_model],
+        }
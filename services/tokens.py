@@ -0,0 +1,70 @@
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# tiktoken is optional; without it token counts are estimated from character classes
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# CJK ideographs, kana, hangul and full-width punctuation
+_CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+_encoding = None
+_encoding_failed = False
+
+
+def _get_encoding():
+    """Get the tiktoken encoding used by OpenAI's current models, if available"""
+    global _encoding, _encoding_failed
+
+    if tiktoken is None or _encoding_failed:
+        return None
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # tiktoken downloads encodings on first use, which fails offline
+            logger.warning("tiktoken encoding unavailable, estimating token counts: %s", e)
+            _encoding_failed = True
+            return None
+    return _encoding
+
+
+def estimate_tokens(text):
+    """Count (or conservatively estimate) the number of tokens in a text"""
+    if not text:
+        return 0
+
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    # Chinese text averages a little over one token per character, other text about four characters per token
+    cjk_chars = len(_CJK_PATTERN.findall(text))
+    other_chars = len(text) - cjk_chars
+    return int(cjk_chars * 1.5 + other_chars / 4) + 1
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut a text down to at most max_tokens (counted or estimated), keeping its beginning"""
+    if max_tokens <= 0 or not text:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    encoding = _get_encoding()
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+    # Binary search for the longest prefix whose estimate fits
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
@@ -0,0 +1,308 @@
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import requests
+
+from routes.utils.config_service import ConfigManager
+from services.job_queue import LATENCY_WINDOW, summarize_latencies
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "flypig-line-bot"
+
+# OTLP span kinds and status codes used in the export
+SPAN_KIND_INTERNAL = 1
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Span:
+    """One timed stage of a trace"""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "duration", "attributes", "error")
+
+    def __init__(self, trace_id, parent_id, name, attributes):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.duration = None
+        self.attributes = attributes
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_otlp(self):
+        """Get the span in the OTLP/JSON span format"""
+        end_ns = self.start_ns + int((self.duration or 0) * 1e9)
+        otlp = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(end_ns),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": STATUS_ERROR, "message": self.error} if self.error else {"code": STATUS_OK},
+        }
+        if self.parent_id:
+            otlp["parentSpanId"] = self.parent_id
+        return otlp
+
+
+def _otlp_attribute(key, value):
+    """Encode an attribute as an OTLP key/value pair"""
+    if isinstance(value, bool):
+        encoded = {"boolValue": value}
+    elif isinstance(value, int):
+        encoded = {"intValue": str(value)}
+    elif isinstance(value, float):
+        encoded = {"doubleValue": value}
+    else:
+        encoded = {"stringValue": str(value)}
+    return {"key": key, "value": encoded}
+
+
+def to_otlp_json(spans):
+    """Wrap spans in an OTLP/JSON ExportTraceServiceRequest body"""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{
+                "scope": {"name": __name__},
+                "spans": [span.to_otlp() for span in spans],
+            }],
+        }]
+    }
+
+
+# The active span: a Span, False inside an unsampled trace, or None outside any trace
+_current = contextvars.ContextVar("trace_span", default=None)
+
+
+class Tracer:
+    """Process-wide store of finished spans
+
+    Keeps the last TRACE_BUFFER_SIZE spans in a ring buffer for the admin page and
+    export, and the last LATENCY_WINDOW durations of each stage for percentiles.
+    """
+
+    _spans = None
+    _stages = {}  # span name -> deque of durations in seconds
+    _lock = threading.Lock()
+
+    @staticmethod
+    def record(span):
+        """Store a finished span"""
+        with Tracer._lock:
+            if Tracer._spans is None:
+                Tracer._spans = deque(maxlen=int(ConfigManager.get("TRACE_BUFFER_SIZE", "2000")))
+            Tracer._spans.append(span)
+            durations = Tracer._stages.get(span.name)
+            if durations is None:
+                durations = Tracer._stages[span.name] = deque(maxlen=LATENCY_WINDOW)
+            durations.append(span.duration)
+        if _exporter.enabled():
+            _exporter.add(span)
+
+    @staticmethod
+    def spans():
+        """Get the buffered spans, oldest first"""
+        with Tracer._lock:
+            return list(Tracer._spans or ())
+
+    @staticmethod
+    def get_stats():
+        """Get the sampling settings and per-stage latency percentiles"""
+        with Tracer._lock:
+            stages = {name: list(durations) for name, durations in Tracer._stages.items()}
+            buffered = len(Tracer._spans or ())
+        return {
+            "sample_rate": sample_rate(),
+            "buffered_spans": buffered,
+            "export_url": _exporter.url() or None,
+            "stages": {name: summarize_latencies(durations) for name, durations in sorted(stages.items())},
+        }
+
+    @staticmethod
+    def get_recent_traces(limit=20):
+        """Get the most recent traces, newest first, each with its spans in start order"""
+        traces = OrderedDict()
+        for span in Tracer.spans():
+            traces.setdefault(span.trace_id, []).append(span)
+
+        result = []
+        for trace_id, spans in reversed(traces.items()):
+            spans.sort(key=lambda span: span.start_ns)
+            started = spans[0].start_ns
+            depths = {}
+            rows = []
+            for span in spans:
+                depth = depths.get(span.parent_id, -1) + 1
+                depths[span.span_id] = depth
+                rows.append({
+                    "name": span.name,
+                    "span_id": span.span_id,
+                    "parent_id": span.parent_id,
+                    "depth": depth,
+                    "offset_ms": round((span.start_ns - started) / 1e6, 2),
+                    "duration_ms": round(span.duration * 1000, 2),
+                    "attributes": span.attributes,
+                    "error": span.error,
+                })
+            finished = max(span.start_ns + int(span.duration * 1e9) for span in spans)
+            result.append({
+                "trace_id": trace_id,
+                "name": spans[0].name,
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(started / 1e9)),
+                "duration_ms": round((finished - started) / 1e6, 2),
+                "error": any(span.error for span in spans),
+                "spans": rows,
+            })
+            if len(result) >= limit:
+                break
+        return result
+
+    @staticmethod
+    def clear():
+        """Drop all buffered spans and stage latencies"""
+        with Tracer._lock:
+            Tracer._spans = None
+            Tracer._stages = {}
+
+
+class _Exporter:
+    """Background pusher of finished spans to an OTLP/HTTP JSON endpoint (TRACE_EXPORT_URL)"""
+
+    def __init__(self):
+        self._pending = deque(maxlen=10000)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+
+    def url(self):
+        return ConfigManager.get("TRACE_EXPORT_URL", "")
+
+    def enabled(self):
+        return bool(self.url())
+
+    def add(self, span):
+        self._pending.append(span)
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(float(ConfigManager.get("TRACE_EXPORT_INTERVAL", "5")))
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning("Error exporting trace spans: %s", e)
+
+    def flush(self):
+        """Send the pending spans in one request"""
+        spans = []
+        while self._pending:
+            spans.append(self._pending.popleft())
+        url = self.url()
+        if not spans or not url:
+            return
+        response = self._session.post(url, json=to_otlp_json(spans), timeout=10)
+        response.raise_for_status()
+
+
+_exporter = _Exporter()
+
+
+def sample_rate():
+    """Get the fraction of traces recorded (TRACE_SAMPLE_RATE, 0 disables tracing)"""
+    try:
+        return min(1.0, max(0.0, float(ConfigManager.get("TRACE_SAMPLE_RATE", "1.0"))))
+    except ValueError:
+        return 0.0
+
+
+@contextmanager
+def span(name, context=None, **attributes):
+    """Time the block as a span of the active trace, starting a trace if there is none
+
+    The sampling decision is made once per trace, at its first span; inside an
+    unsampled trace this yields None and records nothing. context continues a
+    trace started elsewhere (see current_context). The yielded Span accepts
+    extra attributes through set_attribute.
+    """
+    parent = _current.get() if context is None else context
+    if parent is None:
+        rate = sample_rate()
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            parent = False
+
+    if parent is False:
+        if _current.get() is False:
+            yield None
+            return
+        token = _current.set(False)
+        try:
+            yield None
+        finally:
+            _current.reset(token)
+        return
+
+    if isinstance(parent, Span):
+        trace_id, parent_id = parent.trace_id, parent.span_id
+    elif parent:
+        trace_id, parent_id = parent
+    else:
+        trace_id, parent_id = os.urandom(16).hex(), None
+
+    current = Span(trace_id, parent_id, name, attributes)
+    token = _current.set(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    except Exception as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.duration = time.perf_counter() - started
+        _current.reset(token)
+        Tracer.record(current)
+
+
+def traced(name):
+    """Decorator recording each call of a function (or coroutine function) as a span"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_context():
+    """Get the active trace as a picklable value, to continue it in a background job with span(context=...)"""
+    current = _current.get()
+    if isinstance(current, Span):
+        return (current.trace_id, current.span_id)
+    return current
@@ -0,0 +1,70 @@
+import contextvars
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class UsageRecord:
+    """Token usage and prompt measurements accumulated while handling one message"""
+
+    __slots__ = ("prompt_tokens", "completion_tokens", "embedding_tokens", "model",
+                 "rag_context_tokens", "prompt_build_ms")
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.embedding_tokens = 0
+        self.model = None
+        self.rag_context_tokens = None
+        self.prompt_build_ms = None
+
+    def as_columns(self):
+        """Get the values stored on the bot's ChatMessage"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+_current = contextvars.ContextVar("usage_record", default=None)
+
+
+@contextmanager
+def recording_usage():
+    """Collect usage for the calls made inside the block (one webhook event or request)"""
+    record = UsageRecord()
+    token = _current.set(record)
+    try:
+        yield record
+    finally:
+        _current.reset(token)
+
+
+def current_usage():
+    """Get the usage record of the current context, or None when nothing is recording"""
+    return _current.get()
+
+
+def record_chat_usage(model, usage):
+    """Add a chat completion's token usage to the current record"""
+    record = _current.get()
+    if record is None or usage is None:
+        return
+    record.prompt_tokens += usage.prompt_tokens or 0
+    record.completion_tokens += usage.completion_tokens or 0
+    record.model = model
+
+
+def record_embedding_usage(usage):
+    """Add an embeddings call's token usage to the current record"""
+    record = _current.get()
+    if record is None or usage is None:
+        return
+    record.embedding_tokens += usage.total_tokens or 0
+
+
+def record_prompt(rag_context_tokens, prompt_build_ms):
+    """Record the size of the RAG context and the time spent assembling the prompt"""
+    record = _current.get()
+    if record is None:
+        return
+    record.rag_context_tokens = rag_context_tokens
+    record.prompt_build_ms = prompt_build_ms
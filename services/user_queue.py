@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+
+from routes.utils.config_service import ConfigManager
+
+logger = logging.getLogger(__name__)
+
+
+class _Pending:
+    """Messages of one LINE user waiting for their owner, with the arrival times of the burst"""
+
+    __slots__ = ("events", "first_at", "last_at")
+
+    def __init__(self):
+        self.events = []
+        self.first_at = None
+        self.last_at = None
+
+
+class UserMessageQueue:
+    """Per-user message queues that serialise handling and coalesce bursts
+
+    The first job to push a user's messages becomes that user's owner: it handles
+    them, and everything the user sends until it releases the user, one batch at a
+    time. Other jobs only append to the queue, so a user's turns never run
+    concurrently or out of order. A batch is ready once the user has been quiet
+    for MESSAGE_COALESCE_WINDOW_MS (0, the default, takes messages right away:
+    only those that arrive while the previous batch is being handled are
+    merged), or MESSAGE_COALESCE_MAX_WAIT_MS after its first message arrived.
+
+    State is kept per process, so the guarantees hold only while all of a
+    user's deliveries reach the same process: a single gunicorn or uvicorn
+    worker with the webhook queue in thread mode. With several workers, or with
+    WEBHOOK_WORKER_MODE=process, each process serialises only the messages it
+    receives.
+    """
+
+    def __init__(self):
+        self._users = {}  # line_user_id -> _Pending
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _settings():
+        """Get the quiet window and the maximum wait in seconds"""
+        return (
+            int(ConfigManager.get("MESSAGE_COALESCE_WINDOW_MS", "0")) / 1000.0,
+            int(ConfigManager.get("MESSAGE_COALESCE_MAX_WAIT_MS", "3000")) / 1000.0,
+        )
+
+    def push(self, user_id, events):
+        """Queue a user's events, returning True if the caller became the user's owner"""
+        now = time.monotonic()
+        with self._lock:
+            pending = self._users.get(user_id)
+            is_owner = pending is None
+            if is_owner:
+                pending = self._users[user_id] = _Pending()
+            if not pending.events:
+                pending.first_at = now
+            pending.events.extend(events)
+            pending.last_at = now
+        if not is_owner:
+            logger.debug("Queued %d events behind the handler of user %s", len(events), user_id)
+        return is_owner
+
+    def take(self, user_id):
+        """Take the owner's next batch of events
+
+        Returns (events, 0) when a batch is ready, ([], seconds) while the
+        batch's window is still open and ([], 0) when nothing is pending.
+        """
+        window, max_wait = self._settings()
+        now = time.monotonic()
+        with self._lock:
+            pending = self._users[user_id]
+            if not pending.events:
+                return [], 0
+            ready_at = min(pending.last_at + window, pending.first_at + max_wait)
+            if now < ready_at:
+                return [], ready_at - now
+            events, pending.events = pending.events, []
+            return events, 0
+
+    def release(self, user_id):
+        """Give up ownership of a user, unless more events arrived (then returns False and the caller still owns it)"""
+        with self._lock:
+            if self._users[user_id].events:
+                return False
+            del self._users[user_id]
+            return True
+
+    def discard(self, user_id):
+        """Drop a user's queue and ownership after a failure, returning the events that were dropped"""
+        with self._lock:
+            pending = self._users.pop(user_id, None)
+        return pending.events if pending is not None else []
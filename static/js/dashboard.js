@@ -15,22 +15,40 @@ function initActivityChart() {
     
     if (!ctx) return;
     
-    // Generate sample data for the past 7 days
+    fetch(ctx.dataset.statsUrl)
+        .then(response => response.json())
+        .then(stats => drawActivityChart(ctx, stats.hourly))
+        .catch(error => console.error('Error loading dashboard stats:', error));
+}
+
+/**
+ * Sum hourly rollups into per-day counts for the last 7 local days and draw the chart
+ */
+function drawActivityChart(ctx, hourly) {
     const labels = [];
     const userMessages = [];
     const botMessages = [];
+    const dayIndex = {};
     
     // Get dates for the last 7 days
     for (let i = 6; i >= 0; i--) {
         const date = new Date();
         date.setDate(date.getDate() - i);
+        dayIndex[date.toDateString()] = labels.length;
         labels.push(date.toLocaleDateString('en-US', { weekday: 'short', month: 'short', day: 'numeric' }));
-        
-        // Random data for demonstration
-        userMessages.push(Math.floor(Math.random() * 20 + 5));
-        botMessages.push(Math.floor(Math.random() * 20 + 5));
+        userMessages.push(0);
+        botMessages.push(0);
     }
     
+    // Rollup hours are UTC; bucket them by the browser's local day
+    hourly.forEach(bucket => {
+        const index = dayIndex[new Date(bucket.hour).toDateString()];
+        if (index !== undefined) {
+            userMessages[index] += bucket.user_messages;
+            botMessages[index] += bucket.bot_messages;
+        }
+    });
+    
     // Create chart
     new Chart(ctx, {
         type: 'line',